@@ -0,0 +1,135 @@
+from collections import OrderedDict
+import numpy as np
+from scipy.io import netcdf_file
+
+# Lookup methods of GebcoBathymetry.sample
+BATHYMETRY_METHODS = ('nearest', 'bilinear')
+
+# Cells per side of a cached tile, and how many tiles stay in memory
+# (256 x 256 int16 cells is 128 KiB, so the default cache holds at most 32 MiB)
+TILE_SIZE = 256
+MAX_TILES = 256
+
+class GebcoBathymetry:
+    # Samples a GEBCO_08 style netCDF 3 grid: a flat row-major 'z' variable running
+    # west to east from the northernmost row, described by 'x_range', 'y_range',
+    # 'spacing' and 'dimension', with cells centred half a spacing inside the ranges.
+    # The file is memory mapped and read a tile at a time into a bounded LRU cache,
+    # so sampling never loads the whole grid.
+    def __init__(self, path, tile_size=TILE_SIZE, max_tiles=MAX_TILES):
+        self.path = path
+        self.tile_size = tile_size
+        self.max_tiles = max_tiles
+        self.file = netcdf_file(path, 'r', mmap=True, maskandscale=False)
+        variables = self.file.variables
+        self.x_range = variables['x_range'][:].astype(float)
+        self.y_range = variables['y_range'][:].astype(float)
+        self.spacing = variables['spacing'][:].astype(float)
+        self.nx, self.ny = (int(n) for n in variables['dimension'][:])
+        z = variables['z']
+        self.z = z.data.reshape(self.ny, self.nx)
+        self.scale_factor = float(getattr(z, 'scale_factor', 1.0))
+        self.add_offset = float(getattr(z, 'add_offset', 0.0))
+        self.fill_value = getattr(z, '_FillValue', None)
+        # Longitudes wrap around when the grid spans the whole globe
+        self.periodic = np.isclose(self.nx * self.spacing[0], 360.0)
+
+        self._tiles = OrderedDict()
+        self.tile_hits = 0
+        self.tile_misses = 0
+
+    def close(self):
+        # Release the tiles and the memory map
+        self._tiles.clear()
+        self.z = None
+        self.file.close()
+
+    def __del__(self):
+        # Drop the tile and array views first, or netcdf_file warns that it cannot close
+        if getattr(self, 'z', None) is not None:
+            self.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def tile(self, ty, tx):
+        # Cells of tile (ty, tx) as an in-memory array, most recently used last
+        key = (ty, tx)
+        tile = self._tiles.get(key)
+        if tile is not None:
+            self._tiles.move_to_end(key)
+            self.tile_hits += 1
+            return tile
+        self.tile_misses += 1
+        size = self.tile_size
+        tile = np.array(self.z[ty * size:(ty + 1) * size, tx * size:(tx + 1) * size])
+        self._tiles[key] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+
+    def cells(self, rows, cols):
+        # Raw values of the cells at integer rows and columns, read tile by tile
+        rows = np.asarray(rows, dtype=np.int64)
+        cols = np.asarray(cols, dtype=np.int64)
+        size = self.tile_size
+        tiles_per_row = -(-self.nx // size)
+        tile_id = (rows // size) * tiles_per_row + cols // size
+        unique, inverse = np.unique(tile_id, return_inverse=True)
+        # Sort the points by tile so each tile's points form one contiguous run
+        order = np.argsort(inverse, kind='stable')
+        bounds = np.searchsorted(inverse[order], np.arange(len(unique) + 1))
+        values = np.empty(rows.shape, dtype=self.z.dtype)
+        for k, tid in enumerate(unique):
+            points = order[bounds[k]:bounds[k + 1]]
+            ty, tx = divmod(int(tid), tiles_per_row)
+            values[points] = self.tile(ty, tx)[rows[points] - ty * size, cols[points] - tx * size]
+        return values
+
+    def elevation(self, raw):
+        # Raw cell values in metres (negative below sea level), NaN where missing
+        values = raw.astype(float)
+        if self.fill_value is not None:
+            values[raw == self.fill_value] = np.nan
+        return values * self.scale_factor + self.add_offset
+
+    def sample(self, lat, lon, method='nearest'):
+        # Bathymetry in metres at arrays of coordinates (or a single point): the
+        # containing cell with 'nearest', or interpolated between the four
+        # surrounding cell centres with 'bilinear'. NaN outside the grid.
+        if method not in BATHYMETRY_METHODS:
+            raise ValueError(f"Unknown bathymetry method {method!r}")
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+        shape = lat.shape
+        lat, lon = lat.ravel(), lon.ravel()
+        # Fractional cell coordinates, rows counted down from the northern edge
+        y = (self.y_range[1] - lat) / self.spacing[1]
+        x = (lon - self.x_range[0]) / self.spacing[0]
+        if self.periodic:
+            x = np.mod(x, self.nx)
+        inside = np.isfinite(y) & np.isfinite(x) & (y >= 0) & (y <= self.ny) & (x >= 0) & (x <= self.nx)
+        result = np.full(lat.shape, np.nan)
+        y, x = y[inside], x[inside]
+
+        if method == 'nearest':
+            rows = np.minimum(y.astype(np.int64), self.ny - 1)
+            cols = np.minimum(x.astype(np.int64), self.nx - 1)
+            result[inside] = self.elevation(self.cells(rows, cols))
+            return result.reshape(shape) if shape else float(result[0])
+
+        # Bilinear between cell centres; rows clamp at the poles, columns wrap on a
+        # global grid and clamp otherwise
+        y, x = y - 0.5, x - 0.5
+        row0 = np.floor(y).astype(np.int64)
+        col0 = np.floor(x).astype(np.int64)
+        ty, tx = y - row0, x - col0
+        rows = np.clip(np.stack([row0, row0, row0 + 1, row0 + 1]), 0, self.ny - 1)
+        cols = np.stack([col0, col0 + 1, col0, col0 + 1])
+        cols = np.mod(cols, self.nx) if self.periodic else np.clip(cols, 0, self.nx - 1)
+        corners = self.elevation(self.cells(rows.ravel(), cols.ravel())).reshape(4, -1)
+        weights = np.stack([(1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx])
+        result[inside] = np.sum(weights * corners, axis=0)
+        return result.reshape(shape) if shape else float(result[0])
@@ -0,0 +1,225 @@
+import argparse
+import itertools
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+from scipy.stats import norm
+
+# Environmental covariates compared by ConLogModels.R
+COVARIATES = ('bat', 'inc', 'int')
+
+# Tie handling of the conditional likelihood, as clogit(method=...) in R's survival
+TIES = ('efron', 'breslow')
+
+_worker_data = None
+
+def prepare_strata(strata, event, X):
+    # Sort rows by stratum and describe the groups for fit_clogit: row boundaries,
+    # events per stratum and, for Efron, one entry per event holding its stratum and
+    # tie fraction l / d (l = 0 .. d - 1)
+    codes, _ = pd.factorize(pd.Series(strata), sort=False)
+    order = np.argsort(codes, kind='stable')
+    codes = codes[order]
+    starts = np.flatnonzero(np.r_[True, codes[1:] != codes[:-1]])
+    event = np.asarray(event, dtype=float)[order]
+    n_events = np.add.reduceat(event, starts)
+    d = n_events.astype(np.int64)
+    tie_stratum = np.repeat(np.arange(len(starts)), d)
+    tie_fraction = (np.arange(d.sum()) - np.repeat(np.cumsum(d) - d, d)) / np.repeat(np.maximum(d, 1), d)
+    return {
+        'X': np.asarray(X, dtype=float)[order],
+        'event': event,
+        'starts': starts,
+        'n_events': n_events,
+        'tie_stratum': tie_stratum,
+        'tie_fraction': tie_fraction
+    }
+
+def clogit_terms(beta, groups, ties='efron'):
+    # Log partial likelihood, gradient and Hessian at beta, summed over strata. Every
+    # per-stratum sum is taken with np.add.reduceat over the sorted rows.
+    X, event, starts, d = groups['X'], groups['event'], groups['starts'], groups['n_events']
+    p = X.shape[1]
+    eta = X @ beta
+    # Shift each stratum by its largest linear predictor so exp cannot overflow
+    shift = np.maximum.reduceat(eta, starts) if len(eta) else np.zeros(0)
+    w = np.exp(eta - np.repeat(shift, np.diff(np.r_[starts, len(eta)])))
+    we = w * event
+
+    S = np.add.reduceat(w, starts)
+    S1 = np.add.reduceat(w[:, None] * X, starts)
+    S_D = np.add.reduceat(we, starts)
+    S1_D = np.add.reduceat(we[:, None] * X, starts)
+    S2 = np.empty((len(starts), p, p))
+    S2_D = np.empty((len(starts), p, p))
+    for i in range(p):
+        for j in range(i, p):
+            xx = X[:, i] * X[:, j]
+            S2[:, i, j] = S2[:, j, i] = np.add.reduceat(w * xx, starts)
+            S2_D[:, i, j] = S2_D[:, j, i] = np.add.reduceat(we * xx, starts)
+
+    score = np.add.reduceat(event * eta, starts)
+    gradient = event @ X
+
+    if ties == 'breslow':
+        loglik = np.sum(score - d * (np.log(S) + shift))
+        mean = S1 / S[:, None]
+        gradient = gradient - np.sum(d[:, None] * mean, axis=0)
+        cov = S2 / S[:, None, None] - mean[:, :, None] * mean[:, None, :]
+        hessian = -np.einsum('s,sij->ij', d, cov)
+        return loglik, gradient, hessian
+    elif ties != 'efron':
+        raise ValueError(f"Unknown tie method {ties!r}")
+
+    # Efron: the l-th of d tied events sees the denominator S - (l / d) S_D, so only
+    # sums of 1 / D, a / D, 1 / D^2, a / D^2 and a^2 / D^2 over l are needed per stratum
+    s, a = groups['tie_stratum'], groups['tie_fraction']
+    D = S[s] - a * S_D[s]
+    n = len(starts)
+    inv = np.bincount(s, 1 / D, n)
+    a_inv = np.bincount(s, a / D, n)
+    inv2 = np.bincount(s, 1 / D ** 2, n)
+    a_inv2 = np.bincount(s, a / D ** 2, n)
+    aa_inv2 = np.bincount(s, a * a / D ** 2, n)
+
+    loglik = np.sum(score - d * shift) - np.sum(np.log(D))
+    gradient = gradient - np.sum(S1 * inv[:, None] - S1_D * a_inv[:, None], axis=0)
+    outer = lambda u, v: u[:, :, None] * v[:, None, :]
+    second = S2 * inv[:, None, None] - S2_D * a_inv[:, None, None]
+    first = (outer(S1, S1) * inv2[:, None, None]
+             - (outer(S1, S1_D) + outer(S1_D, S1)) * a_inv2[:, None, None]
+             + outer(S1_D, S1_D) * aa_inv2[:, None, None])
+    hessian = -np.sum(second - first, axis=0)
+    return loglik, gradient, hessian
+
+def fit_clogit(data, covariates, strata='turtle_id', event='is_realpath', ties='efron', max_iter=30, tol=1e-9):
+    # Conditional logistic regression of event on the covariates within strata, as
+    # clogit(event ~ covariates + strata(strata), method=ties) in R: Newton-Raphson
+    # with step halving on the partial likelihood. Rows missing any used value are
+    # dropped. Returns a dict with 'coef', 'se', 'z' and 'p' (per covariate),
+    # 'loglik', 'null_loglik', 'n', 'n_events', 'bic' (with log of the number of
+    # events, as R's BIC for coxph), 'aic', 'iterations' and 'converged'.
+    covariates = list(covariates)
+    columns = [data[strata], data[event]] + [data[name] for name in covariates]
+    keep = np.ones(len(data), dtype=bool)
+    for column in columns:
+        keep &= column.notna().to_numpy()
+    X = data.loc[keep, covariates].to_numpy(dtype=float) if covariates else np.zeros((keep.sum(), 0))
+    # Centre the covariates: this leaves conditional coefficients unchanged and keeps
+    # exp(X beta) well scaled
+    X = X - X.mean(axis=0) if len(X) else X
+    groups = prepare_strata(data.loc[keep, strata].to_numpy(), data.loc[keep, event].to_numpy(), X)
+
+    beta = np.zeros(len(covariates))
+    loglik, gradient, hessian = clogit_terms(beta, groups, ties)
+    null_loglik = loglik
+    converged = len(covariates) == 0
+    iterations = 0
+    while not converged and iterations < max_iter:
+        iterations += 1
+        step = np.linalg.solve(-hessian, gradient)
+        for _ in range(30):
+            new = clogit_terms(beta + step, groups, ties)
+            if np.isfinite(new[0]) and new[0] >= loglik - 1e-12 * abs(loglik):
+                break
+            step = step / 2
+        beta = beta + step
+        converged = abs(new[0] - loglik) <= tol * max(abs(new[0]), 1.0)
+        loglik, gradient, hessian = new
+
+    n_events = float(groups['n_events'].sum())
+    k = len(covariates)
+    information = -hessian
+    se = np.sqrt(np.diag(np.linalg.inv(information))) if k else np.zeros(0)
+    z = beta / se if k else np.zeros(0)
+    return {
+        'covariates': covariates,
+        'ties': ties,
+        'coef': beta,
+        'se': se,
+        'z': z,
+        'p': 2 * norm.sf(np.abs(z)),
+        'loglik': loglik,
+        'null_loglik': null_loglik,
+        'n': int(keep.sum()),
+        'n_events': n_events,
+        'bic': -2 * loglik + k * np.log(n_events),
+        'aic': -2 * loglik + 2 * k,
+        'iterations': iterations,
+        'converged': converged
+    }
+
+def coefficient_table(result):
+    # The coefficient part of a fit_clogit result, laid out like R's summary
+    return pd.DataFrame({
+        'coef': result['coef'],
+        'exp(coef)': np.exp(result['coef']),
+        'se(coef)': result['se'],
+        'z': result['z'],
+        'Pr(>|z|)': result['p']
+    }, index=result['covariates'])
+
+def _init_worker(data):
+    global _worker_data
+    _worker_data = data
+
+def _fit_subset(args):
+    subset, options = args
+    return fit_clogit(_worker_data, subset, **options)
+
+def search_models(data, covariates=COVARIATES, strata='turtle_id', event='is_realpath', ties='efron',
+                  processes=None):
+    # Fit every subset of the covariates, the empty null model included, on a process
+    # pool of the given size (None uses every core, 1 runs in this process) and rank
+    # them by BIC. Every model is fitted on the rows complete in all covariates, so
+    # their likelihoods are comparable. Returns a DataFrame with one row per model
+    # and the fit_clogit results, in the same order, in its 'fits' attribute.
+    covariates = list(covariates)
+    data = data[[strata, event] + covariates].dropna()
+    options = {'strata': strata, 'event': event, 'ties': ties}
+    subsets = [list(subset) for size in range(len(covariates) + 1)
+               for subset in itertools.combinations(covariates, size)]
+    tasks = [(subset, options) for subset in subsets]
+
+    if processes == 1 or len(tasks) == 1:
+        _init_worker(data)
+        fits = list(map(_fit_subset, tasks))
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(data,)) as pool:
+            fits = pool.map(_fit_subset, tasks)
+
+    table = pd.DataFrame({
+        'model': [' + '.join(fit['covariates']) or '1' for fit in fits],
+        'k': [len(fit['covariates']) for fit in fits],
+        'loglik': [fit['loglik'] for fit in fits],
+        'bic': [fit['bic'] for fit in fits],
+        'aic': [fit['aic'] for fit in fits],
+        'converged': [fit['converged'] for fit in fits]
+    })
+    order = np.argsort(table['bic'].to_numpy(), kind='stable')
+    table = table.iloc[order].reset_index(drop=True)
+    table['delta_bic'] = table['bic'] - table['bic'].iloc[0]
+    table.attrs['fits'] = [fits[i] for i in order]
+    return table
+
+def read_paths(path):
+    # Long-format path data from a Parquet dataset directory/file or a CSV file
+    if os.path.isdir(path) or path.endswith('.parquet'):
+        return pd.read_parquet(path)
+    return pd.read_csv(path)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Rank conditional logit models of real versus fake paths by BIC")
+    parser.add_argument('data', help="Parquet dataset from TrackPipeline.py or combined_turtle_data_long.csv")
+    parser.add_argument('--covariates', nargs='+', default=list(COVARIATES))
+    parser.add_argument('--ties', choices=TIES, default='efron')
+    parser.add_argument('--processes', type=int, default=None)
+    args = parser.parse_args()
+
+    table = search_models(read_paths(args.data), args.covariates, ties=args.ties, processes=args.processes)
+    print(table.to_string(index=False))
+    best = table.attrs['fits'][0]
+    if best['covariates']:
+        print(f"\nBest model: {table['model'].iloc[0]}")
+        print(coefficient_table(best).to_string())
@@ -0,0 +1,86 @@
+import os
+import zlib
+import numpy as np
+import pandas as pd
+
+# Columns of the long-format table read by ConLogModels.R, one row per path step
+LONG_COLUMNS = ['turtle_id', 'path_id', 'is_realpath', 'step', 'time', 'lat', 'lon']
+
+def turtle_id_from_path(file_path):
+    # Turtle ID of a track file: the first 6 characters of its name, e.g. T53434
+    return os.path.basename(file_path)[:6]
+
+def track_seed(seed, turtle_id):
+    # Seed for one turtle's scrambled paths, derived from a run seed and the turtle
+    # ID so each track's paths stay the same whatever else is processed with it
+    return [seed, zlib.crc32(turtle_id.encode())]
+
+def track_deltas(track):
+    # Start time and position plus per-step (deltaT, deltaLat, deltaLon) of a cleaned
+    # track (datetime, latitude, longitude and, optionally, the delta columns written
+    # by GenerateShiftedTrack.ipynb, whose first row is zero)
+    times = pd.to_datetime(track['datetime']).to_numpy()
+    if {'deltaT', 'deltaLat', 'deltaLon'}.issubset(track.columns):
+        deltas = track[['deltaT', 'deltaLat', 'deltaLon']].to_numpy(dtype=float)
+    else:
+        deltas = np.zeros((len(track), 3))
+        deltas[1:, 0] = np.diff(times) / np.timedelta64(1, 's')
+        deltas[1:, 1] = np.diff(track['latitude'].to_numpy(dtype=float))
+        deltas[1:, 2] = np.diff(track['longitude'].to_numpy(dtype=float))
+    start = (times[0], float(track['latitude'].iloc[0]), float(track['longitude'].iloc[0]))
+    return start, deltas
+
+def real_path(track, turtle_id):
+    # The observed track in long format
+    return pd.DataFrame({
+        'turtle_id': turtle_id,
+        'path_id': 'realpath',
+        'is_realpath': 1,
+        'step': np.arange(len(track)),
+        'time': pd.to_datetime(track['datetime']).to_numpy(),
+        'lat': track['latitude'].to_numpy(dtype=float),
+        'lon': track['longitude'].to_numpy(dtype=float)
+    }, columns=LONG_COLUMNS)
+
+def scrambled_paths(track, n_paths, seed=None, turtle_id=None):
+    # n_paths null paths as in Leclerc et al. (2021): each replays the track's steps
+    # (deltaT, deltaLat, deltaLon) in an independent random order from the track's
+    # start. All permutations and cumulative sums are taken in one array operation.
+    # seed (an int, SeedSequence or Generator) makes the paths reproducible. Returns
+    # a long-format DataFrame with path_id 'fakepath_<k>' for k = 0 .. n_paths - 1.
+    (start_time, start_lat, start_lon), deltas = track_deltas(track)
+    rng = np.random.default_rng(seed)
+    n_steps = len(deltas)
+    order = rng.permuted(np.broadcast_to(np.arange(n_steps), (n_paths, n_steps)), axis=1)
+    paths = np.cumsum(deltas[order], axis=1)  # (n_paths, n_steps, 3)
+    offsets = np.rint(paths[:, :, 0] * 1e9).astype(np.int64).astype('timedelta64[ns]')
+
+    return pd.DataFrame({
+        'turtle_id': turtle_id,
+        'path_id': np.repeat(np.char.add('fakepath_', np.arange(n_paths).astype(str)), n_steps),
+        'is_realpath': 0,
+        'step': np.tile(np.arange(n_steps), n_paths),
+        'time': (start_time + offsets).ravel(),
+        'lat': (start_lat + paths[:, :, 1]).ravel(),
+        'lon': (start_lon + paths[:, :, 2]).ravel()
+    }, columns=LONG_COLUMNS)
+
+def null_path_table(track, n_paths, seed=None, turtle_id=None):
+    # The real path followed by n_paths scrambled paths, in long format
+    return pd.concat([real_path(track, turtle_id), scrambled_paths(track, n_paths, seed, turtle_id)],
+                     ignore_index=True)
+
+def add_environment(paths, magmodel=None, bathymetry=None, bathymetry_method='bilinear'):
+    # Add the conditions compared by ConLogModels.R to every row of a long table:
+    # 'int' and 'inc' (magnetic intensity and inclination at each row's time) from
+    # magmodel and 'bat' from a Bathymetry.GebcoBathymetry sampler, each in one
+    # vectorized lookup
+    lat = paths['lat'].to_numpy()
+    lon = paths['lon'].to_numpy()
+    if bathymetry is not None:
+        paths['bat'] = bathymetry.sample(lat, lon, bathymetry_method)
+    if magmodel is not None:
+        field = magmodel.evaluate_times(lat, lon, paths['time'].to_numpy())
+        paths['int'] = field['F']
+        paths['inc'] = field['I']
+    return paths
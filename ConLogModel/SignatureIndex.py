@@ -0,0 +1,96 @@
+import numpy as np
+
+# Share of each cell's F and I range added on every side when testing whether a
+# target can lie in it: the field inside a cell may overshoot its corner values
+CELL_MARGIN = 0.25
+
+# Cells whose scaled (F, I) box is larger than this quantile of all cells are kept
+# out of the KD-tree and tested directly, so a few extreme cells do not widen every
+# tree query
+TREE_QUANTILE = 0.99
+
+def merge_solutions(targets, lat, lon, residual, distance):
+    # Indices of one solution (the smallest residual) per target among solutions
+    # closer than distance degrees to each other, ordered by target
+    from scipy.sparse import coo_matrix
+    from scipy.sparse.csgraph import connected_components
+    from scipy.spatial import cKDTree
+
+    n = len(targets)
+    if n == 0:
+        return np.empty(0, dtype=np.int64)
+    rlat, rlon = np.radians(lat), np.radians(lon)
+    # Unit vectors, with targets pushed far apart along a fourth axis
+    points = np.column_stack([np.cos(rlat) * np.cos(rlon), np.cos(rlat) * np.sin(rlon), np.sin(rlat),
+                              4.0 * targets])
+    pairs = cKDTree(points).query_pairs(2 * np.sin(np.radians(distance) / 2), output_type='ndarray')
+    links = coo_matrix((np.ones(len(pairs)), (pairs[:, 0], pairs[:, 1])), shape=(n, n))
+    _, component = connected_components(links, directed=False)
+    order = np.lexsort((residual, component))
+    first = order[np.r_[True, component[order][1:] != component[order][:-1]]]
+    return first[np.lexsort((lon[first], lat[first], targets[first]))]
+
+class SignatureIndex:
+    # Spatial index of the sampled grid cells by magnetic signature: each cell between
+    # four neighbouring samples covers the box of (F, I) values spanned by its
+    # corners (plus CELL_MARGIN). A KD-tree over the box centres, in units where the
+    # median cell box is about 1 x 1, finds every cell whose box holds a target
+    # signature, i.e. every place that target can occur.
+    def __init__(self, latitudes, longitudes, F_TOTAL, I_INCL, margin=CELL_MARGIN, tree_quantile=TREE_QUANTILE):
+        from scipy.spatial import cKDTree
+
+        self.latitudes = np.asarray(latitudes, dtype=float)
+        self.longitudes = np.asarray(longitudes, dtype=float)
+        F = np.asarray(F_TOTAL, dtype=float)
+        I = np.asarray(I_INCL, dtype=float)
+
+        def cell_range(values):
+            corners = np.stack([values[:-1, :-1], values[:-1, 1:], values[1:, :-1], values[1:, 1:]])
+            low, high = corners.min(axis=0).ravel(), corners.max(axis=0).ravel()
+            pad = margin * (high - low)
+            return low - pad, high + pad
+
+        self.F_low, self.F_high = cell_range(F)
+        self.I_low, self.I_high = cell_range(I)
+        self.shape = (len(self.latitudes) - 1, len(self.longitudes) - 1)
+
+        F_width = self.F_high - self.F_low
+        I_width = self.I_high - self.I_low
+        self.F_scale = max(float(np.median(F_width)), 1e-12)
+        self.I_scale = max(float(np.median(I_width)), 1e-12)
+        centres = np.column_stack([(self.F_low + self.F_high) / 2 / self.F_scale,
+                                   (self.I_low + self.I_high) / 2 / self.I_scale])
+        half_diagonal = np.hypot(F_width / self.F_scale, I_width / self.I_scale) / 2
+
+        self.radius = float(np.quantile(half_diagonal, tree_quantile))
+        in_tree = half_diagonal <= self.radius
+        self.tree_cells = np.flatnonzero(in_tree)
+        self.large_cells = np.flatnonzero(~in_tree)
+        self.tree = cKDTree(centres[in_tree])
+
+    def __len__(self):
+        return self.shape[0] * self.shape[1]
+
+    def candidates(self, F_TOTAL, I_INCL):
+        # Every (target, cell) pair whose cell box holds the target signature, for
+        # 1-D arrays of targets. Returns target indices and flat cell indices.
+        F = np.atleast_1d(np.asarray(F_TOTAL, dtype=float))
+        I = np.atleast_1d(np.asarray(I_INCL, dtype=float))
+        queries = np.column_stack([F / self.F_scale, I / self.I_scale])
+        found = self.tree.query_ball_point(queries, self.radius)
+        counts = np.fromiter((len(cells) for cells in found), dtype=np.int64, count=len(found))
+        targets = np.repeat(np.arange(len(F)), counts)
+        cells = self.tree_cells[np.concatenate(found).astype(np.int64)] if counts.sum() else np.empty(0, np.int64)
+        if self.large_cells.size:
+            targets = np.concatenate([targets, np.repeat(np.arange(len(F)), self.large_cells.size)])
+            cells = np.concatenate([cells, np.tile(self.large_cells, len(F))])
+
+        inside = ((self.F_low[cells] <= F[targets]) & (F[targets] <= self.F_high[cells]) &
+                  (self.I_low[cells] <= I[targets]) & (I[targets] <= self.I_high[cells]))
+        return targets[inside], cells[inside]
+
+    def cell_bounds(self, cells):
+        # (lat_low, lat_high, lon_low, lon_high) of flat cell indices
+        rows, cols = np.unravel_index(cells, self.shape)
+        return (self.latitudes[rows], self.latitudes[rows + 1],
+                self.longitudes[cols], self.longitudes[cols + 1])
@@ -0,0 +1,161 @@
+import argparse
+import glob
+import hashlib
+import json
+import multiprocessing
+import os
+import pandas as pd
+import ScrambledPaths as scrambled
+
+# Bump when the stages change what they write, so every track is rebuilt
+PIPELINE_VERSION = 2
+
+# Columns of the .si track files
+TRACK_COLUMNS = ["TrackID", "year", "month", "day", "hour", "minute", "second", "latitude", "longitude"]
+
+# Per-track fingerprints, kept next to the partitions (pyarrow skips _ files)
+MANIFEST = '_manifest.json'
+
+_worker = None
+
+def clean_track(file_path):
+    # A .si track as the cleaned table of GenerateShiftedTrack.ipynb: datetime,
+    # latitude, longitude and the deltas from the previous fix (zero for the first)
+    df = pd.read_csv(file_path, sep=r'\s+', names=TRACK_COLUMNS)
+    df['datetime'] = pd.to_datetime(df[['year', 'month', 'day', 'hour', 'minute', 'second']])
+    df['deltaT'] = df['datetime'].diff().dt.total_seconds().fillna(0)
+    df['deltaLat'] = df['latitude'].diff().fillna(0)
+    df['deltaLon'] = df['longitude'].diff().fillna(0)
+    return df[['datetime', 'latitude', 'longitude', 'deltaT', 'deltaLat', 'deltaLon']]
+
+def track_digest(file_path, params):
+    # Fingerprint of one track's input bytes and every parameter that shapes its output
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode())
+    with open(file_path, 'rb') as file:
+        for block in iter(lambda: file.read(1 << 20), b''):
+            digest.update(block)
+    return digest.hexdigest()
+
+def partition_path(output, turtle_id):
+    return os.path.join(output, f"turtle_id={turtle_id}")
+
+def load_manifest(output):
+    try:
+        with open(os.path.join(output, MANIFEST)) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {}
+
+def save_manifest(output, manifest):
+    tmp = os.path.join(output, MANIFEST + '.tmp')
+    with open(tmp, 'w') as file:
+        json.dump(manifest, file, indent=1, sort_keys=True)
+    os.replace(tmp, os.path.join(output, MANIFEST))
+
+def _init_worker(settings):
+    # Open the magnetic model and bathymetry grid once per worker process
+    global _worker
+    import MagneticModel as magmod
+    from Bathymetry import GebcoBathymetry
+    magmodel = magmod.MagneticModel(None, settings['date'], cache_dir=settings['cache_dir'])
+    bathymetry = GebcoBathymetry(settings['gebco']) if settings['gebco'] else None
+    _worker = (settings, magmodel, bathymetry)
+
+def process_track(task):
+    # Clean one track, add its scrambled null paths and their environment, and
+    # write it as the track's Parquet partition
+    turtle_id, file_path, digest = task
+    settings, magmodel, bathymetry = _worker
+    track = clean_track(file_path)
+    paths = scrambled.null_path_table(track, settings['n_paths'],
+                                      seed=scrambled.track_seed(settings['seed'], turtle_id), turtle_id=turtle_id)
+    paths = scrambled.add_environment(paths, magmodel, bathymetry, settings['bathymetry_method'])
+
+    # The partition directory carries turtle_id; write next to the old file and
+    # swap it in so readers never see a partial partition
+    partition = partition_path(settings['output'], turtle_id)
+    os.makedirs(partition, exist_ok=True)
+    tmp = os.path.join(partition, '.part-0.parquet.tmp')
+    paths.drop(columns='turtle_id').to_parquet(tmp, index=False)
+    os.replace(tmp, os.path.join(partition, 'part-0.parquet'))
+    return turtle_id, digest, len(paths)
+
+def run_pipeline(tracks, output, gebco=None, cache_dir='magmodel_cache', date=None, n_paths=101, seed=0,
+                 bathymetry_method='bilinear', processes=None, force=False, verbose=True):
+    # Process every .si file in the tracks directory into a Parquet dataset under
+    # output, partitioned by turtle_id. Tracks whose file contents and parameters
+    # match the manifest are skipped, and partitions of removed tracks are deleted.
+    # Returns the turtle IDs that were (re)built.
+    settings = {
+        'output': output, 'gebco': gebco, 'cache_dir': cache_dir, 'date': date, 'n_paths': n_paths,
+        'seed': seed, 'bathymetry_method': bathymetry_method
+    }
+    gebco_id = None
+    if gebco is not None:
+        stat = os.stat(gebco)
+        gebco_id = [os.path.basename(gebco), stat.st_size, stat.st_mtime_ns]
+    params = {
+        'version': PIPELINE_VERSION, 'date': date, 'n_paths': n_paths, 'seed': seed,
+        'bathymetry_method': bathymetry_method if gebco is not None else None, 'gebco': gebco_id
+    }
+
+    files = {}
+    for file_path in sorted(glob.glob(os.path.join(tracks, '*.si'))):
+        turtle_id = scrambled.turtle_id_from_path(file_path)
+        if turtle_id in files:
+            raise ValueError(f"{file_path} and {files[turtle_id]} share turtle ID {turtle_id}")
+        files[turtle_id] = file_path
+
+    os.makedirs(output, exist_ok=True)
+    manifest = {} if force else load_manifest(output)
+    for turtle_id in set(manifest) - set(files):
+        for part in glob.glob(os.path.join(partition_path(output, turtle_id), '*')):
+            os.remove(part)
+        os.rmdir(partition_path(output, turtle_id))
+        del manifest[turtle_id]
+
+    tasks = []
+    for turtle_id, file_path in files.items():
+        digest = track_digest(file_path, params)
+        if manifest.get(turtle_id) != digest or not os.path.exists(partition_path(output, turtle_id)):
+            tasks.append((turtle_id, file_path, digest))
+    if verbose:
+        print(f"{len(tasks)} of {len(files)} tracks to process")
+    save_manifest(output, manifest)
+    if not tasks:
+        return []
+
+    def collect(results):
+        # Record each finished track at once so an interrupted run resumes from it
+        for turtle_id, digest, n_rows in results:
+            manifest[turtle_id] = digest
+            save_manifest(output, manifest)
+            if verbose:
+                print(f"{turtle_id}: {n_rows} rows")
+
+    if processes == 1 or len(tasks) == 1:
+        _init_worker(settings)
+        collect(map(process_track, tasks))
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(settings,)) as pool:
+            collect(pool.imap_unordered(process_track, tasks))
+    return [task[0] for task in tasks]
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description="Build the long-format real and scrambled path dataset used by ConLogModels.R")
+    parser.add_argument('tracks', help="directory of .si track files")
+    parser.add_argument('output', help="Parquet dataset directory, partitioned by turtle_id")
+    parser.add_argument('--gebco', default=os.getenv('GEBCO_FILE'), help="GEBCO_08 netCDF file (bat is skipped without it)")
+    parser.add_argument('--cache-dir', default=os.getenv('MAGMODEL_CACHE', 'magmodel_cache'))
+    parser.add_argument('--date', default=None, help="date of the magnetic model's sampled grid, YYYY-MM-DD "
+                        "(fields along the paths use each point's own time)")
+    parser.add_argument('--paths', type=int, default=101, help="scrambled paths per track")
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--bathymetry-method', choices=('nearest', 'bilinear'), default='bilinear')
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--force', action='store_true', help="rebuild every track")
+    args = parser.parse_args()
+
+    run_pipeline(args.tracks, args.output, args.gebco, args.cache_dir, args.date, args.paths, args.seed,
+                 args.bathymetry_method, args.processes, args.force)
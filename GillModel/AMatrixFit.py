@@ -0,0 +1,193 @@
+import argparse
+import glob
+import math
+import multiprocessing
+import os
+import numpy as np
+import pandas as pd
+
+# Simulated annealing schedule of AMatrixMatchToPath.ipynb
+INITIAL_TEMPERATURE = 1000
+COOLING_RATE = 0.95
+MAX_ITERATIONS = 500
+PERTURBATION_SCALE = 0.1
+
+# Columns of the .si track files
+TRACK_COLUMNS = ["TrackID", "year", "month", "day", "hour", "minute", "second", "latitude", "longitude"]
+
+def calculate_initial_compass_bearing(lat1, lon1, lat2, lon2):
+    # Initial great-circle bearing in degrees [0, 360) from point 1 to point 2, for
+    # scalars or arrays:
+    #   θ = atan2(sin(Δlong).cos(lat2), cos(lat1).sin(lat2) - sin(lat1).cos(lat2).cos(Δlong))
+    lat1 = np.radians(lat1)
+    lat2 = np.radians(lat2)
+    dlon = np.radians(lon2) - np.radians(lon1)
+    x = np.sin(dlon) * np.cos(lat2)
+    y = np.cos(lat1) * np.sin(lat2) - (np.sin(lat1) * np.cos(lat2) * np.cos(dlon))
+    return (np.degrees(np.arctan2(x, y)) + 360) % 360
+
+def read_track(path):
+    # Load a whitespace separated .si track file, with a datetime column
+    df = pd.read_csv(path, sep=r'\s+', names=TRACK_COLUMNS)
+    df['datetime'] = pd.to_datetime(df[['year', 'month', 'day', 'hour', 'minute', 'second']])
+    return df
+
+def prepare_track(latitudes, longitudes, intensity, inclination, goal_F_TOTAL, goal_I_INCL):
+    # Everything the bearing error needs that does not depend on A, as arrays over
+    # the track's steps: step i goes from point i to point i + 1, driven by the field
+    # at point i. Steps with missing positions or field values are dropped.
+    lat = np.asarray(latitudes, dtype=float)
+    lon = np.asarray(longitudes, dtype=float)
+    error = np.stack([goal_F_TOTAL - np.asarray(intensity, dtype=float),
+                      goal_I_INCL - np.asarray(inclination, dtype=float)])
+    bearing = calculate_initial_compass_bearing(lat[:-1], lon[:-1], lat[1:], lon[1:])
+    valid = np.isfinite(bearing) & np.all(np.isfinite(error[:, :-1]), axis=0)
+    lat0 = np.radians(lat[:-1][valid])
+    return {
+        'lat': lat0,
+        'lon': np.radians(lon[:-1][valid]),
+        'sin_lat': np.sin(lat0),
+        'cos_lat': np.cos(lat0),
+        'error': error[:, :-1][:, valid],
+        'bearing': bearing[valid]
+    }
+
+def track_from_dataframe(df, magmodel, goal_lat, goal_lon):
+    # prepare_track for a track DataFrame with latitude/longitude columns, using its
+    # Intensity/Inclination columns if present and magmodel otherwise. With a
+    # datetime column the field is taken at each fix's time and the goal's at the
+    # last fix's time.
+    times = df['datetime'].to_numpy() if 'datetime' in df else None
+    if times is None:
+        field = magmodel.evaluate_many(np.array([goal_lat]), np.array([goal_lon]))
+    else:
+        field = magmodel.evaluate_times(np.array([goal_lat]), np.array([goal_lon]), times[-1:])
+    if 'Intensity' in df and 'Inclination' in df:
+        intensity, inclination = df['Intensity'].to_numpy(), df['Inclination'].to_numpy()
+    elif times is None:
+        samples = magmodel.evaluate_many(df['latitude'].to_numpy(), df['longitude'].to_numpy())
+        intensity, inclination = samples['F'], samples['I']
+    else:
+        samples = magmodel.evaluate_times(df['latitude'].to_numpy(), df['longitude'].to_numpy(), times)
+        intensity, inclination = samples['F'], samples['I']
+    return prepare_track(df['latitude'].to_numpy(), df['longitude'].to_numpy(), intensity, inclination,
+                         field['F'][0], field['I'][0])
+
+def bearing_error(A, track):
+    # Norm over the track of the angle between each observed bearing and the bearing
+    # of one step of the goal-seeking velocity A @ (goal - field), as
+    # error_function in AMatrixMatchToPath.ipynb. A is a 2x2 matrix or a batch of
+    # candidates shaped (k, 2, 2), giving k errors.
+    A = np.asarray(A, dtype=float)
+    velocity = np.einsum('...ij,jn->...in', A, track['error'])
+    dlon = np.radians(velocity[..., 0, :])
+    lat2 = track['lat'] + np.radians(velocity[..., 1, :])
+    cos_lat2 = np.cos(lat2)
+    x = np.sin(dlon) * cos_lat2
+    y = track['cos_lat'] * np.sin(lat2) - track['sin_lat'] * cos_lat2 * np.cos(dlon)
+    simulated = (np.degrees(np.arctan2(x, y)) + 360) % 360
+    difference = np.abs(simulated - track['bearing'])
+    return np.sqrt(np.sum(np.minimum(difference, 360 - difference) ** 2, axis=-1))
+
+def anneal(track, seeds, initial_temperature=INITIAL_TEMPERATURE, cooling_rate=COOLING_RATE,
+           max_iterations=MAX_ITERATIONS, perturbation_scale=PERTURBATION_SCALE):
+    # Independent simulated annealing chains, one per seed, advanced in lockstep so
+    # each iteration scores every chain's candidate in one bearing_error call. Each
+    # chain draws from its own generator, so its result only depends on its seed.
+    # Returns the final A matrices (k, 2, 2) and their errors (k,).
+    rngs = [np.random.default_rng(seed) for seed in seeds]
+    A = np.stack([rng.random((2, 2)) for rng in rngs])
+    current_error = bearing_error(A, track)
+    temperature = initial_temperature
+
+    for _ in range(max_iterations):
+        new_A = A + np.stack([rng.uniform(-perturbation_scale, perturbation_scale, (2, 2)) for rng in rngs])
+        new_error = bearing_error(new_A, track)
+        chance = np.array([rng.uniform(0, 1) for rng in rngs])
+        with np.errstate(over='ignore'):
+            accept = (new_error < current_error) | (chance < np.exp((current_error - new_error) / temperature))
+        A[accept] = new_A[accept]
+        current_error[accept] = new_error[accept]
+        temperature *= cooling_rate
+
+    return A, current_error
+
+def _anneal_task(args):
+    index, start, track, seeds, options = args
+    A, errors = anneal(track, seeds, **options)
+    return index, start, A, errors
+
+def fit_tracks(tracks, restarts=8, seed=0, processes=None, chains_per_task=None, **options):
+    # Fit an A matrix to every prepared track with independent annealing restarts run
+    # on a process pool of the given size (None uses every core, 1 runs in this
+    # process). Restart r of track t is seeded with (seed, t, r), so results do not
+    # depend on the pool or chunking. options override the annealing schedule.
+    # Returns one dict per track with the best 'A' and 'error' and the final
+    # 'restart_A' (restarts, 2, 2) and 'restart_errors' of every restart.
+    if processes == 1:
+        n_workers = 1
+    else:
+        n_workers = processes or os.cpu_count() or 1
+    if chains_per_task is None:
+        chains_per_task = min(restarts, max(1, math.ceil(len(tracks) * restarts / n_workers)))
+    tasks = [(index, start, track, [(seed, index, r) for r in range(start, min(start + chains_per_task, restarts))],
+              options)
+             for index, track in enumerate(tracks)
+             for start in range(0, restarts, chains_per_task)]
+
+    restart_A = np.empty((len(tracks), restarts, 2, 2))
+    restart_errors = np.empty((len(tracks), restarts))
+
+    def collect(results):
+        for index, start, A, errors in results:
+            restart_A[index, start:start + len(A)] = A
+            restart_errors[index, start:start + len(A)] = errors
+
+    if n_workers == 1 or len(tasks) == 1:
+        collect(map(_anneal_task, tasks))
+    else:
+        with multiprocessing.Pool(processes) as pool:
+            collect(pool.imap_unordered(_anneal_task, tasks))
+
+    results = []
+    for index in range(len(tracks)):
+        best = np.argmin(restart_errors[index])
+        results.append({
+            'A': restart_A[index, best],
+            'error': restart_errors[index, best],
+            'restart_A': restart_A[index],
+            'restart_errors': restart_errors[index]
+        })
+    return results
+
+def fit_track(track, restarts=8, seed=0, processes=None, **options):
+    # fit_tracks for one track, spreading its restarts over the pool
+    return fit_tracks([track], restarts, seed, processes, **options)[0]
+
+if __name__ == '__main__':
+    import MagneticModel as magmod
+
+    parser = argparse.ArgumentParser(description="Fit an A matrix to every .si track in a directory")
+    parser.add_argument('tracks', help="directory of .si track files")
+    parser.add_argument('--goal', type=float, nargs=2, default=(17.7, 56.3), metavar=('LAT', 'LON'))
+    parser.add_argument('--restarts', type=int, default=8)
+    parser.add_argument('--seed', type=int, default=0)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default='magmodel_cache')
+    parser.add_argument('--output', default='amatrix_fits.csv')
+    args = parser.parse_args()
+
+    magmodel = magmod.MagneticModel(None, cache_dir=args.cache_dir)
+    paths = sorted(glob.glob(os.path.join(args.tracks, '*.si')))
+    tracks = [track_from_dataframe(read_track(path), magmodel, *args.goal) for path in paths]
+    fits = fit_tracks(tracks, args.restarts, args.seed, args.processes)
+    pd.DataFrame({
+        'track': [os.path.splitext(os.path.basename(path))[0] for path in paths],
+        'steps': [len(track['bearing']) for track in tracks],
+        'a': [fit['A'][0, 0] for fit in fits],
+        'b': [fit['A'][0, 1] for fit in fits],
+        'c': [fit['A'][1, 0] for fit in fits],
+        'd': [fit['A'][1, 1] for fit in fits],
+        'error': [fit['error'] for fit in fits]
+    }).to_csv(args.output, index=False)
+    print(f"fitted {len(paths)} tracks, written to {args.output}")
@@ -0,0 +1,251 @@
+import math
+import numpy as np
+
+# Levels of halving below the base grid, and how much the intensity (µT) and
+# inclination (degrees) gradients may change across a cell, times its half diagonal,
+# before the cell is split
+MAX_LEVEL = 4
+F_TOLERANCE = 0.02
+I_TOLERANCE = 0.02
+
+# Whole globe, as (lat_min, lat_max, lon_min, lon_max)
+GLOBAL_REGION = (-90.0, 90.0, -180.0, 180.0)
+
+class QuadtreeGrid:
+    # Adaptively refined sample grid: cells of a base grid at base_resolution over
+    # region are split into quarters, up to max_level times, wherever the gradients of
+    # F or I change quickly across them. The field is evaluated exactly at the corners
+    # of every leaf cell and interpolated bilinearly inside it; corners that lie on
+    # the edge of a larger neighbouring leaf take that edge's interpolated value
+    # instead, so lookups stay continuous across levels. The gradients of each leaf
+    # are those at its centre. Cells are addressed by integer (row, column)
+    # coordinates on the lattice of the finest level, counted from the south-west
+    # corner of the region.
+    def __init__(self, magmodel, region=None, base_resolution=1.0, max_level=MAX_LEVEL,
+                 f_tolerance=F_TOLERANCE, i_tolerance=I_TOLERANCE, decimal_year=None):
+        self.magmodel = magmodel
+        self.region = tuple(float(v) for v in (region if region is not None else GLOBAL_REGION))
+        self.base_resolution = float(base_resolution)
+        self.max_level = int(max_level)
+        self.options = {'max_level': max_level, 'f_tolerance': f_tolerance, 'i_tolerance': i_tolerance}
+        self.decimal_year = magmodel.decimal_year if decimal_year is None else decimal_year
+
+        lat_min, lat_max, lon_min, lon_max = self.region
+        self.lat0, self.lon0 = lat_min, lon_min
+        self.fine_resolution = self.base_resolution / 2 ** self.max_level
+        # The base grid covers the region with whole cells, overhanging it if need be
+        self.base_rows = max(1, math.ceil((lat_max - lat_min) / self.base_resolution - 1e-9))
+        self.base_cols = max(1, math.ceil((lon_max - lon_min) / self.base_resolution - 1e-9))
+        self.periodic = abs(self.base_cols * self.base_resolution - 360) < 1e-9
+        self.rows = self.base_rows << self.max_level
+        self.cols = self.base_cols << self.max_level
+
+        self.build(f_tolerance, i_tolerance)
+
+    def node_coordinates(self, r, c):
+        # Latitude and longitude of lattice nodes (latitudes stop at the pole)
+        return (np.minimum(self.lat0 + r * self.fine_resolution, 90.0),
+                self.lon0 + c * self.fine_resolution)
+
+    def evaluate_nodes(self, r, c, gradients=False):
+        # evaluate_many at lattice nodes, each distinct node once
+        codes, inverse = np.unique(r * (self.cols + 1) + c, return_inverse=True)
+        lat, lon = self.node_coordinates(codes // (self.cols + 1), codes % (self.cols + 1))
+        return self.magmodel.evaluate_many(lat, lon, self.decimal_year, gradients=gradients)[inverse.reshape(r.shape)]
+
+    def build(self, f_tolerance, i_tolerance):
+        # Refine level by level, vectorized over every candidate cell of a level
+        level_cells = []
+        i, j = (a.ravel() for a in np.meshgrid(np.arange(self.base_rows), np.arange(self.base_cols), indexing='ij'))
+        for level in range(self.max_level + 1):
+            size = 1 << (self.max_level - level)
+            if level == self.max_level or len(i) == 0:
+                level_cells.append((level, i, j))
+                continue
+            # Corners and centre of each cell; the gradient change from the centre to
+            # the farthest corner, times the half diagonal, bounds how far the field
+            # departs from linear across the cell
+            r0, c0 = i * size, j * size
+            r = np.stack([r0, r0, r0 + size, r0 + size, r0 + size // 2])
+            c = np.stack([c0, c0 + size, c0, c0 + size, c0 + size // 2])
+            field = self.evaluate_nodes(r, c, gradients=True)
+            half_diagonal = size * self.fine_resolution / math.sqrt(2)
+            change = lambda x, y: np.max(np.hypot(field[x][:4] - field[x][4], field[y][:4] - field[y][4]), axis=0)
+            split = ((change('dFdx', 'dFdy') * half_diagonal > f_tolerance)
+                     | (change('dIdx', 'dIdy') * half_diagonal > i_tolerance))
+            level_cells.append((level, i[~split], j[~split]))
+            i = (2 * i[split][:, None] + np.array([0, 0, 1, 1])).ravel()
+            j = (2 * j[split][:, None] + np.array([0, 1, 0, 1])).ravel()
+
+        self.levels = np.concatenate([np.full(len(i), level) for level, i, _ in level_cells])
+        self.cell_rows = np.concatenate([i for _, i, _ in level_cells])
+        self.cell_cols = np.concatenate([j for _, _, j in level_cells])
+        # Per level, the sorted cell codes (row * columns at that level + column) and
+        # the leaf each belongs to, for locate
+        self.level_index = []
+        start = 0
+        for level, i, j in level_cells:
+            codes = i * (self.base_cols << level) + j
+            order = np.argsort(codes)
+            self.level_index.append((codes[order], start + order))
+            start += len(i)
+        self._leaf_lookup = None
+
+        size = 1 << (self.max_level - self.levels)
+        r0, c0 = self.cell_rows * size, self.cell_cols * size
+        self.bounds = np.stack([self.node_coordinates(r0, c0)[0], self.node_coordinates(r0 + size, c0)[0],
+                                self.node_coordinates(r0, c0)[1], self.node_coordinates(r0, c0 + size)[1]], axis=1)
+        # Corners of each leaf (south-west, south-east, north-west, north-east) as
+        # indices into the distinct lattice nodes
+        r = np.stack([r0, r0, r0 + size, r0 + size], axis=1)
+        c = np.stack([c0, c0 + size, c0, c0 + size], axis=1)
+        if self.periodic:
+            c = c % self.cols
+        codes, leaf_nodes = np.unique(r * (self.cols + 1) + c, return_inverse=True)
+        self.leaf_nodes = leaf_nodes.reshape(r.shape)
+        self.node_rows, self.node_cols = codes // (self.cols + 1), codes % (self.cols + 1)
+        lat, lon = self.node_coordinates(self.node_rows, self.node_cols)
+        nodes = self.magmodel.evaluate_many(lat, lon, self.decimal_year)
+        # Declination is interpolated through its cosine and sine, as in lookup_field
+        D = np.radians(nodes['D'])
+        self.node_values = np.stack([np.cos(D), np.sin(D), nodes['I'], nodes['F']], axis=-1)
+        self.conform_nodes()
+        self.tables = self.node_values[self.leaf_nodes]  # (n, 4 corners, 4 values)
+        lat, lon = (self.bounds[:, 0] + self.bounds[:, 1]) / 2, (self.bounds[:, 2] + self.bounds[:, 3]) / 2
+        centre = self.magmodel.evaluate_many(lat, lon, self.decimal_year, gradients=True)
+        self.gradients = {
+            'I_INCL': np.stack([centre['dIdx'], centre['dIdy']]),
+            'F_TOTAL': np.stack([centre['dFdx'], centre['dFdy']])
+        }
+        self.orthogonality = self.magmodel.angle_from_u_to_v(self.gradients['I_INCL'], self.gradients['F_TOTAL'])
+
+    def conform_nodes(self):
+        # Replace each node lying inside an edge of a larger leaf by the linear
+        # interpolation along that edge (the largest such leaf when there are several).
+        # Corners of a leaf can only hang on coarser leaves, so going from the coarsest
+        # level down every edge's ends are final before they are used.
+        n_nodes = len(self.node_values)
+        owner = np.full(n_nodes, -1, dtype=np.int64)
+        owner_size = np.zeros(n_nodes, dtype=np.int64)
+        for dr, dc in ((-1, -1), (-1, 0), (0, -1), (0, 0)):
+            # The leaf containing each of the four lattice cells around the node
+            r, c = self.node_rows + dr, self.node_cols + dc
+            if self.periodic:
+                c = c % self.cols
+            valid = np.flatnonzero((r >= 0) & (r < self.rows) & (c >= 0) & (c < self.cols))
+            leaf = self.locate_cells(r[valid], c[valid])
+            size = 1 << (self.max_level - self.levels[leaf])
+            rr = self.node_rows[valid] - self.cell_rows[leaf] * size
+            cc = self.node_cols[valid] - self.cell_cols[leaf] * size
+            if self.periodic:
+                cc = cc % self.cols
+            hanging = ((((rr == 0) | (rr == size)) & (cc > 0) & (cc < size))
+                       | (((cc == 0) | (cc == size)) & (rr > 0) & (rr < size)))
+            better = hanging & (size > owner_size[valid])
+            owner[valid[better]] = leaf[better]
+            owner_size[valid[better]] = size[better]
+
+        for level in range(self.max_level + 1):
+            nodes = np.flatnonzero(owner >= 0)
+            nodes = nodes[self.levels[owner[nodes]] == level]
+            if len(nodes) == 0:
+                continue
+            leaf, size = owner[nodes], owner_size[nodes]
+            rr = self.node_rows[nodes] - self.cell_rows[leaf] * size
+            cc = self.node_cols[nodes] - self.cell_cols[leaf] * size
+            if self.periodic:
+                cc = cc % self.cols
+            corners = self.leaf_nodes[leaf]
+            # Along the south or north edge the position runs with the column,
+            # along the west or east edge with the row
+            horizontal = (rr == 0) | (rr == size)
+            t = np.where(horizontal, cc, rr) / size
+            a = np.where(horizontal, np.where(rr == 0, corners[:, 0], corners[:, 2]),
+                         np.where(cc == 0, corners[:, 0], corners[:, 1]))
+            b = np.where(horizontal, np.where(rr == 0, corners[:, 1], corners[:, 3]),
+                         np.where(cc == 0, corners[:, 2], corners[:, 3]))
+            self.node_values[nodes] = (1 - t[:, None]) * self.node_values[a] + t[:, None] * self.node_values[b]
+
+    def __len__(self):
+        return len(self.levels)
+
+    def lattice(self, lat, lon):
+        # Fractional finest-lattice coordinates of points, longitudes wrapped onto a
+        # global grid
+        fy = (np.asarray(lat, dtype=float) - self.lat0) / self.fine_resolution
+        lon = np.asarray(lon, dtype=float)
+        if self.periodic:
+            lon = np.mod(lon - self.lon0, 360) + self.lon0
+        return fy, (lon - self.lon0) / self.fine_resolution
+
+    def contains(self, lat, lon):
+        # Whether points lie inside the refined grid
+        fy, fx = self.lattice(lat, lon)
+        return (fy >= 0) & (fy <= self.rows) & (fx >= 0) & (fx <= self.cols)
+
+    def locate(self, lat, lon):
+        # Leaf index of the cell containing each point (points outside go to the
+        # nearest edge cell), searching the levels from the coarsest
+        fy, fx = self.lattice(lat, lon)
+        return self.locate_cells(np.clip(np.floor(fy), 0, self.rows - 1).astype(np.int64),
+                                 np.clip(np.floor(fx), 0, self.cols - 1).astype(np.int64))
+
+    def locate_cells(self, r, c):
+        # Leaf index containing each finest-lattice cell (r, c)
+        leaf = np.full(r.shape, -1, dtype=np.int64)
+        for level, (codes, leaves) in enumerate(self.level_index):
+            open_points = np.flatnonzero(leaf < 0)
+            if len(open_points) == 0 or len(codes) == 0:
+                continue
+            shift = self.max_level - level
+            code = (r[open_points] >> shift) * (self.base_cols << level) + (c[open_points] >> shift)
+            k = np.minimum(np.searchsorted(codes, code), len(codes) - 1)
+            found = codes[k] == code
+            leaf[open_points[found]] = leaves[k[found]]
+        return leaf
+
+    def interpolate(self, lat, lon):
+        # Bilinear interpolation of cos D, sin D, I and F within each point's leaf;
+        # returns (len(lat), 4)
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+        lat, lon = lat.ravel(), lon.ravel()
+        leaf = self.locate(lat, lon)
+        fy, fx = self.lattice(lat, lon)
+        size = 1 << (self.max_level - self.levels[leaf])
+        ty = np.clip((fy - self.cell_rows[leaf] * size) / size, 0, 1)[:, None]
+        tx = np.clip((fx - self.cell_cols[leaf] * size) / size, 0, 1)[:, None]
+        v = self.tables[leaf]
+        return (1 - ty) * ((1 - tx) * v[:, 0] + tx * v[:, 1]) + ty * ((1 - tx) * v[:, 2] + tx * v[:, 3])
+
+    def interpolate_point(self, lat, lon):
+        # Scalar interpolate in plain Python arithmetic, as MagneticModel.interpolate_point
+        if self._leaf_lookup is None:
+            self._leaf_lookup = {(int(l), int(i), int(j)): k for k, (l, i, j)
+                                 in enumerate(zip(self.levels, self.cell_rows, self.cell_cols))}
+        if self.periodic:
+            lon = (lon - self.lon0) % 360 + self.lon0
+        fy = (lat - self.lat0) / self.fine_resolution
+        fx = (lon - self.lon0) / self.fine_resolution
+        r = min(max(math.floor(fy), 0), self.rows - 1)
+        c = min(max(math.floor(fx), 0), self.cols - 1)
+        for level in range(self.max_level + 1):
+            shift = self.max_level - level
+            leaf = self._leaf_lookup.get((level, r >> shift, c >> shift))
+            if leaf is not None:
+                break
+        size = 1 << (self.max_level - level)
+        ty = min(max((fy - (r >> shift) * size) / size, 0.0), 1.0)
+        tx = min(max((fx - (c >> shift) * size) / size, 0.0), 1.0)
+        v00, v01, v10, v11 = self.tables[leaf].tolist()
+        return [(1 - ty) * ((1 - tx) * a + tx * b) + ty * ((1 - tx) * p + tx * q)
+                for a, b, p, q in zip(v00, v01, v10, v11)]
+
+    def cell_polygons(self):
+        # Corners of every leaf as (n, 4, 2) longitude, latitude pairs, for plotting
+        lat_s, lat_n, lon_w, lon_e = self.bounds.T
+        return np.stack([np.stack([lon_w, lat_s], -1), np.stack([lon_e, lat_s], -1),
+                         np.stack([lon_e, lat_n], -1), np.stack([lon_w, lat_n], -1)], axis=1)
+
+    def level_counts(self):
+        # Number of leaves at each level, coarsest first
+        return np.bincount(self.levels, minlength=self.max_level + 1)
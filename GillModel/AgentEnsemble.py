@@ -0,0 +1,180 @@
+import numpy as np
+from Agent import stepping_lookup, warn_unconverged
+
+# Why each agent of an ensemble stopped moving
+RUNNING = 0
+CONVERGED = 1  # speed fell below max_speed / 100, as in Agent.Run
+CROSSED_POLE = 2  # the next step would have crossed |lat| = 90
+MAX_STEPS = 3
+ARRIVED = 4  # came within arrival_radius of the goal (only with stop_on_arrival)
+TERMINATION_REASONS = ('running', 'converged', 'crossed pole', 'max steps', 'arrived')
+
+EARTH_RADIUS_KM = 6371.0
+
+def great_circle_km(lat1, lon1, lat2, lon2):
+    # Haversine distance in km between (arrays of) points given in degrees
+    lat1, lon1, lat2, lon2 = (np.radians(v) for v in (lat1, lon1, lat2, lon2))
+    h = np.sin((lat2 - lat1) / 2) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(h, 0, 1)))
+
+class AgentEnsemble:
+    # Many Agents advanced together as arrays. Every agent has its own start, goal,
+    # A matrix and use_magnetic_north flag, follows the same forward Euler rule as
+    # Agent.Run, and stops on its own when it converges or would cross a pole.
+    def __init__(self, magmodel, starts, goals, A=np.eye(2), use_magnetic_north=False, field_lookup=None,
+                 verbose=False):
+        # starts and goals are (lat, lon) pairs shaped (n, 2) (a single goal is shared);
+        # A is one 2x2 matrix or one per agent; field_lookup selects the magmodel
+        # backend as for Agent (None uses magmodel.field_lookup; Run warns when agents
+        # stepped on a piecewise linear backend reach max_steps)
+        self.magmodel = magmodel
+        self.verbose = verbose
+        self.field_lookup = field_lookup
+        self.max_speed = 1 / 10
+        self.time_step = 1
+
+        starts = np.atleast_2d(np.asarray(starts, dtype=float))
+        self.n_agents = len(starts)
+        self.A = np.array(np.broadcast_to(np.asarray(A, dtype=float), (self.n_agents, 2, 2)))
+        self.use_magnetic_north = np.array(np.broadcast_to(np.asarray(use_magnetic_north, dtype=bool), (self.n_agents,)))
+        self.SetGoals(goals)
+        self.SetStarts(starts)
+
+        self.trajectory_lat = None
+        self.trajectory_lon = None
+        self.lengths = None
+        self.steps = None
+        self.status = None
+        self.end_lat = None
+        self.end_lon = None
+        self.arrival_steps = None
+
+    def EvaluateField(self, lat, lon):
+        # Declination, inclination and intensity arrays from the selected backend
+        return self.magmodel.lookup_field(lat, lon, self.field_lookup)
+
+    def SetStarts(self, starts):
+        starts = np.array(np.broadcast_to(np.asarray(starts, dtype=float), (self.n_agents, 2)))
+        self.start_lat = starts[:, 0]
+        self.start_lon = starts[:, 1]
+        self.start_D_DECL, self.start_I_INCL, self.start_F_TOTAL = (
+            np.asarray(v, dtype=float) for v in self.EvaluateField(self.start_lat, self.start_lon))
+
+    def SetGoals(self, goals):
+        goals = np.array(np.broadcast_to(np.asarray(goals, dtype=float), (self.n_agents, 2)))
+        self.goal_lat = goals[:, 0]
+        self.goal_lon = goals[:, 1]
+        self.goal_D_DECL, self.goal_I_INCL, self.goal_F_TOTAL = (
+            np.asarray(v, dtype=float) for v in self.EvaluateField(self.goal_lat, self.goal_lon))
+
+    def ComputeVelocities(self, agents, D_DECL, I_INCL, F_TOTAL):
+        # Velocities (dlon, dlat) of the given agents at the given field values: the
+        # Agent.ComputeVelocity rule applied row by row
+        error = np.stack([self.goal_F_TOTAL[agents] - F_TOTAL, self.goal_I_INCL[agents] - I_INCL], axis=1)
+        velocity = np.einsum('nij,nj->ni', self.A[agents], error)
+
+        rotate = self.use_magnetic_north[agents]
+        if np.any(rotate):
+            D = np.radians(-D_DECL[rotate])
+            cosD, sinD = np.cos(D), np.sin(D)
+            vx, vy = velocity[rotate, 0], velocity[rotate, 1]
+            velocity[rotate] = np.stack([cosD * vx - sinD * vy, sinD * vx + cosD * vy], axis=1)
+
+        speed = np.hypot(velocity[:, 0], velocity[:, 1])
+        too_fast = speed > self.max_speed
+        velocity[too_fast] *= (self.max_speed / speed[too_fast])[:, None]
+        return velocity, np.where(too_fast, self.max_speed, speed)
+
+    def Run(self, max_steps=10000, record=True, arrival_radius=None, stop_on_arrival=False):
+        # Integrate every agent until it stops or max_steps is reached. With record,
+        # trajectory_lat/lon hold NaN-padded (n_agents, max length) positions and
+        # lengths the number of valid points per agent; end_lat/lon, steps and status
+        # (see TERMINATION_REASONS) are always filled.
+        # With arrival_radius (km), arrival_steps holds the first step at which each
+        # agent was within that distance of its goal (-1 if never); stop_on_arrival
+        # also stops agents there, with status ARRIVED.
+        n = self.n_agents
+        lat = self.start_lat.copy()
+        lon = self.start_lon.copy()
+        D = self.start_D_DECL.copy()
+        I = self.start_I_INCL.copy()
+        F = self.start_F_TOTAL.copy()
+        self.steps = np.zeros(n, dtype=int)
+        self.status = np.full(n, RUNNING, dtype=np.int8)
+        velocity_threshold = self.max_speed / 100
+
+        if record:
+            capacity = min(max_steps, 255) + 1
+            history_lat = np.full((n, capacity), np.nan)
+            history_lon = np.full((n, capacity), np.nan)
+            history_lat[:, 0] = lat
+            history_lon[:, 0] = lon
+
+        active = np.arange(n)
+        if arrival_radius is not None:
+            self.arrival_steps = np.full(n, -1, dtype=int)
+            active = self.CheckArrivals(active, 0, lat, lon, arrival_radius, stop_on_arrival)
+        else:
+            self.arrival_steps = None
+
+        for step in range(max_steps):
+            if active.size == 0:
+                break
+            velocity, speed = self.ComputeVelocities(active, D[active], I[active], F[active])
+            new_lon = lon[active] + velocity[:, 0] * self.time_step
+            new_lat = lat[active] + velocity[:, 1] * self.time_step
+
+            converged = speed < velocity_threshold
+            polar = ~converged & (np.abs(new_lat) > 90)
+            self.status[active[converged]] = CONVERGED
+            self.status[active[polar]] = CROSSED_POLE
+            moving = ~(converged | polar)
+            active = active[moving]
+            lat[active] = new_lat[moving]
+            lon[active] = new_lon[moving]
+            self.steps[active] += 1
+
+            if record:
+                if step + 1 >= capacity:
+                    grow = min(capacity, max_steps + 1 - capacity)
+                    history_lat = np.concatenate([history_lat, np.full((n, grow), np.nan)], axis=1)
+                    history_lon = np.concatenate([history_lon, np.full((n, grow), np.nan)], axis=1)
+                    capacity += grow
+                history_lat[active, step + 1] = lat[active]
+                history_lon[active, step + 1] = lon[active]
+
+            if arrival_radius is not None:
+                active = self.CheckArrivals(active, step + 1, lat, lon, arrival_radius, stop_on_arrival)
+            if active.size:
+                D[active], I[active], F[active] = self.EvaluateField(lat[active], lon[active])
+
+        self.status[active] = MAX_STEPS
+        if active.size and not stop_on_arrival:
+            warn_unconverged(stepping_lookup(self.magmodel, self.field_lookup), active.size)
+        if self.verbose and np.any(self.status == CROSSED_POLE):
+            print(f"aborted {np.count_nonzero(self.status == CROSSED_POLE)} agents: crossed polar singularity")
+
+        self.end_lat = lat
+        self.end_lon = lon
+        self.lengths = self.steps + 1
+        if record:
+            length = self.lengths.max()
+            self.trajectory_lat = history_lat[:, :length]
+            self.trajectory_lon = history_lon[:, :length]
+
+    def CheckArrivals(self, active, step, lat, lon, arrival_radius, stop_on_arrival):
+        # Mark active agents within arrival_radius km of their goal for the first time
+        # as arrived at step; returns the agents still moving
+        waiting = active[self.arrival_steps[active] < 0]
+        distance = great_circle_km(lat[waiting], lon[waiting], self.goal_lat[waiting], self.goal_lon[waiting])
+        arrived = waiting[distance <= arrival_radius]
+        self.arrival_steps[arrived] = step
+        if not stop_on_arrival or arrived.size == 0:
+            return active
+        self.status[arrived] = ARRIVED
+        return active[self.arrival_steps[active] < 0]
+
+    def GetTraj(self, i):
+        # Trajectory of agent i as lists, like Agent.GetTraj
+        length = self.lengths[i]
+        return self.trajectory_lat[i, :length].tolist(), self.trajectory_lon[i, :length].tolist()
@@ -1,7 +1,28 @@
 import numpy as np
 #from joblib import Parallel, delayed
-import matplotlib.pyplot as plt
-from mpl_toolkits.basemap import Basemap
+# matplotlib and Basemap are imported by the methods that draw, so computing
+# stability maps does not load them
+import Stability as stability
+import Instrumentation
+
+# Projected sample meshes by (projection, region, latitude axis, longitude axis),
+# shared by every map in this process. Each map builds its own Basemap: a Basemap
+# keeps the limb and boundary artists it drew, which cannot move to another figure.
+_projected_meshes = {}
+
+def axis_key(values):
+    return (float(values[0]), float(values[-1]), len(values))
+
+def new_basemap(projection, region=None):
+    # Basemap of a global map, or a map cropped to region
+    from mpl_toolkits.basemap import Basemap
+    with Instrumentation.phase('AxesmMagneticMap.initialize_axes/basemap'):
+        if region is None:
+            return Basemap(projection=projection, lon_0=0)
+        lat_min, lat_max, lon_min, lon_max = region
+        return Basemap(projection=projection, llcrnrlat=lat_min, urcrnrlat=lat_max,
+                       llcrnrlon=lon_min, urcrnrlon=lon_max, lon_0=(lon_min + lon_max) / 2)
+
 class AxesmMagneticMap:
     def __init__(self, magmod):
         self.projection = 'robin'
@@ -10,6 +31,9 @@ class AxesmMagneticMap:
         self.lat_mesh = None
         self.lon_mesh = None
         self.stability = None
+        self.stability_A = None
+        self.stability_grid = None  # (grid_version, decimal_year) of the model when classified
+        self.basin = None
         self.surface_mesh = None
         self.surface_mesh_type = None
         self.vector_field = None
@@ -31,32 +55,85 @@ class AxesmMagneticMap:
                 'position': 'y'
             }
         }
+        self.fig = None
         self.ax = None
+        self.base_artists = set()
+        self.headless = False
+        self.animation = None
 
-    def initialize_axes(self, projection='robin', surfmesh="stability"):
+    @Instrumentation.timed()
+    def initialize_axes(self, projection=None, surfmesh="stability", headless=False, figsize=(8, 6)):
+        # projection defaults to a global Robinson map, or a Mercator map cropped to the
+        # model's region for regional models. headless draws on a plain Agg figure,
+        # without pyplot, for saving to files (see save and MapRenderer).
+        region = getattr(self.magmodel, 'region', None)
+        if projection is None:
+            projection = 'robin' if region is None else 'merc'
         self.projection = projection
-        
-        fig, self.ax = plt.subplots(figsize=(8, 6))
+        self.headless = headless
+        if headless:
+            from matplotlib.figure import Figure
+            from matplotlib.backends.backend_agg import FigureCanvasAgg
+            self.fig = Figure(figsize=figsize)
+            FigureCanvasAgg(self.fig)
+            self.ax = self.fig.add_subplot()
+        else:
+            import matplotlib.pyplot as plt
+            self.fig, self.ax = plt.subplots(figsize=figsize)
         self.ax.set_facecolor('k')
         
-        # Initialize Basemap
-        self.m = Basemap(projection=self.projection, lon_0=0, ax=self.ax)
-        self.m.drawcoastlines(color='w', linewidth=1)
-        self.m.drawcountries(color='w', linewidth=0.5)
+        # Initialize Basemap; every drawing call names self.ax, so figures made
+        # elsewhere with pyplot do not pick up this map's artists
+        self.m = new_basemap(self.projection, region)
+        with Instrumentation.phase('AxesmMagneticMap.initialize_axes/coastlines'):
+            self.m.drawcoastlines(color='w', linewidth=1, ax=self.ax)
+            self.m.drawcountries(color='w', linewidth=0.5, ax=self.ax)
         
         # Colors for land and ocean
-        self.m.drawmapboundary(fill_color=self.colors['surface_mesh']['terrain']['ocean'])
+        self.m.drawmapboundary(fill_color=self.colors['surface_mesh']['terrain']['ocean'], ax=self.ax)
         #self.m.fillcontinents(color=self.colors['surface_mesh']['terrain']['land'], lake_color=self.colors['surface_mesh']['terrain']['ocean'])
         
-        self.lon_mesh, self.lat_mesh = np.meshgrid(np.linspace(-90, 90, self.magmodel.lon_mesh_size), np.linspace(-180, 180, self.magmodel.lat_mesh_size))
+        self.lon_mesh, self.lat_mesh = np.meshgrid(self.magmodel.sample_longitudes, self.magmodel.sample_latitudes)
+        # Everything drawn from here on is cleared by clear_overlays
+        self.base_artists = set(self.ax.get_children())
 
         self.set_surface_mesh(surfmesh)
         self.set_vector_field("none")
 
+    def projected_mesh(self, latitudes, longitudes):
+        # Map coordinates (x, y) of the mesh of the given axes, projected once per
+        # projection and grid
+        key = (self.projection, getattr(self.magmodel, 'region', None), axis_key(latitudes), axis_key(longitudes))
+        if key not in _projected_meshes:
+            lon, lat = np.meshgrid(longitudes, latitudes)
+            _projected_meshes[key] = self.m(lon, lat)
+        return _projected_meshes[key]
+
+    def clear_overlays(self):
+        # Remove everything drawn since initialize_axes (meshes, vector fields, agents,
+        # legend), keeping the projection, coastlines and map boundary for the next
+        # figure
+        self.clear_animation()
+        for artist in self.ax.get_children():
+            if artist not in self.base_artists:
+                try:
+                    artist.remove()
+                except NotImplementedError:
+                    pass
+
+    @Instrumentation.timed()
+    def save(self, path, dpi=100, legend=True):
+        # Write the figure to path, format from its extension (.png, .svg, .pdf)
+        if legend and self.ax.get_legend_handles_labels()[0]:
+            self.ax.legend()
+        self.fig.savefig(path, dpi=dpi)
+
     def set_surface_mesh(self, surface_mesh_type):
         self.surface_mesh_type = surface_mesh_type
         if self.surface_mesh_type == "stability":
             self.draw_stability_mesh()
+        elif self.surface_mesh_type == "basin" and self.basin is not None:
+            self.draw_basin_mesh(self.basin)
 
     def set_vector_field(self, vector_field_type, downsample_factor=5, gradients_scale=0.5):
         self.vector_field_type = vector_field_type
@@ -66,72 +143,228 @@ class AxesmMagneticMap:
             self.draw_flow_vector_field_plot()
         elif self.vector_field_type == "gradients":
             self.draw_if_gradients()
+    @Instrumentation.timed()
     def calculate_stability(self,a):
-        lat = self.magmodel.sample_latitudes
-        lon = self.magmodel.sample_longitudes
-        dF = self.magmodel.sample_gradients['F_TOTAL']
-        dI = self.magmodel.sample_gradients['I_INCL']
-        D = self.magmodel.samples['D_DECL']
-        def compute_stability(i, j):
-            Jg = -a.dot(np.array([dF[:,i, j], dI[:,i, j]]))
-            ev,_=np.linalg.eig(Jg)
-            evreal = np.real(ev)
-            evimag = np.imag(ev)
-            is_unstable = evreal[0] > 1e-12 or evreal[1] > 1e-12
-            is_degenerate = abs(evreal[0]) < 1e-12 or abs(evreal[1]) < 1e-12
-            has_rotation = evimag[0] != 0 or evimag[1] != 0
-
-            if is_unstable:
-                if has_rotation:
-                    return 0.75  # Spiral source (light green)
-                else:
-                    return 1  # Unstable node (yellow)
-            else:
-                if is_degenerate:
-                    return 0.5  # Neutrally stable
-                else:
-                    if has_rotation:
-                        return 0.25  # Spiral sink (medium green)
-                    else:
-                        return 0  # Stable node (dark green)
-        stab=np.full((len(lat), len(lon)), np.nan)
-        for i in range(len(lat)):
-            for j in range(len(lon)):
-                stab[i,j]=compute_stability(i, j)
-        self.stability=stab
+        # Classify the whole grid in one array operation; a may also be a stack of
+        # A matrices shaped (k, 2, 2), giving one stability map per matrix. A refined
+        # model (see MagneticModel.refine_grid) is classified per quadtree leaf.
+        # The last map is reused while A and the model's grids and date are unchanged.
+        a = np.asarray(a)
+        grid = (self.magmodel.grid_version, self.magmodel.decimal_year)
+        if (self.stability is not None and self.stability_A is not None and np.array_equal(a, self.stability_A)
+                and grid == self.stability_grid):
+            return self.stability
+        quadtree = getattr(self.magmodel, 'quadtree', None)
+        gradients = self.magmodel.sample_gradients if quadtree is None else quadtree.gradients
+        dF = gradients['F_TOTAL']
+        dI = gradients['I_INCL']
+        self.stability = stability.classify_stability(a, dF, dI)
+        self.stability_A = a.copy()
+        # Read after the lookups above, which may have rebuilt the grids or quadtree
+        self.stability_grid = (self.magmodel.grid_version, self.magmodel.decimal_year)
+        return self.stability
 
+    @Instrumentation.timed()
     def draw_stability_mesh(self,AMatrix=np.array([[1, 0], [0, 1]])):
         self.calculate_stability(AMatrix)
-        lon, lat = np.meshgrid(np.linspace(-180, 180, self.magmodel.lon_mesh_size), np.linspace(-90, 90, self.magmodel.lat_mesh_size))
-        x, y = self.m(lon, lat)  # Ensure correct order for Basemap
-        self.m.contourf(x, y, self.stability, cmap='summer')
+        quadtree = getattr(self.magmodel, 'quadtree', None)
+        if quadtree is not None:
+            from matplotlib.collections import PolyCollection
+            # One projected polygon per leaf, coloured on the same scale as contourf
+            corners = quadtree.cell_polygons()
+            x, y = self.m(corners[..., 0], corners[..., 1])
+            cells = PolyCollection(np.stack([x, y], axis=-1), array=self.stability, cmap='summer',
+                                   edgecolors='face', linewidths=0.2)
+            cells.set_clim(0, 1)
+            self.ax.add_collection(cells)
+            return
+        x, y = self.projected_mesh(self.magmodel.sample_latitudes, self.magmodel.sample_longitudes)
+        self.surface_mesh = self.m.contourf(x, y, self.stability, cmap='summer', ax=self.ax)
 
+    @Instrumentation.timed()
+    def draw_basin_mesh(self, basin, quantity='arrival_time', cmap='viridis'):
+        # Surface mesh of a BasinMap.basin_map result: start cells that reach the goal
+        # coloured by quantity ('arrival_time', 'steps' or 'distance_km'), cells that
+        # never arrive left blank; quantity 'reached' draws the basin itself
+        self.basin = basin
+        x, y = self.projected_mesh(basin['latitudes'], basin['longitudes'])
+        reached = np.asarray(basin['reached'], dtype=bool)
+        if quantity == 'reached':
+            values = reached.astype(float)
+            cmap = 'summer'
+        else:
+            values = np.ma.masked_where(~reached, basin[quantity])
+        self.surface_mesh = self.m.pcolormesh(x, y, values, cmap=cmap, shading='nearest', ax=self.ax)
+        return self.surface_mesh
+
+    @Instrumentation.timed()
     def draw_flow_vector_field_plot(self):
         lon, lat = np.meshgrid(np.linspace(-180, 180, 50), np.linspace(-90, 90, 50))
         u = np.random.rand(50, 50) - 0.5
         v = np.random.rand(50, 50) - 0.5
         x, y = self.m(lon, lat)
-        self.m.quiver(x, y, u, v)
+        self.m.quiver(x, y, u, v, ax=self.ax)
 
+    @Instrumentation.timed()
     def draw_if_gradients(self):
         lon, lat = np.meshgrid(np.linspace(-180, 180, 50), np.linspace(-90, 90, 50))
         u = np.random.rand(50, 50) - 0.5
         v = np.random.rand(50, 50) - 0.5
         x, y = self.m(lon, lat)
-        self.m.quiver(x, y, u, v, color='gray')
+        self.m.quiver(x, y, u, v, color='gray', ax=self.ax)
 
+    @Instrumentation.timed()
     def update_agent_start(self, start_lat, start_lon):
         x, y = self.m(start_lon, start_lat)
         self.ax.plot(x, y, 'go', markersize=8, label='Start')
 
+    @Instrumentation.timed()
     def update_agent_goal(self, goal_lat, goal_lon):
         x, y = self.m(goal_lon, goal_lat)
         self.ax.plot(x, y, 'ro', markersize=8, label='Goal')
 
+    @Instrumentation.timed()
     def update_agent_trajectory(self, trajectory_lat, trajectory_lon):
         x, y = self.m(trajectory_lon, trajectory_lat)
         self.ax.plot(x, y, 'b-', label='Trajectory')
 
+    @Instrumentation.timed()
+    def update_track(self, track_lat, track_lon, label='Track'):
+        # An observed track, e.g. a turtle's satellite fixes
+        x, y = self.m(track_lon, track_lat)
+        self.ax.plot(x, y, '.-', color=self.colors['agent']['position'], markersize=3, linewidth=1, label=label)
+
+    def start_animation(self, n_agents=1):
+        # Blitted animation of n_agents trajectories: one line and one position marker
+        # per agent, changed in place with set_data and drawn over a cached image of
+        # everything else on the map (mesh, coastlines, start and goal markers), so a
+        # frame costs only the moving artists however detailed the map is. Feed
+        # positions with append_positions and show them with draw_frame, or let
+        # animate_agents / animate_ensemble do both.
+        self.clear_animation()
+        lines = [self.ax.plot([], [], '-', color=self.colors['agent']['trajectory'], animated=True)[0]
+                 for _ in range(n_agents)]
+        markers = [self.ax.plot([], [], 'o', color=self.colors['agent']['position'], markersize=5,
+                                animated=True)[0]
+                   for _ in range(n_agents)]
+        self.animation = {
+            'lines': lines,
+            'markers': markers,
+            # Projected positions so far, in buffers grown by doubling
+            'x': [np.empty(1024) for _ in range(n_agents)],
+            'y': [np.empty(1024) for _ in range(n_agents)],
+            'length': np.zeros(n_agents, dtype=int),
+            'background': None
+        }
+        canvas = self.fig.canvas
+        # A full redraw (first show, resize) invalidates the cached background
+        self.animation['draw_event'] = canvas.mpl_connect('draw_event', self._capture_background)
+        if not self.headless:
+            import matplotlib.pyplot as plt
+            plt.show(block=False)
+        canvas.draw()
+        canvas.flush_events()
+
+    def _capture_background(self, event=None):
+        canvas = self.fig.canvas
+        self.animation['background'] = canvas.copy_from_bbox(self.fig.bbox)
+        self.draw_animated_artists()
+
+    def draw_animated_artists(self):
+        for artist in self.animation['lines'] + self.animation['markers']:
+            self.ax.draw_artist(artist)
+
+    def append_positions(self, agent, lat, lon):
+        # Add positions (scalars or arrays) to the end of an agent's animated
+        # trajectory; only the new points are projected
+        x, y = self.m(np.atleast_1d(np.asarray(lon, dtype=float)), np.atleast_1d(np.asarray(lat, dtype=float)))
+        animation = self.animation
+        start = animation['length'][agent]
+        stop = start + len(x)
+        if stop > len(animation['x'][agent]):
+            size = max(stop, 2 * len(animation['x'][agent]))
+            for name in ('x', 'y'):
+                grown = np.empty(size)
+                grown[:start] = animation[name][agent][:start]
+                animation[name][agent] = grown
+        animation['x'][agent][start:stop] = x
+        animation['y'][agent][start:stop] = y
+        animation['length'][agent] = stop
+        animation['lines'][agent].set_data(animation['x'][agent][:stop], animation['y'][agent][:stop])
+        animation['markers'][agent].set_data(animation['x'][agent][stop - 1:stop], animation['y'][agent][stop - 1:stop])
+
+    def draw_frame(self):
+        # Restore the cached background, draw the animated artists over it and blit
+        canvas = self.fig.canvas
+        if self.animation['background'] is None:
+            canvas.draw()
+        else:
+            canvas.restore_region(self.animation['background'])
+            self.draw_animated_artists()
+            canvas.blit(self.fig.bbox)
+        canvas.flush_events()
+
+    def clear_animation(self):
+        # Remove the animated artists, e.g. before drawing finished trajectories
+        if self.animation is None:
+            return
+        self.fig.canvas.mpl_disconnect(self.animation['draw_event'])
+        for artist in self.animation['lines'] + self.animation['markers']:
+            artist.remove()
+        self.animation = None
+
+    @Instrumentation.timed()
+    def animate_agents(self, agents, steps_per_frame=10, max_steps=10000):
+        # Step Agents from their starts and animate them live, steps_per_frame Euler
+        # steps per frame, until each converges (as in Agent.Run), would cross a pole
+        # or has taken max_steps. Returns the number of frames drawn.
+        self.start_animation(len(agents))
+        moving = []
+        for i, turtle in enumerate(agents):
+            turtle.Reset()
+            self.append_positions(i, turtle.trajectory_lat, turtle.trajectory_lon)
+            moving.append(True)
+        self.draw_frame()
+        frames = 1
+        for _ in range(0, max_steps, steps_per_frame):
+            if not any(moving):
+                break
+            for i, turtle in enumerate(agents):
+                if not moving[i]:
+                    continue
+                before = len(turtle.trajectory_lat)
+                turtle.Step(steps_per_frame)
+                if len(turtle.trajectory_lat) == before:
+                    moving[i] = False  # the next step would cross a pole
+                    continue
+                self.append_positions(i, turtle.trajectory_lat[before:], turtle.trajectory_lon[before:])
+                last_step = np.hypot(turtle.trajectory_lat[-1] - turtle.trajectory_lat[-2],
+                                     turtle.trajectory_lon[-1] - turtle.trajectory_lon[-2])
+                if last_step < turtle.max_speed / 100 * turtle.time_step:
+                    moving[i] = False
+            self.draw_frame()
+            frames += 1
+        return frames
+
+    @Instrumentation.timed()
+    def animate_ensemble(self, ensemble, steps_per_frame=10):
+        # Replay the recorded trajectories of an AgentEnsemble run (record=True),
+        # steps_per_frame steps of every agent per frame. Returns the number of frames.
+        self.start_animation(ensemble.n_agents)
+        n_steps = ensemble.trajectory_lat.shape[1]
+        frames = 0
+        for start in range(0, n_steps, steps_per_frame):
+            stop = min(start + steps_per_frame, n_steps)
+            for i in range(ensemble.n_agents):
+                end = min(stop, ensemble.lengths[i])
+                if end > start:
+                    self.append_positions(i, ensemble.trajectory_lat[i, start:end], ensemble.trajectory_lon[i, start:end])
+            self.draw_frame()
+            frames += 1
+        return frames
+
+    @Instrumentation.timed()
     def show(self):
+        import matplotlib.pyplot as plt
         plt.legend()
         plt.show()
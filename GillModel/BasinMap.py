@@ -0,0 +1,156 @@
+import argparse
+import multiprocessing
+import numpy as np
+import AgentEnsemble as ensemble
+from SharedGrids import SharedGrids
+
+# Agents integrated together per task; small enough that slow batches (agents that
+# never settle) do not hold up the pool, large enough to amortize each field lookup
+BASIN_BATCH_AGENTS = 2048
+
+# Default distance (km) from the goal counted as arriving
+ARRIVAL_RADIUS_KM = 100.0
+
+_worker_state = None
+
+def basin_starts(magmodel, region=None, stride=1):
+    # Latitude and longitude axes of the sample grid cells (optionally a region and
+    # stride, see MagneticModel.sample_region) seeded with one agent each
+    rows, cols = magmodel.sample_region(region, stride)
+    return magmodel.sample_latitudes[rows], magmodel.sample_longitudes[cols]
+
+def _init_worker(magmodel, goal, A, options):
+    # magmodel may be a SharedGrids handle, attached here
+    global _worker_state
+    if isinstance(magmodel, SharedGrids):
+        magmodel = magmodel.attach()
+    _worker_state = (magmodel, goal, A, options)
+
+def _run_batch(args):
+    # Integrate the agents started at the given points; returns their outcome arrays
+    start, starts = args
+    magmodel, goal, A, options = _worker_state
+    agents = ensemble.AgentEnsemble(magmodel, starts, goal, A, options['use_magnetic_north'], options['field_lookup'])
+    agents.Run(options['max_steps'], record=False, arrival_radius=options['radius_km'],
+               stop_on_arrival=options['stop_on_arrival'])
+    return start, agents.end_lat, agents.end_lon, agents.steps, agents.status, agents.arrival_steps
+
+def basin_map(magmodel, goal, A=np.eye(2), region=None, stride=1, radius_km=ARRIVAL_RADIUS_KM,
+              max_steps=10000, stop_on_arrival=True, use_magnetic_north=False, field_lookup=None,
+              processes=None, batch_agents=BASIN_BATCH_AGENTS):
+    # Basin of attraction of goal = (lat, lon) under A: one agent is started at every
+    # sample grid cell (or those of region, every stride-th) and they are integrated
+    # together with AgentEnsemble, in batches on a process pool of the given size
+    # (None uses every core, 1 runs in this process). With stop_on_arrival agents stop
+    # the first time they come within radius_km of the goal; otherwise they run to
+    # convergence as in Agent.Run and only their final position counts.
+    # Returns a dict with the 'latitudes' and 'longitudes' axes and, shaped
+    # (len(latitudes), len(longitudes)):
+    #   'reached': the trajectory ended within radius_km of the goal
+    #   'end_lat', 'end_lon', 'distance_km': where it ended and how far from the goal
+    #   'arrival_steps', 'arrival_time': first step (and time) within radius_km of
+    #              the goal, -1 and NaN if never
+    #   'steps', 'status': steps taken and why the agent stopped (AgentEnsemble codes)
+    # field_lookup='bilinear' is over ten times faster than exact evaluation on
+    # global maps. It suits stop_on_arrival, but agents run to convergence on it may
+    # circle the goal until max_steps (see Agent.PIECEWISE_LINEAR_LOOKUPS).
+    latitudes, longitudes = basin_starts(magmodel, region, stride)
+    lat, lon = np.meshgrid(latitudes, longitudes, indexing='ij')
+    starts = np.stack([lat.ravel(), lon.ravel()], axis=1)
+    n = len(starts)
+    goal = np.asarray(goal, dtype=float)
+    A = np.asarray(A, dtype=float)
+    options = {'radius_km': radius_km, 'max_steps': max_steps, 'stop_on_arrival': stop_on_arrival,
+               'use_magnetic_north': use_magnetic_north, 'field_lookup': field_lookup}
+
+    tasks = [(start, starts[start:start + batch_agents]) for start in range(0, n, batch_agents)]
+    end_lat = np.empty(n)
+    end_lon = np.empty(n)
+    steps = np.empty(n, dtype=int)
+    status = np.empty(n, dtype=np.int8)
+    arrival_steps = np.empty(n, dtype=int)
+
+    def collect(results):
+        for start, *values in results:
+            stop = start + len(values[0])
+            for out, value in zip((end_lat, end_lon, steps, status, arrival_steps), values):
+                out[start:stop] = value
+
+    if processes == 1 or len(tasks) == 1:
+        _init_worker(magmodel, goal, A, options)
+        collect(map(_run_batch, tasks))
+    else:
+        # Workers attach to the model's grids in shared memory instead of copying them
+        with SharedGrids(magmodel) as shared:
+            with multiprocessing.Pool(processes, initializer=_init_worker,
+                                      initargs=(shared, goal, A, options)) as pool:
+                collect(pool.imap_unordered(_run_batch, tasks))
+
+    distance_km = ensemble.great_circle_km(end_lat, end_lon, goal[0], goal[1])
+    shape = lat.shape
+    result = {
+        'latitudes': latitudes,
+        'longitudes': longitudes,
+        'goal': goal,
+        'A': A,
+        'radius_km': radius_km,
+        'reached': (distance_km <= radius_km).reshape(shape),
+        'end_lat': end_lat.reshape(shape),
+        'end_lon': end_lon.reshape(shape),
+        'distance_km': distance_km.reshape(shape),
+        'arrival_steps': arrival_steps.reshape(shape),
+        'arrival_time': np.where(arrival_steps >= 0, arrival_steps.astype(float), np.nan).reshape(shape),
+        'steps': steps.reshape(shape),
+        'status': status.reshape(shape)
+    }
+    return result
+
+def save_basin(path, result, **extra):
+    # Write a basin map (plus any extra arrays) to a compressed .npz file
+    np.savez_compressed(path, termination_reasons=np.array(ensemble.TERMINATION_REASONS), **result, **extra)
+
+def load_basin(path):
+    # A basin map written by save_basin, as a dict of arrays
+    with np.load(path) as data:
+        return {key: data[key] for key in data.files}
+
+def print_summary(result):
+    # Print how many start cells reach the goal and why their agents stopped
+    reached = result['reached']
+    total = reached.size
+    print(f"{np.count_nonzero(reached)} of {total} start cells end within {float(result['radius_km']):g} km of the goal")
+    if np.any(reached):
+        times = result['arrival_time'][reached]
+        print(f"time to arrival: median {np.nanmedian(times):g}, max {np.nanmax(times):g}")
+    for code, reason in enumerate(ensemble.TERMINATION_REASONS):
+        count = np.count_nonzero(result['status'] == code)
+        if count:
+            print(f"{reason:>14}: {count} ({100 * count / total:.2f}%)")
+
+if __name__ == '__main__':
+    import MagneticModel as magmod
+
+    parser = argparse.ArgumentParser(description="Map which start cells of the sample grid reach a goal")
+    parser.add_argument('--goal', type=float, nargs=2, default=(17.7, 56.3), metavar=('LAT', 'LON'))
+    parser.add_argument('--A', type=float, nargs=4, default=(1, 0, 0, 1), metavar=('a', 'b', 'c', 'd'))
+    parser.add_argument('--region', type=float, nargs=4, default=None,
+                        metavar=('LAT_MIN', 'LAT_MAX', 'LON_MIN', 'LON_MAX'))
+    parser.add_argument('--stride', type=int, default=1)
+    parser.add_argument('--radius-km', type=float, default=ARRIVAL_RADIUS_KM)
+    parser.add_argument('--max-steps', type=int, default=10000)
+    parser.add_argument('--run-to-convergence', action='store_true',
+                        help="keep integrating agents after they arrive and judge their final position")
+    parser.add_argument('--magnetic-north', action='store_true')
+    parser.add_argument('--field-lookup', default=None, choices=magmod.FIELD_LOOKUPS)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default='magmodel_cache')
+    parser.add_argument('--output', default='basin_map.npz')
+    args = parser.parse_args()
+
+    magmodel = magmod.MagneticModel(None, cache_dir=args.cache_dir)
+    result = basin_map(magmodel, args.goal, np.reshape(args.A, (2, 2)), args.region, args.stride, args.radius_km,
+                       args.max_steps, not args.run_to_convergence, args.magnetic_north, args.field_lookup,
+                       args.processes)
+    save_basin(args.output, result)
+    print_summary(result)
+    print(f"written to {args.output}")
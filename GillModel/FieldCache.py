@@ -0,0 +1,82 @@
+from collections import OrderedDict
+import numpy as np
+
+# Default number of evaluated points kept
+FIELD_CACHE_SIZE = 100000
+
+# Coordinates closer than these share a cache entry: 1e-6 degrees is about 0.1 m,
+# 1e-4 years under an hour
+COORDINATE_RESOLUTION = 1e-6
+YEAR_RESOLUTION = 1e-4
+HEIGHT_RESOLUTION = 1.0
+
+class FieldCache:
+    # Bounded least-recently-used memo of magnetic field evaluations keyed on
+    # quantized (lat, lon, decimal year, height). One cache can be passed to several
+    # MagneticModels (and so be shared by every Agent using them); entries of
+    # different kinds of evaluation never mix.
+    def __init__(self, max_entries=FIELD_CACHE_SIZE, resolution=COORDINATE_RESOLUTION,
+                 year_resolution=YEAR_RESOLUTION, height_resolution=HEIGHT_RESOLUTION):
+        self.max_entries = max_entries
+        self.resolution = resolution
+        self.year_resolution = year_resolution
+        self.height_resolution = height_resolution
+        self._entries = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def key(self, kind, lat, lon, decimal_year, height):
+        # Cache key of one point; longitudes are wrapped to [-180, 180)
+        return (kind, round(lat / self.resolution), round(((lon + 180) % 360 - 180) / self.resolution),
+                round(decimal_year / self.year_resolution), round(height / self.height_resolution))
+
+    def keys(self, kind, lats, lons, decimal_years, heights):
+        # key for 1-D arrays of points at once
+        lons = (np.asarray(lons) + 180) % 360 - 180
+        quantized = np.rint(np.stack([np.asarray(lats) / self.resolution, lons / self.resolution,
+                                      np.asarray(decimal_years) / self.year_resolution,
+                                      np.asarray(heights) / self.height_resolution])).astype(np.int64)
+        return [(kind,) + point for point in zip(*quantized.tolist())]
+
+    def get(self, key):
+        # Cached value or None, counting the hit or miss
+        value = self._entries.get(key)
+        if value is None:
+            self.misses += 1
+            return None
+        self._entries.move_to_end(key)
+        self.hits += 1
+        return value
+
+    def put(self, key, value):
+        self._entries[key] = value
+        self._entries.move_to_end(key)
+        if len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def get_many(self, keys):
+        # get for a list of keys: the values (None where missing)
+        return [self.get(key) for key in keys]
+
+    def put_many(self, keys, values):
+        for key, value in zip(keys, values):
+            self.put(key, value)
+
+    def clear(self):
+        self._entries.clear()
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._entries)
+
+    def stats(self):
+        # Hit and miss counts, hit rate and current size
+        lookups = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / lookups if lookups else 0.0,
+            'entries': len(self._entries),
+            'max_entries': self.max_entries
+        }
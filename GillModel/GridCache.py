@@ -0,0 +1,67 @@
+import hashlib
+import json
+import os
+import shutil
+import tempfile
+import numpy as np
+
+# Bump when the layout or meaning of the cached arrays changes
+GRID_CACHE_VERSION = 1
+
+# Layout of regional sample axes, part of regional keys only: 2 covers the region
+# with whole cells, 1 (unversioned keys) shortened the last cell to end on the region
+REGION_AXES_VERSION = 2
+
+# Cached arrays, stored one .npy file each so they can be memory mapped
+GRID_ARRAYS = ('D_DECL', 'I_INCL', 'F_TOTAL', 'dI_INCL', 'dF_TOTAL', 'orthogonality')
+
+def grid_cache_key(decimal_year, sample_resolution, height, coefficients_id, gradient_method, dtype, region=None):
+    # Directory name for one sampled grid: readable prefix plus a hash of every input
+    # (region is left out of the hash for global grids, so their keys do not change)
+    dtype = np.dtype(dtype).name
+    params = {
+        'version': GRID_CACHE_VERSION,
+        'decimal_year': float(decimal_year),
+        'sample_resolution': float(sample_resolution),
+        'height': float(height),
+        'coefficients': coefficients_id,
+        'gradient_method': gradient_method,
+        'dtype': dtype,
+    }
+    prefix = f"grid_{decimal_year:.4f}_{sample_resolution:g}deg"
+    if region is not None:
+        params['region'] = [float(v) for v in region]
+        params['region_axes'] = REGION_AXES_VERSION
+        prefix += "_{:g}_{:g}_{:g}_{:g}".format(*region)
+    digest = hashlib.sha1(json.dumps(params, sort_keys=True).encode()).hexdigest()[:16]
+    return f"{prefix}_{dtype}_{digest}", params
+
+def load_grid(path, mmap_mode='r'):
+    # Open a cached grid as read-only memory maps; None if it has not been built
+    if not os.path.exists(os.path.join(path, 'meta.json')):
+        return None
+    with open(os.path.join(path, 'meta.json')) as file:
+        metadata = json.load(file)
+    if metadata.get('version') != GRID_CACHE_VERSION:
+        return None
+    arrays = {name: np.load(os.path.join(path, f"{name}.npy"), mmap_mode=mmap_mode) for name in GRID_ARRAYS}
+    return arrays, metadata
+
+def save_grid(path, arrays, metadata, dtype=np.float64):
+    # Write the arrays to a temporary directory and move it into place, so readers
+    # never see a partial cache and concurrent builders do not clobber each other
+    parent = os.path.dirname(os.path.abspath(path))
+    os.makedirs(parent, exist_ok=True)
+    tmp = tempfile.mkdtemp(prefix='.building_', dir=parent)
+    try:
+        for name in GRID_ARRAYS:
+            np.save(os.path.join(tmp, f"{name}.npy"), np.ascontiguousarray(arrays[name], dtype=dtype))
+        with open(os.path.join(tmp, 'meta.json'), 'w') as file:
+            json.dump(metadata, file, indent=1)
+        os.replace(tmp, path)
+    except OSError:
+        # Another process finished the same grid first
+        if not os.path.exists(os.path.join(path, 'meta.json')):
+            raise
+    finally:
+        shutil.rmtree(tmp, ignore_errors=True)
@@ -0,0 +1,128 @@
+import functools
+import json
+import sys
+import time
+from collections import defaultdict
+from contextlib import nullcontext
+
+# Instrumented code checks this module attribute before doing anything else, so
+# with no profile recording the cost is one global lookup and comparison per site
+active = None
+
+_NO_PHASE = nullcontext()
+
+class Profile:
+    # Everything recorded while a profile is active: wall time per named phase,
+    # counters broken down by calling function, and one event per e.g. Agent.Run.
+    # Use it as a context manager to record:
+    #     with Instrumentation.Profile() as profile:
+    #         ...
+    #     profile.dump('profile.json')
+    def __init__(self):
+        self.phases = defaultdict(lambda: {'calls': 0, 'seconds': 0.0})
+        self.counters = defaultdict(lambda: defaultdict(int))
+        self.events = defaultdict(list)
+        self._previous = None
+
+    def __enter__(self):
+        global active
+        self._previous = active
+        active = self
+        return self
+
+    def __exit__(self, *exc):
+        global active
+        active = self._previous
+        self._previous = None
+
+    def add_time(self, name, seconds):
+        phase = self.phases[name]
+        phase['calls'] += 1
+        phase['seconds'] += seconds
+
+    def as_dict(self):
+        return {
+            'phases': {name: dict(phase) for name, phase in self.phases.items()},
+            'counters': {name: {'total': sum(callers.values()), 'callers': dict(callers)}
+                         for name, callers in self.counters.items()},
+            'events': {name: list(events) for name, events in self.events.items()}
+        }
+
+    def dump(self, path=None, indent=1):
+        # The profile as JSON, written to path when given
+        text = json.dumps(self.as_dict(), indent=indent, default=float)
+        if path is not None:
+            with open(path, 'w') as file:
+                file.write(text)
+        return text
+
+    def summary(self):
+        # Phases by total time, then counter totals
+        lines = [f"{name:<48}{phase['calls']:>8} calls{phase['seconds']:>12.4f} s"
+                 for name, phase in sorted(self.phases.items(), key=lambda item: -item[1]['seconds'])]
+        lines += [f"{name:<48}{sum(callers.values()):>8} total" for name, callers in self.counters.items()]
+        lines += [f"{name:<48}{len(events):>8} events" for name, events in self.events.items()]
+        return '\n'.join(lines)
+
+class _Phase:
+    __slots__ = ('profile', 'name', 'start')
+
+    def __init__(self, profile, name):
+        self.profile = profile
+        self.name = name
+
+    def __enter__(self):
+        self.start = time.perf_counter()
+        return self
+
+    def __exit__(self, *exc):
+        self.profile.add_time(self.name, time.perf_counter() - self.start)
+
+def phase(name):
+    # Context manager timing a named phase into the active profile (a shared no-op
+    # when none is recording)
+    if active is None:
+        return _NO_PHASE
+    return _Phase(active, name)
+
+def timed(name=None):
+    # Decorator timing every call of a function as a phase (named after its
+    # qualified name by default); disabled, it adds one function call
+    def decorate(function):
+        label = name or function.__qualname__
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            if active is None:
+                return function(*args, **kwargs)
+            with _Phase(active, label):
+                return function(*args, **kwargs)
+        return wrapper
+    return decorate
+
+# Frames named by caller_name, innermost first
+CALLER_LEVELS = 2
+
+def caller_name(depth=2, levels=CALLER_LEVELS):
+    # Qualified names of the function depth frames up and of its own callers, e.g.
+    # 'MagneticModel.lookup_field < Agent.EvaluateField', passing over the timed
+    # wrappers
+    frame = sys._getframe(depth)
+    names = []
+    while frame is not None and len(names) < levels:
+        if frame.f_code.co_filename != __file__:
+            names.append(getattr(frame.f_code, 'co_qualname', frame.f_code.co_name))
+        frame = frame.f_back
+    return ' < '.join(names)
+
+def count(name, n=1, caller=None):
+    # Add n to a counter of the active profile, attributed to caller (default: the
+    # function calling the instrumented one)
+    if active is None:
+        return
+    active.counters[name][caller if caller is not None else caller_name(3)] += n
+
+def record(name, **fields):
+    # Append an event to the active profile
+    if active is None:
+        return
+    active.events[name].append(fields)
@@ -1,15 +1,401 @@
+import calendar
+import datetime
+import math
+import operator
+from collections import OrderedDict
 import numpy as np
-from scipy.optimize import minimize
 from pygeomag import GeoMag
-import pandas as pd
+import os
+import GridCache
+import Instrumentation
+from AdaptiveGrid import QuadtreeGrid
+from FieldCache import FieldCache
+from SignatureIndex import SignatureIndex, merge_solutions
+
+# WGS 84 ellipsoid axes and the geomagnetic reference radius used by GeoMag (km)
+WGS84_A = 6378.137
+WGS84_B = 6356.7523142
+GEOMAG_RE = 6371.2
+
+# Field components returned by evaluate_many, in the same order as evaluate_model
+FIELD_COMPONENTS = ('X', 'Y', 'Z', 'H', 'D', 'I', 'F')
+FIELD_DTYPE = np.dtype([(name, np.float64) for name in FIELD_COMPONENTS])
+
+# Analytic gradients added by evaluate_many(gradients=True): x is longitude and y is
+# latitude, in microtesla per degree and degrees per degree
+GRADIENT_COMPONENTS = ('dFdx', 'dFdy', 'dIdx', 'dIdy')
+FIELD_GRADIENT_DTYPE = np.dtype([(name, np.float64) for name in FIELD_COMPONENTS + GRADIENT_COMPONENTS])
+
+# Number of points synthesized at once by evaluate_many (bounds temporary memory)
+EVALUATE_CHUNK = 16384
+
+# Largest evaluate_many batch routed through the field cache; bigger batches (whole
+# grids) are synthesized directly, keeping their vectorization and leaving the
+# cached agent steps in place
+FIELD_CACHE_MAX_POINTS = 1024
+
+# WMM releases are valid for 5 years from their epoch (2010, 2015, 2020, 2025)
+WMM_LIFE_SPAN = 5
+
+# Knot grids kept in memory by set_date for time interpolation
+KNOT_GRIDS = 4
 
 def to_decimal_year(date):
-    date_object = pd.to_datetime(date, format="mixed")
-    total_days = 366 if date_object.is_leap_year else 365
-    return date_object.year + (date_object.dayofyear - 1) / total_days
+    # ISO date strings and date/datetime objects are converted without pandas (which
+    # is only imported for other formats)
+    if isinstance(date, str):
+        try:
+            date = datetime.datetime.fromisoformat(date)
+        except ValueError:
+            pass
+    if not isinstance(date, datetime.date):
+        import pandas as pd
+        date = pd.to_datetime(date, format="mixed")
+    total_days = 366 if calendar.isleap(date.year) else 365
+    return date.year + (date.timetuple().tm_yday - 1) / total_days
+
+def to_decimal_years(dates):
+    # to_decimal_year for an array or column of dates or datetimes
+    import pandas as pd
+    dates = pd.DatetimeIndex(pd.to_datetime(np.ravel(np.asarray(dates)), format="mixed"))
+    total_days = np.where(dates.is_leap_year, 366, 365)
+    years = dates.year.to_numpy() + (dates.dayofyear.to_numpy() - 1) / total_days
+    return years.reshape(np.shape(dates)) if np.ndim(dates) else years
+
+def geomag_coefficients(geo_mag):
+    # Copy the Schmidt-unnormalized Gauss coefficients of a GeoMag instance into
+    # arrays indexed [n, m]: coeffs[0..3] hold g, h, dg/dt and dh/dt, k holds the
+    # Legendre recursion constants
+    geo_mag._load_coefficients()
+    size = geo_mag._maxord + 1
+    coeffs = np.zeros((4, size, size))
+    k = np.zeros((size, size))
+    for n in range(1, size):
+        for m in range(n + 1):
+            coeffs[0, n, m] = geo_mag._c[m][n]
+            coeffs[2, n, m] = geo_mag._cd[m][n]
+            if m != 0:
+                coeffs[1, n, m] = geo_mag._c[n][m - 1]
+                coeffs[3, n, m] = geo_mag._cd[n][m - 1]
+            if geo_mag._k[m][n] is not None:
+                k[n, m] = geo_mag._k[m][n]
+    return coeffs, k, geo_mag._epoch
+
+def geocentric_terms(lat, height, derivatives=False):
+    # Convert geodetic latitudes (degrees) and heights (km) to the geocentric
+    # colatitude cosine/sine, radius and the rotation back to geodetic axes.
+    # With derivatives=True also return the derivatives with respect to geodetic
+    # latitude (per radian) of the colatitude, radius, ca and sa.
+    a2 = WGS84_A * WGS84_A
+    b2 = WGS84_B * WGS84_B
+    c2 = a2 - b2
+    a4 = a2 * a2
+    c4 = a4 - b2 * b2
+    rlat = np.radians(lat)
+    srlat = np.sin(rlat)
+    crlat = np.cos(rlat)
+    srlat2 = srlat * srlat
+    crlat2 = crlat * crlat
+    q = np.sqrt(a2 - c2 * srlat2)
+    q1 = height * q
+    q2 = ((q1 + a2) / (q1 + b2)) ** 2
+    ct = srlat / np.sqrt(q2 * crlat2 + srlat2)
+    st = np.sqrt(1.0 - ct * ct)
+    r = np.sqrt(height * height + 2.0 * q1 + (a4 - c4 * srlat2) / (q * q))
+    d = np.sqrt(a2 * crlat2 + b2 * srlat2)
+    ca = (height + d) / r
+    sa = c2 * crlat * srlat / (r * d)
+    if not derivatives:
+        return ct, st, r, ca, sa
+
+    dq = -c2 * srlat * crlat / q
+    dq1 = height * dq
+    u = (q1 + a2) / (q1 + b2)
+    du = dq1 * (b2 - a2) / (q1 + b2) ** 2
+    # The geocentric latitude is atan2(srlat, u * crlat); colatitude is its complement
+    dtheta = -(u - srlat * crlat * du) / (q2 * crlat2 + srlat2)
+    dr = (2.0 * dq1 - 2.0 * c4 * srlat * crlat / (q * q) - 2.0 * (a4 - c4 * srlat2) * dq / q ** 3) / (2.0 * r)
+    dd = (b2 - a2) * srlat * crlat / d
+    dca = dd / r - ca * dr / r
+    dsa = c2 * (crlat2 - srlat2) / (r * d) - sa * (dr / r + dd / d)
+    return ct, st, r, ca, sa, dtheta, dr, dca, dsa
+
+def legendre_terms(ct, st, k, second_derivative=False):
+    # Unnormalized associated Legendre functions P[n, m] and their derivatives with
+    # respect to colatitude, using the recursion of GeoMag.calculate. The trailing
+    # axis runs over the latitudes in ct/st. second_derivative=True also returns
+    # d2P/dtheta2, from the same recursion differentiated once more.
+    size = k.shape[0]
+    P = np.zeros((size, size, len(ct)))
+    dP = np.zeros_like(P)
+    ddP = np.zeros_like(P)
+    P[0, 0] = 1.0
+    for n in range(1, size):
+        for m in range(n + 1):
+            if n == m:
+                P[n, m] = st * P[n - 1, m - 1]
+                dP[n, m] = st * dP[n - 1, m - 1] + ct * P[n - 1, m - 1]
+                if second_derivative:
+                    ddP[n, m] = st * ddP[n - 1, m - 1] + 2.0 * ct * dP[n - 1, m - 1] - st * P[n - 1, m - 1]
+            elif n == 1:
+                P[n, m] = ct * P[n - 1, m]
+                dP[n, m] = ct * dP[n - 1, m] - st * P[n - 1, m]
+                if second_derivative:
+                    ddP[n, m] = ct * ddP[n - 1, m] - 2.0 * st * dP[n - 1, m] - ct * P[n - 1, m]
+            else:
+                P[n, m] = ct * P[n - 1, m] - k[n, m] * P[n - 2, m]
+                dP[n, m] = ct * dP[n - 1, m] - st * P[n - 1, m] - k[n, m] * dP[n - 2, m]
+                if second_derivative:
+                    ddP[n, m] = (ct * ddP[n - 1, m] - 2.0 * st * dP[n - 1, m] - ct * P[n - 1, m]
+                                 - k[n, m] * ddP[n - 2, m])
+    if second_derivative:
+        return P, dP, ddP
+    return P, dP
+
+def polar_legendre_terms(ct, k):
+    # Legendre terms for m = 1 used by GeoMag on the geographic poles, where the
+    # east component cannot be divided by sin(colatitude)
+    size = k.shape[0]
+    pp = np.ones((size, len(ct)))
+    for n in range(2, size):
+        pp[n] = ct * pp[n - 1] - k[n, 1] * pp[n - 2]
+    return pp
+
+def synthesize_field(coeffs, k, epoch, lat, lon, decimal_year, height, gradients=False):
+    # Vectorized equivalent of GeoMag.calculate for 1-D arrays of points. The
+    # Legendre terms are computed once per distinct (latitude, height) and reduced
+    # to per-order sums, so each point only pays for its longitude and time terms.
+    # Returns x, y, z, h, d, i, f with intensities in nT and angles in degrees.
+    # With gradients=True a second tuple (dfdx, dfdy, didx, didy) holds the
+    # analytic derivatives of f and i with respect to longitude (x) and latitude
+    # (y), per degree.
+    dt = decimal_year - epoch
+    if np.any((dt < 0.0) | (dt > 5.0)):
+        raise ValueError("Time extends beyond model 5-year life span")
+
+    size = k.shape[0]
+    n = np.arange(size)[:, None]
+    m = np.arange(size)
+
+    groups, inverse = np.unique(np.column_stack([lat, height]), axis=0, return_inverse=True)
+    inverse = inverse.reshape(-1)
+    if gradients:
+        ct, st, r, ca, sa, dtheta, dr, dca, dsa = geocentric_terms(groups[:, 0], groups[:, 1], derivatives=True)
+        P, dP, ddP = legendre_terms(ct, st, k, second_derivative=True)
+    else:
+        ct, st, r, ca, sa = geocentric_terms(groups[:, 0], groups[:, 1])
+        P, dP = legendre_terms(ct, st, k)
+    ar = (GEOMAG_RE / r) ** (n + 2)
+
+    # Per-group sums over degree n for each order m of g, h, dg/dt and dh/dt
+    term_t = np.einsum('ng,nmg,knm->gkm', -ar, dP, coeffs, optimize=True)
+    term_p = np.einsum('ng,nmg,knm->gkm', ar, P, coeffs, optimize=True)
+    term_r = np.einsum('ng,nmg,knm->gkm', (n + 1) * ar, P, coeffs, optimize=True)
+    if gradients:
+        dar = -(n + 2) * ar * dr / r
+        dkernel_p = dar[:, None] * P + ar[:, None] * dP * dtheta
+        dterm_t = -np.einsum('nmg,knm->gkm', dar[:, None] * dP + ar[:, None] * ddP * dtheta, coeffs, optimize=True)
+        dterm_p = np.einsum('nmg,knm->gkm', dkernel_p, coeffs, optimize=True)
+        dterm_r = np.einsum('nmg,knm->gkm', (n[:, None] + 1) * dkernel_p, coeffs, optimize=True)
+
+    def at_time(term):
+        term = term[inverse]
+        return term[:, :2] + dt[:, None, None] * term[:, 2:]
+
+    rlon = np.radians(lon)[:, None] * m
+    cos_m = np.cos(rlon)
+    sin_m = np.sin(rlon)
+
+    def cos_sum(term):
+        return np.sum(term[:, 0] * cos_m + term[:, 1] * sin_m, axis=1)
+
+    def sin_sum(term):
+        return np.sum(m * (term[:, 0] * sin_m - term[:, 1] * cos_m), axis=1)
+
+    term_t = at_time(term_t)
+    term_r = at_time(term_r)
+    term_p = at_time(term_p)
+    bt = cos_sum(term_t)
+    br = cos_sum(term_r)
+    bp = sin_sum(term_p)
+    if gradients:
+        # d/dlon turns cos(m lon) into -m sin(m lon) and sin(m lon) into m cos(m lon)
+        bt_x = -sin_sum(term_t)
+        br_x = -sin_sum(term_r)
+        bp_x = np.sum(m * m * (term_p[:, 0] * cos_m + term_p[:, 1] * sin_m), axis=1)
+        bt_y = cos_sum(at_time(dterm_t))
+        br_y = cos_sum(at_time(dterm_r))
+        bp_y = sin_sum(at_time(dterm_p))
+
+    st_g = st
+    st = st[inverse]
+    polar = st == 0.0
+    if np.any(polar):
+        pp = polar_legendre_terms(ct, k)
+        term_pp = at_time(np.einsum('ng,ng,kn->gk', ar, pp, coeffs[:, :, 1])[:, :, None])[polar, :, 0]
+        bp[polar] = term_pp[:, 0] * sin_m[polar, 1] - term_pp[:, 1] * cos_m[polar, 1]
+        if gradients:
+            bp_x[polar] = term_pp[:, 0] * cos_m[polar, 1] + term_pp[:, 1] * sin_m[polar, 1]
+            dterm_pp = at_time(np.einsum('ng,ng,kn->gk', dar, pp, coeffs[:, :, 1])[:, :, None])[polar, :, 0]
+            bp_y[polar] = dterm_pp[:, 0] * sin_m[polar, 1] - dterm_pp[:, 1] * cos_m[polar, 1]
+    if gradients:
+        # Quotient rule for bp / sin(colatitude)
+        cot = (ct / np.where(st_g == 0.0, 1.0, st_g) * dtheta)[inverse]
+        bp_y[~polar] = (bp_y[~polar] - bp[~polar] * cot[~polar]) / st[~polar]
+        bp_x[~polar] /= st[~polar]
+    bp[~polar] /= st[~polar]
+
+    # Rotate from spherical to geodetic components
+    ca = ca[inverse]
+    sa = sa[inverse]
+    bx = -bt * ca - br * sa
+    by = bp
+    bz = bt * sa - br * ca
+
+    bh = np.sqrt(bx * bx + by * by)
+    f = np.sqrt(bh * bh + bz * bz)
+    d = np.degrees(np.arctan2(by, bx))
+    i = np.degrees(np.arctan2(bz, bh))
+    rd = np.radians(d)
+    ri = np.radians(i)
+    x = f * np.cos(rd) * np.cos(ri)
+    y = f * np.cos(ri) * np.sin(rd)
+    z = f * np.sin(ri)
+    h = f * np.cos(ri)
+    if not gradients:
+        return x, y, z, h, d, i, f
+
+    dca = dca[inverse]
+    dsa = dsa[inverse]
+    bx_x = -bt_x * ca - br_x * sa
+    bz_x = bt_x * sa - br_x * ca
+    bx_y = -bt_y * ca - bt * dca - br_y * sa - br * dsa
+    bz_y = bt_y * sa + bt * dsa - br_y * ca - br * dca
+
+    def intensity_inclination_gradient(bx_, by_, bz_):
+        # Derivatives are per radian; a degree of lon/lat is pi/180 radians, while
+        # inclination stays in radians per radian == degrees per degree
+        dbh = (bx * bx_ + by * by_) / bh
+        df = (bh * dbh + bz * bz_) / f
+        di = (bh * bz_ - bz * dbh) / (f * f)
+        return np.radians(df), di
+
+    dfdx, didx = intensity_inclination_gradient(bx_x, bp_x, bz_x)
+    dfdy, didy = intensity_inclination_gradient(bx_y, bp_y, bz_y)
+    return (x, y, z, h, d, i, f), (dfdx, dfdy, didx, didy)
+
+# Newton iterations of find_all_coords and when they count as converged (in µT and
+# degrees); solutions closer than INVERSE_MERGE_DISTANCE degrees are one solution
+# (where the F and I gradients are nearly parallel a solution is only determined
+# to about 1e-4 degrees)
+INVERSE_ITERATIONS = 25
+INVERSE_F_TOLERANCE = 1e-6
+INVERSE_I_TOLERANCE = 1e-6
+INVERSE_MERGE_DISTANCE = 1e-3
+
+# Field lookup backends: exact GeoMag evaluation or interpolation over the samples
+FIELD_LOOKUPS = ('exact', 'bilinear', 'bicubic', 'adaptive')
+
+def cubic_weights(t):
+    # Catmull-Rom (Keys, a = -0.5) weights for the four neighbours at offsets -1..2
+    t2 = t * t
+    t3 = t2 * t
+    return ((-t3 + 2 * t2 - t) / 2, (3 * t3 - 5 * t2 + 2) / 2,
+            (-3 * t3 + 4 * t2 + t) / 2, (t3 - t2) / 2)
+
+def prepare_lookup_grid(tables, latitudes, longitudes):
+    # Pad a stack of tables shaped (k, len(latitudes), len(longitudes)) by one cell
+    # before and two after each axis (wrapping longitude when the grid spans the
+    # whole circle, extrapolating the edge slope linearly otherwise, so bicubic
+    # lookups in the edge cells stay as accurate as inside) and move the stack axis
+    # last, so the 4x4 neighbourhood of any cell is one contiguous slice
+    nlat, nlon = tables.shape[1:]
+    dlat = float(latitudes[1] - latitudes[0])
+    dlon = float(longitudes[1] - longitudes[0])
+    period = int(round(360 / dlon))
+    periodic = abs(period * dlon - 360) < 1e-9 and nlon >= period
+    tables = np.moveaxis(np.asarray(tables, dtype=float), 0, -1)
+    def extrapolate(values, axis):
+        first, second = np.take(values, [0], axis), np.take(values, [1], axis)
+        last, before = np.take(values, [-1], axis), np.take(values, [-2], axis)
+        return np.concatenate([2 * first - second, values, 2 * last - before, 3 * last - 2 * before], axis=axis)
+
+    tables = extrapolate(tables, 0)
+    if periodic:
+        tables = tables[:, :period]
+        tables = np.concatenate([tables[:, -1:], tables, tables[:, :2]], axis=1)
+        ncells = period
+    else:
+        tables = extrapolate(tables, 1)
+        ncells = nlon - 1
+    return {
+        'tables': np.ascontiguousarray(tables),
+        'lat0': float(latitudes[0]), 'dlat': dlat, 'nlat': nlat,
+        'lon0': float(longitudes[0]), 'dlon': dlon, 'nlon': nlon,
+        'periodic': periodic, 'ncells': ncells
+    }
+
+def interpolate_grid(grid, lat, lon, method='bilinear'):
+    # Interpolate a prepared lookup grid at arrays of points; returns (len(lat), k)
+    nlat = grid['nlat']
+    fy = np.clip((lat - grid['lat0']) / grid['dlat'], 0, nlat - 1)
+    if grid['periodic']:
+        fx = np.mod(lon - grid['lon0'], 360) / grid['dlon']
+    else:
+        fx = np.clip((lon - grid['lon0']) / grid['dlon'], 0, grid['nlon'] - 1)
+    i = np.minimum(np.floor(fy).astype(int), nlat - 2)
+    j = np.minimum(np.floor(fx).astype(int), grid['ncells'] - 1)
+    ty = (fy - i)[:, None]
+    tx = (fx - j)[:, None]
+    tables = grid['tables']
+
+    if method == 'bilinear':
+        return ((1 - ty) * ((1 - tx) * tables[i + 1, j + 1] + tx * tables[i + 1, j + 2])
+                + ty * ((1 - tx) * tables[i + 2, j + 1] + tx * tables[i + 2, j + 2]))
+    elif method == 'bicubic':
+        wy = cubic_weights(ty)
+        wx = cubic_weights(tx)
+        result = 0.0
+        for a in range(4):
+            row = 0.0
+            for b in range(4):
+                row = row + wx[b] * tables[i + a, j + b]
+            result = result + wy[a] * row
+        return result
+    raise ValueError(f"Unknown interpolation method {method!r}")
+
+def interpolate_point(grid, lat, lon, method='bilinear'):
+    # Scalar version of interpolate_grid in plain Python arithmetic, for stepping
+    # one agent at a time without numpy's per-call overhead; returns a list of k
+    nlat = grid['nlat']
+    fy = min(max((lat - grid['lat0']) / grid['dlat'], 0.0), nlat - 1)
+    if grid['periodic']:
+        fx = ((lon - grid['lon0']) % 360) / grid['dlon']
+    else:
+        fx = min(max((lon - grid['lon0']) / grid['dlon'], 0.0), grid['nlon'] - 1)
+    i = min(math.floor(fy), nlat - 2)
+    j = min(math.floor(fx), grid['ncells'] - 1)
+    ty = fy - i
+    tx = fx - j
+    tables = grid['tables']
+    k = tables.shape[2]
+
+    if method == 'bilinear':
+        v = tables[i + 1:i + 3, j + 1:j + 3].ravel().tolist()
+        w = ((1 - ty) * (1 - tx), (1 - ty) * tx, ty * (1 - tx), ty * tx)
+    elif method == 'bicubic':
+        v = tables[i:i + 4, j:j + 4].ravel().tolist()
+        wx = cubic_weights(tx)
+        w = [wya * wxb for wya in cubic_weights(ty) for wxb in wx]
+    else:
+        raise ValueError(f"Unknown interpolation method {method!r}")
+    # v interleaves the k tables, so v[c::k] are the neighbours of table c
+    return [sum(map(operator.mul, w, v[c::k])) for c in range(k)]
 
 class MagneticModel:
-    def __init__(self, sample_resolution, datestr=None, model=None, version=None):
+    @Instrumentation.timed()
+    def __init__(self, sample_resolution, datestr=None, model=None, version=None, gradient_method='analytic',
+                 cache_dir=None, cache_dtype=np.float64, field_lookup='exact', field_cache=None, region=None):
         # Initialize properties
         if model is not None or version is not None:
             raise ValueError("No support for different Model/Version yet")
@@ -20,25 +406,297 @@ class MagneticModel:
         elif model is not None or version is not None:
             raise ValueError("No support for different Model/Version yet")
         self.height = 0.0  # altitude in meters
+        self.gradient_method = gradient_method  # 'analytic' or 'finite' differences
+        self.field_lookup = field_lookup  # default backend of lookup_field, see FIELD_LOOKUPS
+        self._lookup_tables = None
+        self._signature_index = None
+        # Memo of exact evaluations (single points and evaluate_many batches of up to
+        # FIELD_CACHE_MAX_POINTS): True for a private FieldCache, or a FieldCache
+        # shared with other models
+        if field_cache is True:
+            field_cache = FieldCache()
+        self.field_cache = field_cache if field_cache is not False else None
         self.sample_resolution = sample_resolution if sample_resolution is not None else 1.0
-        self.sample_latitudes = np.arange(-90, 91, self.sample_resolution)
-        self.sample_longitudes = np.arange(-180, 181, self.sample_resolution)
+        # region = (lat_min, lat_max, lon_min, lon_max) samples only that bounding box
+        self.region = None
+        if region is None:
+            self.sample_latitudes = np.arange(-90, 91, self.sample_resolution)
+            self.sample_longitudes = np.arange(-180, 181, self.sample_resolution)
+        else:
+            lat_min, lat_max, lon_min, lon_max = (float(v) for v in region)
+            if not (-90 <= lat_min < lat_max <= 90 and lon_min < lon_max <= lon_min + 360):
+                raise ValueError(f"Invalid region {region!r}")
+            self.region = (lat_min, lat_max, lon_min, lon_max)
+            self.sample_latitudes = self.region_axis(lat_min, lat_max, pole=True)
+            self.sample_longitudes = self.region_axis(lon_min, lon_max)
+        # Adaptively refined grid, built by refine_grid and rebuilt lazily with the same
+        # options after set_date
+        self._quadtree = None
+        self._quadtree_options = None
         self.lat_mesh_size=np.prod(self.sample_latitudes.shape)
         self.lon_mesh_size=np.prod(self.sample_longitudes.shape)
-        self.geo_mag = GeoMag()
+        self._epoch_models = {}
+        self._knot_grids = OrderedDict()
+        self.geo_mag = self.epoch_model(self.decimal_year)
         self.contour_levels = {
             'I_INCL': np.arange(-80, 81, 20),  # degrees
             'F_TOTAL': np.arange(0, 101, 5)  # microtesla
         }
 
-        self.populate_samples()
-        #self.compute_contours()
-        self.compute_gradients()
-        self.compute_orthogonality()
+        # The sampled grids are built on first access of samples, sample_gradients or
+        # sample_orthogonality (see grid), memory mapped from cache_dir when given
+        self._grids = {}
+        self._grid_source = ('cache', cache_dir, cache_dtype) if cache_dir is not None else ('compute',)
+        # Counts changes of the sampled grids or quadtree (new grids, set_date,
+        # refine_grid), so results derived from them can tell when they are stale
+        self.grid_version = 0
+
+    def grid(self, name):
+        # One of the sampled grids, building it from the current source if needed:
+        # computed here, memory mapped from a cache directory (built there on first
+        # use), or resampled at the date of the last set_date
+        if name not in self._grids:
+            source = self._grid_source
+            if source[0] == 'cache':
+                self.load_grid_cache(*source[1:])
+            elif source[0] == 'date':
+                self.date_grids(*source[1:])
+            elif name == 'samples':
+                self.populate_samples()
+            elif name == 'sample_gradients':
+                self.compute_gradients()
+            else:
+                self.compute_orthogonality()
+        return self._grids[name]
+
+    @property
+    def samples(self):
+        return self.grid('samples')
+
+    @samples.setter
+    def samples(self, value):
+        self._grids['samples'] = value
+        self._lookup_tables = None
+        self._signature_index = None
+        self.grid_version += 1
+
+    @property
+    def sample_gradients(self):
+        return self.grid('sample_gradients')
+
+    @sample_gradients.setter
+    def sample_gradients(self, value):
+        self._grids['sample_gradients'] = value
+        self.grid_version += 1
+
+    @property
+    def sample_orthogonality(self):
+        return self.grid('sample_orthogonality')
+
+    @sample_orthogonality.setter
+    def sample_orthogonality(self, value):
+        self._grids['sample_orthogonality'] = value
+
+    @property
+    def quadtree(self):
+        if self._quadtree is None and self._quadtree_options is not None:
+            self.refine_grid()
+        return self._quadtree
+
+    @property
+    def signature_index(self):
+        # SignatureIndex of the sampled grid, built on first use by find_all_coords
+        if getattr(self, '_signature_index', None) is None:
+            self._signature_index = SignatureIndex(self.sample_latitudes, self.sample_longitudes,
+                                                   self.samples['F_TOTAL'], self.samples['I_INCL'])
+        return self._signature_index
+
+    def grid_cache_key(self, dtype=np.float64, decimal_year=None):
+        # Cache directory name and parameters identifying this model's sampled grids
+        # (or its grids at another decimal_year)
+        if decimal_year is None:
+            decimal_year = self.decimal_year
+        geo_mag = self.epoch_model(decimal_year)
+        coefficients_id = f"{geo_mag._model}-{geo_mag._epoch}-{geo_mag._release_date}-{geo_mag._maxord}"
+        return GridCache.grid_cache_key(decimal_year, self.sample_resolution, self.height, coefficients_id,
+                                        getattr(self, 'gradient_method', 'finite'), dtype,
+                                        getattr(self, 'region', None))
+
+    def region_axis(self, start, stop, pole=False):
+        # Evenly spaced sample coordinates at sample_resolution from start, covering
+        # start to stop with whole cells (overhanging stop if need be), as the lookup
+        # interpolators assume a uniform axis. A latitude axis (pole) that would pass
+        # 90 is moved south instead, dropping samples past the pole if it cannot fit.
+        n = max(1, math.ceil((stop - start) / self.sample_resolution - 1e-9))
+        axis = start + self.sample_resolution * np.arange(n + 1)
+        if pole and axis[-1] > 90:
+            axis -= min(axis[-1] - 90, axis[0] + 90)
+            axis = axis[axis <= 90 + 1e-9]
+        return axis
+
+    @Instrumentation.timed()
+    def refine_grid(self, max_level=None, f_tolerance=None, i_tolerance=None):
+        # Build quadtree, an AdaptiveGrid.QuadtreeGrid over the model's region (or the
+        # globe) with the sample grid as its base level, split where the gradients of
+        # F or I change quickly. It then serves 'adaptive' lookups, and the stability
+        # maps of StabilitySweep and AxesmMagneticMap use its leaves. Options left at
+        # None keep those of the current quadtree, or the AdaptiveGrid defaults.
+        options = dict(self._quadtree_options or {})
+        for name, value in (('max_level', max_level), ('f_tolerance', f_tolerance), ('i_tolerance', i_tolerance)):
+            if value is not None:
+                options[name] = value
+        self._quadtree_options = options
+        self._quadtree = QuadtreeGrid(self, getattr(self, 'region', None), self.sample_resolution, **options)
+        self.grid_version += 1
+        return self._quadtree
+
+    def outside_grid(self, lat, lon):
+        # Whether points fall outside a regional sample grid (never for a global one)
+        if getattr(self, 'region', None) is None:
+            return np.zeros(np.broadcast(lat, lon).shape, dtype=bool)
+        lat_min, lat_max, lon_min, lon_max = self.region
+        if isinstance(lat, (float, int, np.number)) and isinstance(lon, (float, int, np.number)):
+            return lat < lat_min or lat > lat_max or (lon - lon_min) % 360 + lon_min > lon_max
+        lon = np.mod(np.asarray(lon, dtype=float) - lon_min, 360) + lon_min
+        return (np.asarray(lat) < lat_min) | (np.asarray(lat) > lat_max) | (lon > lon_max)
+
+    @Instrumentation.timed()
+    def load_grid_cache(self, cache_dir, dtype=np.float64):
+        # Replace samples, sample_gradients and sample_orthogonality with read-only
+        # memory maps of the cached grid, computing and saving it if it is missing
+        key, params = self.grid_cache_key(dtype)
+        path = os.path.join(cache_dir, key)
+        cached = GridCache.load_grid(path)
+        if cached is None:
+            self.populate_samples()
+            self.compute_gradients()
+            self.compute_orthogonality()
+            self.save_grid_cache(cache_dir, dtype)
+            cached = GridCache.load_grid(path)
+        arrays, _ = cached
+        self.samples = {name: arrays[name] for name in ('D_DECL', 'I_INCL', 'F_TOTAL')}
+        self.sample_gradients = {'I_INCL': arrays['dI_INCL'], 'F_TOTAL': arrays['dF_TOTAL']}
+        self.sample_orthogonality = arrays['orthogonality']
+        self.grid_cache_path = path
+        self._lookup_tables = None
+
+    @Instrumentation.timed()
+    def save_grid_cache(self, cache_dir, dtype=np.float64):
+        # Write the current grids to cache_dir and return the cache path
+        key, params = self.grid_cache_key(dtype)
+        path = os.path.join(cache_dir, key)
+        arrays = dict(self.samples)
+        arrays['dI_INCL'] = self.sample_gradients['I_INCL']
+        arrays['dF_TOTAL'] = self.sample_gradients['F_TOTAL']
+        arrays['orthogonality'] = self.sample_orthogonality
+        GridCache.save_grid(path, arrays, params, dtype)
+        return path
+
+    def grid_arrays(self, decimal_year):
+        # Every cached grid (see GridCache.GRID_ARRAYS) sampled at another decimal_year
+        lat, lon = np.meshgrid(self.sample_latitudes, self.sample_longitudes, indexing='ij')
+        if getattr(self, 'gradient_method', 'finite') == 'analytic':
+            field = self.evaluate_many(lat, lon, decimal_year, gradients=True)
+            dF_TOTAL = np.stack([field['dFdx'], field['dFdy']])
+            dI_INCL = np.stack([field['dIdx'], field['dIdy']])
+        else:
+            ddeg = 1e-3
+            field = self.evaluate_many(lat, lon, decimal_year)
+            field_x = self.evaluate_many(lat, lon + ddeg, decimal_year)
+            field_y = self.evaluate_many(lat + ddeg, lon, decimal_year)
+            dF_TOTAL = np.stack([(field_x['F'] - field['F']) / ddeg, (field_y['F'] - field['F']) / ddeg])
+            dI_INCL = np.stack([(field_x['I'] - field['I']) / ddeg, (field_y['I'] - field['I']) / ddeg])
+        return {
+            'D_DECL': field['D'],
+            'I_INCL': field['I'],
+            'F_TOTAL': field['F'],
+            'dI_INCL': dI_INCL,
+            'dF_TOTAL': dF_TOTAL,
+            'orthogonality': self.angle_from_u_to_v(dI_INCL, dF_TOTAL)
+        }
+
+    def knot_grid(self, decimal_year, cache_dir=None, dtype=np.float64):
+        # grid_arrays at decimal_year, memory mapped from cache_dir (built there on first
+        # use) when given; the last KNOT_GRIDS grids used stay open
+        key = (decimal_year, cache_dir, np.dtype(dtype).name)
+        if key in self._knot_grids:
+            self._knot_grids.move_to_end(key)
+            return self._knot_grids[key]
+        if cache_dir is None:
+            arrays = self.grid_arrays(decimal_year)
+        else:
+            name, params = self.grid_cache_key(dtype, decimal_year)
+            path = os.path.join(cache_dir, name)
+            cached = GridCache.load_grid(path)
+            if cached is None:
+                GridCache.save_grid(path, self.grid_arrays(decimal_year), params, dtype)
+                cached = GridCache.load_grid(path)
+            arrays = cached[0]
+        self._knot_grids[key] = arrays
+        if len(self._knot_grids) > KNOT_GRIDS:
+            self._knot_grids.popitem(last=False)
+        return arrays
+
+    @Instrumentation.timed()
+    def set_date(self, date, cache_dir=None, knot_years=None, dtype=np.float64):
+        # Move the model to another date (a date string or decimal year) without
+        # rebuilding it. Exact lookups use the new date directly. The sampled grids are
+        # resampled at the date, or with knot_years interpolated linearly in time
+        # between the grids at the surrounding multiples of knot_years, so Agent runs
+        # across a date range reuse a handful of knot grids (cached in cache_dir when
+        # given). The grids are only rebuilt when next used. Agents keep the start and
+        # goal fields they were given, so set those again after moving.
+        if isinstance(date, (int, float, np.number)):
+            self.decimal_year = float(date)
+        else:
+            self.decimal_year = to_decimal_year(date)
+        self.geo_mag = self.epoch_model(self.decimal_year)
+        self._lookup_tables = None
+        self._signature_index = None
+        self._grids = {}
+        self._grid_source = ('date', cache_dir, knot_years, dtype)
+        self._quadtree = None
+        self.grid_version += 1
+
+    @Instrumentation.timed()
+    def date_grids(self, cache_dir=None, knot_years=None, dtype=np.float64):
+        # Resample the grids at decimal_year for set_date
+        if knot_years is None:
+            arrays = self.knot_grid(self.decimal_year, cache_dir, dtype)
+        else:
+            t0 = knot_years * math.floor(self.decimal_year / knot_years)
+            w = (self.decimal_year - t0) / knot_years
+            arrays = self.knot_grid(t0, cache_dir, dtype)
+            if w > 0:
+                # Knots on either side of a new WMM release blend the two releases
+                after = self.knot_grid(t0 + knot_years, cache_dir, dtype)
+                blend = lambda name: (1 - w) * arrays[name] + w * after[name]
+                D = arrays['D_DECL'] + w * ((after['D_DECL'] - arrays['D_DECL'] + 180) % 360 - 180)
+                dI_INCL, dF_TOTAL = blend('dI_INCL'), blend('dF_TOTAL')
+                arrays = {
+                    'D_DECL': (D + 180) % 360 - 180,
+                    'I_INCL': blend('I_INCL'),
+                    'F_TOTAL': blend('F_TOTAL'),
+                    'dI_INCL': dI_INCL,
+                    'dF_TOTAL': dF_TOTAL,
+                    'orthogonality': self.angle_from_u_to_v(dI_INCL, dF_TOTAL)
+                }
+        self.samples = {name: arrays[name] for name in ('D_DECL', 'I_INCL', 'F_TOTAL')}
+        self.sample_gradients = {'I_INCL': arrays['dI_INCL'], 'F_TOTAL': arrays['dF_TOTAL']}
+        self.sample_orthogonality = arrays['orthogonality']
 
     def evaluate_model(self, lat, lon):
         # Evaluate the magnetic field at the given coordinates
         # Outputs in microtesla and degrees
+        if Instrumentation.active is not None:
+            Instrumentation.count('MagneticModel.evaluate_model',
+                                  caller=Instrumentation.caller_name(2))
+        cache = getattr(self, 'field_cache', None)
+        if cache is not None:
+            key = cache.key('model', lat, lon, self.decimal_year, self.height)
+            cached = cache.get(key)
+            if cached is not None:
+                return cached
         result=self.geo_mag.calculate(lat, lon, self.height, self.decimal_year)
         #XYZ, H, D, I, F = self.geo_mag.calculate(lat, lon, self.height, self.decimal_year)
         # Access the results
@@ -50,10 +708,221 @@ class MagneticModel:
         east_component = result.y      /1000 # East component (nT) converted to µT
         vertical_component = result.z /1000  # Vertical component (nT) converted to µT
 
-        return north_component, east_component, vertical_component, horizontal_intensity, declination, inclination, total_intensity
+        field = north_component, east_component, vertical_component, horizontal_intensity, declination, inclination, total_intensity
+        if cache is not None:
+            cache.put(key, field)
+        return field
+
+    def evaluate_many(self, lats, lons, decimal_years=None, heights=None, gradients=False):
+        # Evaluate the magnetic field at arrays of coordinates in one vectorized pass
+        # Inputs broadcast against each other; decimal_years and heights default to the
+        # model's own. Returns a structured array with fields X, Y, Z, H, D, I, F in
+        # microtesla and degrees, shaped like the broadcast inputs. gradients=True adds
+        # the analytic dFdx, dFdy, dIdx, dIdy fields (x is longitude, y is latitude).
+        if decimal_years is None:
+            decimal_years = self.decimal_year
+        if heights is None:
+            heights = self.height
+        lats, lons, decimal_years, heights = np.broadcast_arrays(
+            np.asarray(lats, dtype=float), np.asarray(lons, dtype=float),
+            np.asarray(decimal_years, dtype=float), np.asarray(heights, dtype=float))
+        shape = lats.shape
+        if Instrumentation.active is not None:
+            Instrumentation.count('MagneticModel.evaluate_many points', lats.size,
+                                  caller=Instrumentation.caller_name(2))
+        lats, lons, decimal_years, heights = (a.ravel() for a in (lats, lons, decimal_years, heights))
+        if getattr(self, 'field_cache', None) is not None and lats.size <= FIELD_CACHE_MAX_POINTS:
+            return self.cached_synthesis(lats, lons, decimal_years, heights, gradients).reshape(shape)
+        return self.synthesize(lats, lons, decimal_years, heights, gradients).reshape(shape)
+
+    def synthesize(self, lats, lons, decimal_years, heights, gradients=False):
+        # evaluate_many for 1-D arrays of points, without the field cache
+        result = np.empty(lats.size, dtype=FIELD_GRADIENT_DTYPE if gradients else FIELD_DTYPE)
+        # Points are synthesized per WMM release with that release's coefficients;
+        # points is None when every point shares one release
+        for (coeffs, k, epoch), points in self.epoch_groups(decimal_years):
+            n_points = lats.size if points is None else len(points)
+            for start in range(0, n_points, EVALUATE_CHUNK):
+                if points is None:
+                    chunk = slice(start, start + EVALUATE_CHUNK)
+                else:
+                    chunk = points[start:start + EVALUATE_CHUNK]
+                field = synthesize_field(coeffs, k, epoch, lats[chunk], lons[chunk],
+                                         decimal_years[chunk], heights[chunk], gradients=gradients)
+                if gradients:
+                    field, (dfdx, dfdy, didx, didy) = field
+                    result['dFdx'][chunk] = dfdx / 1000
+                    result['dFdy'][chunk] = dfdy / 1000
+                    result['dIdx'][chunk] = didx
+                    result['dIdy'][chunk] = didy
+                x, y, z, h, d, i, f = field
+                result['X'][chunk] = x / 1000
+                result['Y'][chunk] = y / 1000
+                result['Z'][chunk] = z / 1000
+                result['H'][chunk] = h / 1000
+                result['D'][chunk] = d
+                result['I'][chunk] = i
+                result['F'][chunk] = f / 1000
+        return result
+
+    def cached_synthesis(self, lats, lons, decimal_years, heights, gradients=False):
+        # synthesize, taking every point already in field_cache from there and adding
+        # the rest to it
+        cache = self.field_cache
+        keys = cache.keys('gradients' if gradients else 'field', lats, lons, decimal_years, heights)
+        values = cache.get_many(keys)
+        missing = np.array([value is None for value in values], dtype=bool)
+        result = np.empty(lats.size, dtype=FIELD_GRADIENT_DTYPE if gradients else FIELD_DTYPE)
+        if not missing.all():
+            result[~missing] = [value for value in values if value is not None]
+        if missing.any():
+            computed = self.synthesize(lats[missing], lons[missing], decimal_years[missing], heights[missing],
+                                       gradients)
+            result[missing] = computed
+            cache.put_many([key for key, miss in zip(keys, missing) if miss], computed.tolist())
+        return result
 
-    def estimate_gradients(self, lat, lon, ddeg=1e-3):
+    def evaluate_times(self, lats, lons, times, heights=None, gradients=False):
+        # evaluate_many at each point's own date, e.g. a track's datetime column
+        return self.evaluate_many(lats, lons, to_decimal_years(times), heights, gradients)
+
+    def epoch_model(self, decimal_year):
+        # GeoMag instance of the WMM release whose life span covers decimal_year, one
+        # per release (the end of the last life span belongs to that release)
+        release = WMM_LIFE_SPAN * math.floor(decimal_year / WMM_LIFE_SPAN)
+        if release not in self._epoch_models:
+            try:
+                geo_mag = GeoMag(base_year=release)
+                geo_mag._load_coefficients()
+            except ValueError:
+                if decimal_year != release:
+                    raise
+                return self.epoch_model(decimal_year - 1e-9)
+            self._epoch_models[release] = (geo_mag, None)
+        return self._epoch_models[release][0]
+
+    def epoch_coefficients(self, decimal_year):
+        # geomag_coefficients of epoch_model(decimal_year), extracted once per release
+        geo_mag = self.epoch_model(decimal_year)
+        release = WMM_LIFE_SPAN * math.floor(geo_mag._epoch / WMM_LIFE_SPAN)
+        if self._epoch_models[release][1] is None:
+            self._epoch_models[release] = (geo_mag, geomag_coefficients(geo_mag))
+        return self._epoch_models[release][1]
+
+    def epoch_groups(self, decimal_years):
+        # Split points by WMM release: (coefficients, point indices) per release, with
+        # indices None when all points share one. Releases are found per distinct
+        # calendar year, so this costs one pass over the points.
+        if len(decimal_years) == 0:
+            return [(self.field_coefficients(), None)]
+        first, last = np.min(decimal_years), np.max(decimal_years)
+        if self.epoch_model(math.floor(first)) is self.epoch_model(math.floor(last)):
+            return [(self.epoch_coefficients(first), None)]
+        years, inverse = np.unique(np.floor(decimal_years), return_inverse=True)
+        epochs = np.array([self.epoch_model(year)._epoch for year in years])
+        point_epochs = epochs[inverse.reshape(-1)]
+        groups = []
+        for epoch in np.unique(point_epochs):
+            points = np.flatnonzero(point_epochs == epoch)
+            groups.append((self.epoch_coefficients(epoch), None if len(points) == len(decimal_years) else points))
+        return groups
+
+    def field_coefficients(self):
+        # Spherical harmonic coefficients of geo_mag as arrays, extracted once
+        return self.epoch_coefficients(self.decimal_year)
+
+    def lookup_field(self, lat, lon, method=None):
+        # Declination, inclination and intensity at a point or arrays of points using
+        # the selected backend: 'exact' evaluates GeoMag, 'bilinear' and 'bicubic'
+        # interpolate the sampled grid and 'adaptive' the leaves of quadtree (built by
+        # refine_grid on first use); see interpolation_error for their accuracy.
+        # Points outside a regional grid are evaluated exactly. 'bilinear' and
+        # 'adaptive' are piecewise linear: their gradients jump between cells, and
+        # Agent runs stepped on them may circle the goal without converging (Agent.Run
+        # warns when they reach max_steps).
+        if method is None:
+            method = getattr(self, 'field_lookup', 'exact')
+        scalar = isinstance(lat, (float, int, np.number)) and isinstance(lon, (float, int, np.number))
+        if method == 'exact' or (scalar and getattr(self, 'region', None) is not None
+                                 and self.outside_grid(lat, lon)):
+            if np.ndim(lat) == 0 and np.ndim(lon) == 0:
+                _, _, _, _, D, I, F = self.evaluate_model(lat, lon)
+                return D, I, F
+            field = self.evaluate_many(lat, lon)
+            return field['D'], field['I'], field['F']
+        elif method not in FIELD_LOOKUPS:
+            raise ValueError(f"Unknown field lookup {method!r}")
+        if not scalar and getattr(self, 'region', None) is not None:
+            lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+            outside = self.outside_grid(lat, lon)
+            if outside.any():
+                D, I, F = (np.array(v, dtype=float) for v in self.lookup_field(lat, lon, method='exact'))
+                inside = ~outside
+                D[inside], I[inside], F[inside] = self.lookup_field(lat[inside], lon[inside], method)
+                return D, I, F
+
+        if method == 'adaptive':
+            if getattr(self, 'quadtree', None) is None:
+                self.refine_grid()
+            if scalar:
+                cosD, sinD, I, F = self.quadtree.interpolate_point(float(lat), float(lon))
+                return math.degrees(math.atan2(sinD, cosD)), I, F
+            lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+            values = self.quadtree.interpolate(lat, lon)
+            D = np.degrees(np.arctan2(values[:, 1], values[:, 0]))
+            return D.reshape(lat.shape), values[:, 2].reshape(lat.shape), values[:, 3].reshape(lat.shape)
+
+        tables = self.lookup_tables()
+        if isinstance(lat, (float, int, np.number)) and isinstance(lon, (float, int, np.number)):
+            cosD, sinD, I, F = interpolate_point(tables, float(lat), float(lon), method)
+            return math.degrees(math.atan2(sinD, cosD)), I, F
+        lat, lon = np.broadcast_arrays(np.asarray(lat, dtype=float), np.asarray(lon, dtype=float))
+        values = interpolate_grid(tables, lat.ravel(), lon.ravel(), method)
+        D = np.degrees(np.arctan2(values[:, 1], values[:, 0]))
+        return D.reshape(lat.shape), values[:, 2].reshape(lat.shape), values[:, 3].reshape(lat.shape)
+
+    def lookup_tables(self):
+        # The samples prepared for 'bilinear' and 'bicubic' lookups (see
+        # prepare_lookup_grid), built on first use. Declination is interpolated through
+        # its cosine and sine so it stays continuous across +-180 degrees.
+        if getattr(self, '_lookup_tables', None) is None:
+            D = np.radians(self.samples['D_DECL'])
+            tables = np.stack([np.cos(D), np.sin(D), self.samples['I_INCL'], self.samples['F_TOTAL']])
+            self._lookup_tables = prepare_lookup_grid(tables, self.sample_latitudes, self.sample_longitudes)
+        return self._lookup_tables
+
+    def interpolation_error(self, method=None, n_points=10000, lat_range=(-80, 80), seed=0):
+        # Compare an interpolating lookup with exact evaluation at random points and
+        # report the maximum and root-mean-square error of each quantity. Small field
+        # errors do not make a backend safe to step agents with: see lookup_field.
+        if method is None:
+            method = getattr(self, 'field_lookup', 'exact')
+        rng = np.random.default_rng(seed)
+        lat_lo = max(lat_range[0], self.sample_latitudes[0])
+        lat_hi = min(lat_range[1], self.sample_latitudes[-1])
+        lat = rng.uniform(lat_lo, lat_hi, n_points)
+        lon = rng.uniform(self.sample_longitudes[0], self.sample_longitudes[-1], n_points)
+        exact = self.evaluate_many(lat, lon)
+        D, I, F = self.lookup_field(lat, lon, method)
+        errors = {
+            'D_DECL': (D - exact['D'] + 180) % 360 - 180,
+            'I_INCL': I - exact['I'],
+            'F_TOTAL': F - exact['F']
+        }
+        return {name: {'max': float(np.max(np.abs(err))), 'rms': float(np.sqrt(np.mean(err ** 2)))}
+                for name, err in errors.items()}
+
+    def estimate_gradients(self, lat, lon, ddeg=1e-3, method=None):
         # Estimate the intensity and inclination gradients at a location
+        # method defaults to the model's gradient_method; 'analytic' differentiates the
+        # spherical harmonic expansion directly and also accepts arrays of coordinates,
+        # 'finite' uses forward differences of size ddeg
+        if method is None:
+            method = getattr(self, 'gradient_method', 'finite')
+        if method == 'analytic':
+            return self.analytic_gradients(lat, lon)
+        elif method != 'finite':
+            raise ValueError(f"Unknown gradient method {method!r}")
         _, _, _, _, _, I1, F1 = self.evaluate_model(lat, lon)
         _, _, _, _, _, I2, F2 = self.evaluate_model(lat, lon + ddeg)
         dFdx = (F2 - F1) / ddeg
@@ -63,22 +932,25 @@ class MagneticModel:
         dIdy = (I2 - I1) / ddeg
         return dFdx, dFdy, dIdx, dIdy
 
+    def analytic_gradients(self, lat, lon):
+        # Analytic intensity and inclination gradients from one spherical harmonic
+        # evaluation, for single points or arrays. Returns dFdx, dFdy, dIdx, dIdy.
+        field = self.evaluate_many(lat, lon, gradients=True)
+        if field.ndim == 0:
+            return tuple(float(field[name]) for name in GRADIENT_COMPONENTS)
+        return tuple(field[name] for name in GRADIENT_COMPONENTS)
+
+    @Instrumentation.timed()
     def populate_samples(self):
         # Collect samples of magnetic field properties at all coordinates
-        lat = self.sample_latitudes
-        lon = self.sample_longitudes
+        lat, lon = np.meshgrid(self.sample_latitudes, self.sample_longitudes, indexing='ij')
+        field = self.evaluate_many(lat, lon)
         self.samples = {
-            'D_DECL': np.full((len(lat), len(lon)), np.nan),
-            'I_INCL': np.full((len(lat), len(lon)), np.nan),
-            'F_TOTAL': np.full((len(lat), len(lon)), np.nan)
+            'D_DECL': field['D'],
+            'I_INCL': field['I'],
+            'F_TOTAL': field['F']
         }
-
-        for i, latitude in enumerate(lat):
-            for j, longitude in enumerate(lon):
-                _, _, _, _, D, I, F = self.evaluate_model(latitude, longitude)
-                self.samples['D_DECL'][i, j] = D
-                self.samples['I_INCL'][i, j] = I
-                self.samples['F_TOTAL'][i, j] = F
+        self._lookup_tables = None
 
     #def compute_contours(self):
         # Compute magnetic field property contours
@@ -87,34 +959,55 @@ class MagneticModel:
          #   contour_matrix = contourc(self.sample_longitudes, self.sample_latitudes, self.samples[param], levels)
          #   self.contour_tables[param] = getContourLineCoordinates(contour_matrix)
 
+    @Instrumentation.timed()
     def compute_gradients(self):
         # Compute magnetic field property gradients
-        dI_INCL = np.full((2, len(self.sample_latitudes), len(self.sample_longitudes)), np.nan)
-        dF_TOTAL = np.full((2, len(self.sample_latitudes), len(self.sample_longitudes)), np.nan)
-
-        for i, lat in enumerate(self.sample_latitudes):
-            for j, lon in enumerate(self.sample_longitudes):
-                dFdx, dFdy, dIdx, dIdy = self.estimate_gradients(lat, lon)
-                dF_TOTAL[:, i, j] = [dFdx, dFdy]
-                dI_INCL[:, i, j] = [dIdx, dIdy]
+        lat, lon = np.meshgrid(self.sample_latitudes, self.sample_longitudes, indexing='ij')
+        if getattr(self, 'gradient_method', 'finite') == 'analytic':
+            dFdx, dFdy, dIdx, dIdy = self.analytic_gradients(lat, lon)
+            dF_TOTAL = np.stack([dFdx, dFdy])
+            dI_INCL = np.stack([dIdx, dIdy])
+        else:
+            # Same forward differences as estimate_gradients, evaluated a grid at a time
+            ddeg = 1e-3
+            field = self.evaluate_many(lat, lon)
+            field_x = self.evaluate_many(lat, lon + ddeg)
+            field_y = self.evaluate_many(lat + ddeg, lon)
+            dF_TOTAL = np.stack([(field_x['F'] - field['F']) / ddeg, (field_y['F'] - field['F']) / ddeg])
+            dI_INCL = np.stack([(field_x['I'] - field['I']) / ddeg, (field_y['I'] - field['I']) / ddeg])
 
         self.sample_gradients = {
             'I_INCL': dI_INCL,
             'F_TOTAL': dF_TOTAL
         }
 
-    def compute_orthogonality(self):
-        # Compute the angle in degrees between gradient vectors for inclination and intensity
-        dI_INCL = self.sample_gradients['I_INCL']
-        dF_TOTAL = self.sample_gradients['F_TOTAL']
-        orthogonality = np.full((len(self.sample_latitudes), len(self.sample_longitudes)), np.nan)
+    def sample_region(self, region=None, stride=1):
+        # Row and column slices of the sample grid covering region = (lat_min, lat_max,
+        # lon_min, lon_max) in degrees (None is the whole grid), keeping every stride-th
+        # cell; stride may also be a (lat_stride, lon_stride) pair
+        lat_stride, lon_stride = (stride, stride) if np.ndim(stride) == 0 else stride
+        if region is None:
+            return slice(None, None, lat_stride), slice(None, None, lon_stride)
+        lat_min, lat_max, lon_min, lon_max = region
+        rows = slice(np.searchsorted(self.sample_latitudes, lat_min, 'left'),
+                     np.searchsorted(self.sample_latitudes, lat_max, 'right'), lat_stride)
+        cols = slice(np.searchsorted(self.sample_longitudes, lon_min, 'left'),
+                     np.searchsorted(self.sample_longitudes, lon_max, 'right'), lon_stride)
+        return rows, cols
 
-        for i in range(len(self.sample_latitudes)):
-            for j in range(len(self.sample_longitudes)):
-                angle = self.angle_from_u_to_v(dI_INCL[:, i, j], dF_TOTAL[:, i, j])
-                orthogonality[i, j] = angle
+    @Instrumentation.timed()
+    def compute_orthogonality(self, region=None, stride=1):
+        # Compute the angle in degrees between gradient vectors for inclination and intensity.
+        # The whole grid is stored as sample_orthogonality; a region or stride (see
+        # sample_region) only computes and returns those cells.
+        rows, cols = self.sample_region(region, stride)
+        dI_INCL = self.sample_gradients['I_INCL'][:, rows, cols]
+        dF_TOTAL = self.sample_gradients['F_TOTAL'][:, rows, cols]
+        orthogonality = self.angle_from_u_to_v(dI_INCL, dF_TOTAL)
 
-        self.sample_orthogonality = orthogonality
+        if region is None and stride == 1:
+            self.sample_orthogonality = orthogonality
+        return orthogonality
 
     @staticmethod
     def angle_from_u_to_v(U, V):
@@ -125,9 +1018,12 @@ class MagneticModel:
         return np.degrees(np.arctan2(np.sin(np.radians(angle)), np.cos(np.radians(angle))))  # between -180 and 180 degrees
 
     def find_coords(self, F_TOTAL_target, I_INCL_target, lat0, lon0, options=None):
+        # The location nearest the guess (lat0, lon0) with the target intensity and
+        # inclination; see find_all_coords for every such location
         if options is None:
             options = {'xatol': 1e-16, 'fatol': 1e-16, 'maxiter': 10000, 'disp': True}
         
+        from scipy.optimize import minimize
         latlon = minimize(self.find_coords_error, [lat0, lon0], args=(F_TOTAL_target, I_INCL_target), options=options)
         return latlon.x[0], latlon.x[1]
 
@@ -136,3 +1032,68 @@ class MagneticModel:
         lon = latlon[1]
         _, _, _, _, _, I, F = self.evaluate_model(lat, lon)
         return (F - F_TOTAL_target)**2 + (I - I_INCL_target)**2
+
+    @Instrumentation.timed()
+    def find_all_coords(self, F_TOTAL_targets, I_INCL_targets, max_iterations=INVERSE_ITERATIONS,
+                        f_tolerance=INVERSE_F_TOLERANCE, i_tolerance=INVERSE_I_TOLERANCE):
+        # Every location with each target intensity (µT) and inclination (degrees),
+        # for arrays of targets at once. signature_index finds every sample cell that
+        # can hold a target; Newton steps on the exact field, all candidates advanced
+        # together, then refine the cell centres; a candidate leaving the cells around
+        # its own is dropped (that cell finds the solution if there is one), and
+        # duplicates are merged. A regional model only searches its own region.
+        # Returns a dict of 1-D arrays, one entry per solution ordered by target:
+        # 'target' (index into the flattened targets), 'lat', 'lon' and the 'F_TOTAL'
+        # and 'I_INCL' reached there.
+        F_targets, I_targets = (a.ravel() for a in np.broadcast_arrays(
+            np.asarray(F_TOTAL_targets, dtype=float), np.asarray(I_INCL_targets, dtype=float)))
+        index = self.signature_index
+        targets, cells = index.candidates(F_targets, I_targets)
+        lat_low, lat_high, lon_low, lon_high = index.cell_bounds(cells)
+        lat = (lat_low + lat_high) / 2
+        lon = (lon_low + lon_high) / 2
+        F = np.full(len(targets), np.nan)
+        I = np.full(len(targets), np.nan)
+        converged = np.zeros(len(targets), dtype=bool)
+
+        # Steps are capped at a sample cell so candidates stay near their own cell
+        max_step = self.sample_resolution
+        lat_low, lat_high = lat_low - max_step, lat_high + max_step
+        lon_low, lon_high = lon_low - max_step, lon_high + max_step
+        active = np.arange(len(targets))
+        for _ in range(max_iterations):
+            if active.size == 0:
+                break
+            field = self.evaluate_many(lat[active], lon[active], gradients=True)
+            F[active] = field['F']
+            I[active] = field['I']
+            dF = F_targets[targets[active]] - field['F']
+            dI = I_targets[targets[active]] - field['I']
+            done = (np.abs(dF) <= f_tolerance) & (np.abs(dI) <= i_tolerance)
+            converged[active[done]] = True
+
+            det = field['dFdx'] * field['dIdy'] - field['dFdy'] * field['dIdx']
+            moving = ~done & (np.abs(det) > 1e-12)
+            active, field, dF, dI, det = active[moving], field[moving], dF[moving], dI[moving], det[moving]
+            dlon = (field['dIdy'] * dF - field['dFdy'] * dI) / det
+            dlat = (field['dFdx'] * dI - field['dIdx'] * dF) / det
+            scale = np.minimum(1, max_step / np.maximum(np.hypot(dlon, dlat), 1e-300))
+            lat[active] = np.clip(lat[active] + scale * dlat, -90, 90)
+            lon[active] = lon[active] + scale * dlon
+            nearby = ((lat_low[active] <= lat[active]) & (lat[active] <= lat_high[active]) &
+                      (lon_low[active] <= lon[active]) & (lon[active] <= lon_high[active]))
+            active = active[nearby]
+
+        # One solution per target and location (longitudes wrapped to [-180, 180))
+        lon = (lon + 180) % 360 - 180
+        converged = np.flatnonzero(converged)
+        residual = np.hypot(F[converged] - F_targets[targets[converged]], I[converged] - I_targets[targets[converged]])
+        solutions = converged[merge_solutions(targets[converged], lat[converged], lon[converged], residual,
+                                              INVERSE_MERGE_DISTANCE)]
+        return {
+            'target': targets[solutions],
+            'lat': lat[solutions],
+            'lon': lon[solutions],
+            'F_TOTAL': F[solutions],
+            'I_INCL': I[solutions]
+        }
@@ -0,0 +1,120 @@
+import argparse
+import multiprocessing
+import os
+import numpy as np
+import Agent as agent
+import AxesmMagneticMap as axesmap
+from SharedGrids import SharedGrids
+
+_worker_map = None
+
+def _init_worker(magmodel, surfmesh, figsize):
+    # One headless map per process: its projection, coastlines and projected mesh are
+    # built here once and reused by every figure it renders. magmodel may be a
+    # SharedGrids handle, attached here.
+    global _worker_map
+    if isinstance(magmodel, SharedGrids):
+        magmodel = magmodel.attach()
+    _worker_map = axesmap.AxesmMagneticMap(magmodel)
+    _worker_map.initialize_axes(surfmesh=surfmesh, headless=True, figsize=figsize)
+
+def render_job(stability_map, job, path, dpi=100):
+    # Draw one job on a headless map and save it to path. A job is a dict with any of
+    #   'A': 2x2 matrix whose stability mesh is drawn
+    #   'track': (latitudes, longitudes) of an observed track
+    #   'start', 'goal': (lat, lon) markers (start defaults to the track's first fix)
+    #   'simulate': also run an Agent with A from start to goal and draw its path
+    #   'title': figure title
+    stability_map.clear_overlays()
+    A = job.get('A')
+    if A is not None:
+        stability_map.draw_stability_mesh(np.asarray(A, dtype=float))
+    track = job.get('track')
+    if track is not None:
+        stability_map.update_track(*track)
+    start = job.get('start')
+    if start is None and track is not None:
+        start = (track[0][0], track[1][0])
+    goal = job.get('goal')
+    if job.get('simulate') and start is not None and goal is not None:
+        turtle = agent.Agent(stability_map.magmodel)
+        if A is not None:
+            turtle.SetAMatrix(np.asarray(A, dtype=float))
+        turtle.SetStart(*start)
+        turtle.SetGoal(*goal)
+        turtle.Run()
+        stability_map.update_agent_trajectory(*turtle.GetTraj())
+    if start is not None:
+        stability_map.update_agent_start(*start)
+    if goal is not None:
+        stability_map.update_agent_goal(*goal)
+    stability_map.ax.set_title(job.get('title', ''))
+    stability_map.save(path, dpi)
+    return path
+
+def _render_task(args):
+    index, job, path, dpi = args
+    return index, render_job(_worker_map, job, path, dpi)
+
+def render_maps(magmodel, jobs, output_dir, names=None, fmt='png', dpi=100, processes=None,
+                surfmesh='none', figsize=(8, 6)):
+    # Render every job (see render_job) to output_dir/<name>.<fmt> (png, svg or pdf)
+    # on a process pool of the given size (None uses every core, 1 runs in this
+    # process). Each worker attaches the model's grids through SharedGrids and keeps
+    # one headless map, so the Basemap, coastlines and projected stability mesh are
+    # built once per worker instead of once per figure. names default to the job
+    # numbers. Returns the written paths in job order.
+    os.makedirs(output_dir, exist_ok=True)
+    if names is None:
+        names = [f"map_{index:04d}" for index in range(len(jobs))]
+    tasks = [(index, job, os.path.join(output_dir, f"{name}.{fmt}"), dpi)
+             for index, (job, name) in enumerate(zip(jobs, names))]
+    paths = [None] * len(tasks)
+
+    def collect(results):
+        for index, path in results:
+            paths[index] = path
+
+    if processes == 1 or len(tasks) <= 1:
+        _init_worker(magmodel, surfmesh, figsize)
+        collect(map(_render_task, tasks))
+    else:
+        with SharedGrids(magmodel) as shared:
+            with multiprocessing.Pool(processes, initializer=_init_worker,
+                                      initargs=(shared, surfmesh, figsize)) as pool:
+                collect(pool.imap_unordered(_render_task, tasks))
+    return paths
+
+if __name__ == '__main__':
+    import pandas as pd
+    import MagneticModel as magmod
+    from AMatrixFit import read_track
+
+    parser = argparse.ArgumentParser(description="Render a stability map with the track and fitted A matrix "
+                                     "of every row of an AMatrixFit results file")
+    parser.add_argument('fits', help="CSV written by AMatrixFit.py (track, a, b, c, d columns)")
+    parser.add_argument('tracks', help="directory of the .si track files")
+    parser.add_argument('--goal', type=float, nargs=2, default=(17.7, 56.3), metavar=('LAT', 'LON'))
+    parser.add_argument('--simulate', action='store_true', help="also draw the agent path under each A")
+    parser.add_argument('--format', default='png', choices=('png', 'svg', 'pdf'))
+    parser.add_argument('--dpi', type=int, default=100)
+    parser.add_argument('--processes', type=int, default=None)
+    parser.add_argument('--cache-dir', default='magmodel_cache')
+    parser.add_argument('--output-dir', default='figures')
+    args = parser.parse_args()
+
+    magmodel = magmod.MagneticModel(None, cache_dir=args.cache_dir)
+    fits = pd.read_csv(args.fits)
+    jobs = []
+    for row in fits.itertuples():
+        track = read_track(os.path.join(args.tracks, f"{row.track}.si"))
+        jobs.append({
+            'A': [[row.a, row.b], [row.c, row.d]],
+            'track': (track['latitude'].to_numpy(), track['longitude'].to_numpy()),
+            'goal': tuple(args.goal),
+            'simulate': args.simulate,
+            'title': f"{row.track}  A = [[{row.a:.2f}, {row.b:.2f}], [{row.c:.2f}, {row.d:.2f}]]"
+        })
+    paths = render_maps(magmodel, jobs, args.output_dir, fits['track'].astype(str).tolist(), args.format,
+                        args.dpi, args.processes)
+    print(f"rendered {len(paths)} maps to {args.output_dir}")
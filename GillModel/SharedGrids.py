@@ -0,0 +1,118 @@
+from multiprocessing import shared_memory
+import numpy as np
+
+# Arrays published for a model: (grid, key) pairs, key None for a plain array
+SHARED_ARRAYS = (('samples', 'D_DECL'), ('samples', 'I_INCL'), ('samples', 'F_TOTAL'),
+                 ('sample_gradients', 'I_INCL'), ('sample_gradients', 'F_TOTAL'),
+                 ('sample_orthogonality', None))
+
+# Offsets of arrays in the shared block are rounded up to this many bytes
+ALIGNMENT = 64
+
+class SharedGrids:
+    # A MagneticModel's sampled grids and lookup tables published once in one
+    # shared memory block. The object pickles to its block name and array layout (a
+    # few hundred bytes), so it can be handed to a Pool initializer; attach() in a
+    # worker returns a MagneticModel whose grids are read-only views of that block,
+    # so N workers add no grid memory. The creating process owns the block and
+    # frees it with close(), or use it as a context manager around the pool:
+    #     with SharedGrids(magmodel) as shared:
+    #         with multiprocessing.Pool(initializer=init, initargs=(shared,)) as pool:
+    #             ...
+    # and in init: magmodel = shared.attach()
+    def __init__(self, magmodel, lookup_tables=True):
+        self.settings = {
+            'sample_resolution': magmodel.sample_resolution,
+            'decimal_year': magmodel.decimal_year,
+            'height': magmodel.height,
+            'gradient_method': getattr(magmodel, 'gradient_method', 'finite'),
+            'field_lookup': getattr(magmodel, 'field_lookup', 'exact'),
+            'region': getattr(magmodel, 'region', None),
+            'quadtree_options': getattr(magmodel, '_quadtree_options', None)
+        }
+        arrays = {}
+        for grid, key in SHARED_ARRAYS:
+            value = magmodel.grid(grid)
+            arrays[(grid, key)] = value if key is None else value[key]
+        self.lookup_settings = None
+        if lookup_tables:
+            tables = magmodel.lookup_tables()
+            self.lookup_settings = {name: value for name, value in tables.items() if name != 'tables'}
+            arrays[('lookup_tables', 'tables')] = tables['tables']
+
+        self.layout = []
+        size = 0
+        for name, value in arrays.items():
+            value = np.asarray(value)
+            self.layout.append((name, size, value.shape, value.dtype.str))
+            size += -(-value.nbytes // ALIGNMENT) * ALIGNMENT
+        self._memory = shared_memory.SharedMemory(create=True, size=max(size, 1))
+        self.name = self._memory.name
+        self.nbytes = size
+        self._owner = True
+        for (name, offset, shape, dtype), value in zip(self.layout, arrays.values()):
+            view = np.ndarray(shape, dtype, buffer=self._memory.buf, offset=offset)
+            view[...] = value
+            del view
+
+    def __getstate__(self):
+        state = dict(self.__dict__)
+        state['_memory'] = None
+        state['_owner'] = False
+        return state
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def arrays(self):
+        # Read-only views of every published array, keyed by (grid, key)
+        if self._memory is None:
+            self._memory = shared_memory.SharedMemory(name=self.name)
+        views = {}
+        for name, offset, shape, dtype in self.layout:
+            view = np.ndarray(shape, dtype, buffer=self._memory.buf, offset=offset)
+            view.flags.writeable = False
+            views[name] = view
+        return views
+
+    def attach(self):
+        # A MagneticModel with the published settings whose grids (and lookup tables)
+        # are views of the shared block. Exact evaluation, set_date and refine_grid
+        # work as usual; anything they rebuild is private to this process.
+        import MagneticModel as magmod
+
+        settings = self.settings
+        magmodel = magmod.MagneticModel(settings['sample_resolution'], gradient_method=settings['gradient_method'],
+                                        field_lookup=settings['field_lookup'], region=settings['region'])
+        magmodel.height = settings['height']
+        magmodel.set_date(settings['decimal_year'])
+        views = self.arrays()
+        magmodel.samples = {key: views[('samples', key)] for key in ('D_DECL', 'I_INCL', 'F_TOTAL')}
+        magmodel.sample_gradients = {key: views[('sample_gradients', key)] for key in ('I_INCL', 'F_TOTAL')}
+        magmodel.sample_orthogonality = views[('sample_orthogonality', None)]
+        if self.lookup_settings is not None:
+            magmodel._lookup_tables = dict(self.lookup_settings, tables=views[('lookup_tables', 'tables')])
+        # A refined model's quadtree is rebuilt here, with the same options, on first use
+        magmodel._quadtree_options = settings['quadtree_options']
+        # The views stay valid while the model holds the mapping
+        magmodel.shared_grids = self
+        return magmodel
+
+    def close(self):
+        # Release the block: the owner unlinks it (attached workers keep their
+        # mappings until they exit), other processes only unmap it
+        if self._memory is None:
+            return
+        if self._owner:
+            self._memory.unlink()
+            self._owner = False
+        try:
+            self._memory.close()
+        except BufferError:
+            # Views attached in this process are still alive; the mapping stays until
+            # they are gone
+            return
+        self._memory = None
@@ -0,0 +1,58 @@
+import numpy as np
+
+# Linear stability classes of the goal-seeking flow, with the values that
+# AxesmMagneticMap has always drawn on its 'summer' colormap
+STABLE_NODE = 0  # dark green
+SPIRAL_SINK = 0.25  # medium green
+NEUTRAL = 0.5  # neutrally stable
+SPIRAL_SOURCE = 0.75  # light green
+UNSTABLE_NODE = 1  # yellow
+STABILITY_CLASSES = (STABLE_NODE, SPIRAL_SINK, NEUTRAL, SPIRAL_SOURCE, UNSTABLE_NODE)
+STABILITY_LABELS = ('stable node', 'spiral sink', 'neutral', 'spiral source', 'unstable node')
+
+# Eigenvalue real parts within this of zero count as zero, as with np.linalg.eig before
+EIGEN_TOL = 1e-12
+
+def jacobian_eigenvalues(J00, J01, J10, J11):
+    # Real parts of both eigenvalues of 2x2 matrices given elementwise, and whether
+    # they are a complex pair, from the trace, determinant and discriminant
+    tr = J00 + J11
+    det = J00 * J11 - J01 * J10
+    disc = tr * tr - 4 * det
+    rotation = disc < 0
+    sq = np.sqrt(np.where(rotation, 0.0, disc))
+    # Larger-magnitude root first, then det / root, to avoid cancellation
+    q = (tr + np.copysign(sq, tr)) / 2
+    safe_q = np.where(q == 0, 1.0, q)
+    re1 = np.where(rotation, tr / 2, q)
+    re2 = np.where(rotation, tr / 2, np.where(q == 0, 0.0, det / safe_q))
+    return re1, re2, rotation
+
+def classify_stability(A, dF, dI):
+    # Classify the Jacobian -A @ [[dF/dx, dF/dy], [dI/dx, dI/dy]] at every cell.
+    # A is a 2x2 matrix or a stack shaped (..., 2, 2); dF and dI are gradients shaped
+    # (2, ...) as in MagneticModel.sample_gradients. Returns one of STABILITY_CLASSES
+    # per cell, shaped A.shape[:-2] + dF.shape[1:], NaN where the gradients are.
+    A = np.asarray(A, dtype=float)
+    dF = np.asarray(dF, dtype=float)
+    dI = np.asarray(dI, dtype=float)
+    expand = (Ellipsis,) + (None,) * (dF.ndim - 1)
+    a, b = A[..., 0, 0][expand], A[..., 0, 1][expand]
+    c, d = A[..., 1, 0][expand], A[..., 1, 1][expand]
+    J00 = -(a * dF[0] + b * dI[0])
+    J01 = -(a * dF[1] + b * dI[1])
+    J10 = -(c * dF[0] + d * dI[0])
+    J11 = -(c * dF[1] + d * dI[1])
+    re1, re2, rotation = jacobian_eigenvalues(J00, J01, J10, J11)
+
+    unstable = (re1 > EIGEN_TOL) | (re2 > EIGEN_TOL)
+    degenerate = (np.abs(re1) < EIGEN_TOL) | (np.abs(re2) < EIGEN_TOL)
+    stability = np.where(unstable,
+                         np.where(rotation, SPIRAL_SOURCE, UNSTABLE_NODE),
+                         np.where(degenerate, NEUTRAL, np.where(rotation, SPIRAL_SINK, STABLE_NODE)))
+    return np.where(np.isnan(re1) | np.isnan(re2), np.nan, stability)
+
+def stability_codes(stability):
+    # Compact uint8 codes 0..4 indexing STABILITY_CLASSES (255 where undefined)
+    codes = np.rint(np.nan_to_num(stability, nan=-1.0) * 4)
+    return np.where(codes < 0, 255, codes).astype(np.uint8)
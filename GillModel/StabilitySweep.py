@@ -0,0 +1,107 @@
+import multiprocessing
+import numpy as np
+import Stability as stability
+
+# Matrix-location pairs classified per chunk (bounds temporary memory per worker)
+SWEEP_CHUNK_ELEMENTS = 2 ** 21
+
+_worker_gradients = None
+
+def location_gradients(magmodel, lats, lons):
+    # Analytic gradients at a list of locations, as (dF, dI) each shaped (2, n)
+    dFdx, dFdy, dIdx, dIdy = magmodel.analytic_gradients(np.asarray(lats, dtype=float), np.asarray(lons, dtype=float))
+    return np.stack([dFdx, dFdy]), np.stack([dIdx, dIdy])
+
+def grid_gradients(magmodel):
+    # Gradients of every sampled grid cell, flattened to (2, n_cells) each, or of
+    # every quadtree leaf when the model has been refined
+    quadtree = getattr(magmodel, 'quadtree', None)
+    gradients = magmodel.sample_gradients if quadtree is None else quadtree.gradients
+    dF = gradients['F_TOTAL']
+    dI = gradients['I_INCL']
+    return dF.reshape(2, -1), dI.reshape(2, -1)
+
+def _init_worker(dF, dI):
+    global _worker_gradients
+    _worker_gradients = (dF, dI)
+
+def _classify_chunk(args):
+    # Classify matrices [start, stop) of the flattened (a, b, c, d) sweep at every location
+    start, stop, axes, store_classes, matrix_counts = args
+    dF, dI = _worker_gradients
+    index = np.unravel_index(np.arange(start, stop), tuple(len(v) for v in axes))
+    A = np.empty((stop - start, 2, 2))
+    A[:, 0, 0], A[:, 0, 1], A[:, 1, 0], A[:, 1, 1] = (values[i] for values, i in zip(axes, index))
+    codes = stability.stability_codes(stability.classify_stability(A, dF, dI))
+    n_classes = len(stability.STABILITY_CLASSES)
+    location_counts = np.stack([np.count_nonzero(codes == k, axis=0) for k in range(n_classes)], axis=1)
+    per_matrix = None
+    if matrix_counts:
+        per_matrix = np.stack([np.count_nonzero(codes == k, axis=1) for k in range(n_classes)], axis=1)
+    return start, stop, codes if store_classes else None, location_counts, per_matrix
+
+def sweep_stability(a_values, b_values, c_values, d_values, dF, dI, store_classes=True,
+                    matrix_counts=False, processes=None, chunk_elements=SWEEP_CHUNK_ELEMENTS):
+    # Classify every A = [[a, b], [c, d]] from the given value ranges at every location
+    # whose gradients are given as dF, dI shaped (2, n_locations).
+    # Returns a dict with the value axes and
+    #   'classes': uint8 codes shaped (len(a), len(b), len(c), len(d), n_locations)
+    #              (only with store_classes; n_matrices * n_locations bytes)
+    #   'location_counts': (n_locations, 5) matrices per class at each location
+    #   'matrix_counts': (len(a), len(b), len(c), len(d), 5) locations per class for
+    #              each matrix (only with matrix_counts, e.g. for full-grid atlases)
+    #   'counts': (5,) totals per class
+    # Chunks run on a process pool of the given size (None uses every core, 1 runs
+    # in this process).
+    axes = [np.asarray(v, dtype=float) for v in (a_values, b_values, c_values, d_values)]
+    dF = np.asarray(dF, dtype=float).reshape(2, -1)
+    dI = np.asarray(dI, dtype=float).reshape(2, -1)
+    shape = tuple(len(v) for v in axes)
+    n_matrices = int(np.prod(shape))
+    n_locations = dF.shape[1]
+    n_classes = len(stability.STABILITY_CLASSES)
+
+    chunk = max(1, chunk_elements // n_locations)
+    tasks = [(start, min(start + chunk, n_matrices), axes, store_classes, matrix_counts)
+             for start in range(0, n_matrices, chunk)]
+    classes = np.empty((n_matrices, n_locations), dtype=np.uint8) if store_classes else None
+    per_matrix = np.empty((n_matrices, n_classes), dtype=np.int64) if matrix_counts else None
+    location_counts = np.zeros((n_locations, n_classes), dtype=np.int64)
+
+    def collect(results):
+        for start, stop, codes, counts, matrix_chunk in results:
+            if store_classes:
+                classes[start:stop] = codes
+            if matrix_counts:
+                per_matrix[start:stop] = matrix_chunk
+            location_counts[...] += counts
+
+    if processes == 1 or len(tasks) == 1:
+        _init_worker(dF, dI)
+        collect(map(_classify_chunk, tasks))
+    else:
+        with multiprocessing.Pool(processes, initializer=_init_worker, initargs=(dF, dI)) as pool:
+            collect(pool.imap_unordered(_classify_chunk, tasks))
+
+    result = {
+        'a_values': axes[0], 'b_values': axes[1], 'c_values': axes[2], 'd_values': axes[3],
+        'location_counts': location_counts,
+        'counts': location_counts.sum(axis=0)
+    }
+    if store_classes:
+        result['classes'] = classes.reshape(shape + (n_locations,))
+    if matrix_counts:
+        result['matrix_counts'] = per_matrix.reshape(shape + (n_classes,))
+    return result
+
+def save_sweep(path, result, **extra):
+    # Write a sweep result (plus any extra arrays, e.g. goal coordinates) to a
+    # compressed .npz file
+    np.savez_compressed(path, class_values=np.array(stability.STABILITY_CLASSES),
+                        class_labels=np.array(stability.STABILITY_LABELS), **result, **extra)
+
+def print_summary(result):
+    # Print how many (matrix, location) pairs fell into each stability class
+    total = result['counts'].sum()
+    for label, count in zip(stability.STABILITY_LABELS, result['counts']):
+        print(f"{label:>14}: {count} ({100 * count / total:.2f}%)")
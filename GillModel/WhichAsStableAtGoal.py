@@ -1,46 +1,29 @@
 import MagneticModel as magmod
+import StabilitySweep as sweep
 import numpy as np
-import csv
-def compute_stability(a):
-    Jg = -a.dot(np.array([[dFdx , dFdy], [dIdx, dIdy]]))
-    ev,_=np.linalg.eig(Jg)
-    evreal = np.real(ev)
-    evimag = np.imag(ev)
-    is_unstable = evreal[0] > 1e-12 or evreal[1] > 1e-12
-    is_degenerate = abs(evreal[0]) < 1e-12 or abs(evreal[1]) < 1e-12
-    has_rotation = evimag[0] != 0 or evimag[1] != 0
 
-    if is_unstable:
-        if has_rotation:
-            return 0.75  # Spiral source (light green)
-        else:
-            return 1  # Unstable node (yellow)
-    else:
-        if is_degenerate:
-            return 0.5  # Neutrally stable
-        else:
-            if has_rotation:
-                return 0.25  # Spiral sink (medium green)
-            else:
-                return 0  # Stable node (dark green)
+# Goals to classify every A matrix at, and the range/step of each A entry
+goals = [(17.7, 56.3)]  # Oman
+values = np.arange(-10, 10, 1)
+full_grid = False  # also count classes over every cell of the sampled grid
 
-magmodel=magmod.MagneticModel(None)
-goal_lat,goal_lon=17.7,56.3
-dFdx, dFdy, dIdx, dIdy =  magmodel.estimate_gradients(17.7,56.3, ddeg=1e-3)
-print(dFdx*dIdy-dFdy*dIdx)
-print(dFdx, dFdy, dIdx, dIdy )
-# Open CSV file in write mode
-with open('stability_results.csv', mode='w', newline='') as file:
-    writer = csv.writer(file)
-    
-    # Write header row
-    writer.writerow(['av', 'bv', 'cv', 'dv', 'A Matrix', 'Stability'])
-    for av in range(-10,10):
-        for bv in range(-10,10):
-            for cv in range(-10,10):
-                for dv in range(-10,10):
-                    aMat = np.array([[av, bv], [cv, dv]])
-                    stability = compute_stability(aMat)
-                        
-                        # Write the matrix and stability to the CSV file
-                    writer.writerow([av, bv, cv, dv, aMat.tolist(), stability])
\ No newline at end of file
+if __name__ == '__main__':
+    # The field cache serves location_gradients the goal evaluated just above
+    magmodel=magmod.MagneticModel(None, cache_dir='magmodel_cache', field_cache=True)
+    goal_lat,goal_lon=goals[0]
+    dFdx, dFdy, dIdx, dIdy =  magmodel.analytic_gradients(goal_lat, goal_lon)
+    print(dFdx*dIdy-dFdy*dIdx)
+    print(dFdx, dFdy, dIdx, dIdy )
+
+    lats, lons = zip(*goals)
+    dF, dI = sweep.location_gradients(magmodel, lats, lons)
+    result = sweep.sweep_stability(values, values, values, values, dF, dI)
+    sweep.save_sweep('stability_results.npz', result, goals=np.array(goals))
+    sweep.print_summary(result)
+
+    if full_grid:
+        dF, dI = sweep.grid_gradients(magmodel)
+        atlas = sweep.sweep_stability(values, values, values, values, dF, dI, store_classes=False, matrix_counts=True)
+        sweep.save_sweep('stability_atlas.npz', atlas,
+                         sample_latitudes=magmodel.sample_latitudes, sample_longitudes=magmodel.sample_longitudes)
+        sweep.print_summary(atlas)
@@ -1,14 +1,10 @@
 import Agent as agent
 import numpy as np
-import pickle
 import MagneticModel as magmod
 import AxesmMagneticMap as axesmap
 # Example Usage
-#magmodel=magmod.MagneticModel(1.0)
-#with open('magmodel.pkl', 'wb') as file:
-#    pickle.dump(magmodel, file)
-with open('magmodel.pkl', 'rb') as file:
-    magmodel = pickle.load(file)
+# The sampled grids are built once and memory mapped from magmodel_cache afterwards
+magmodel=magmod.MagneticModel(1.0, cache_dir='magmodel_cache', field_cache=True)
 map = axesmap.AxesmMagneticMap(magmodel)
 map.initialize_axes()
 #Slat,Slon=-5.2367, -35.4049  # Brazil coast
@@ -24,13 +20,20 @@ Turtle.SetAMatrix(np.array([[1, 0], [0, 1]])) #stable node
 Turtle.SetStart(Slat,Slon)
 Turtle.SetGoal(Glat,Glon)
 Turtle.Reset()
-#Turtle.Step(50000)
-Turtle.Run()
-Lats,Longs=Turtle.GetTraj()
-map.update_agent_start(Slat,Slon)  
-map.update_agent_goal(Glat,Glon)  
-map.update_agent_trajectory(Lats,Longs)
-map.draw_stability_mesh(Turtle.A)
+animate = False  # watch the agent move (blitted) instead of drawing the finished path
+if animate:
+    map.draw_stability_mesh(Turtle.A)
+    map.update_agent_start(Slat,Slon)
+    map.update_agent_goal(Glat,Glon)
+    map.animate_agents([Turtle], steps_per_frame=5)
+else:
+    #Turtle.Step(50000)
+    Turtle.Run()
+    Lats,Longs=Turtle.GetTraj()
+    map.update_agent_start(Slat,Slon)
+    map.update_agent_goal(Glat,Glon)
+    map.update_agent_trajectory(Lats,Longs)
+    map.draw_stability_mesh(Turtle.A)
 map.show()
 
 #map.update_agent_start(-21.115141, 55.536384)  # Example coordinates for Reunion
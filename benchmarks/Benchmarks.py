@@ -0,0 +1,459 @@
+import argparse
+import importlib
+import json
+import os
+import pickle
+import platform
+import sys
+import tempfile
+import time
+import tracemalloc
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+
+HERE = os.path.dirname(os.path.abspath(__file__))
+REPO = os.path.dirname(HERE)
+# GillModel first: ConLogModel carries identical copies of the modules they share
+sys.path[:0] = [os.path.join(REPO, 'GillModel'), os.path.join(REPO, 'ConLogModel')]
+
+import matplotlib
+matplotlib.use('Agg')
+import MagneticModel as magmod
+import Agent as agent
+import AxesmMagneticMap as axesmap
+import BasinMap as basin
+import MapRenderer as renderer
+from SharedGrids import SharedGrids
+import StabilitySweep as sweep
+import ScrambledPaths as scrambled
+from Bathymetry import GebcoBathymetry
+from scipy.io import netcdf_file
+
+# Stored results compared against, written by --save
+BASELINE = os.path.join(HERE, 'baseline.json')
+
+# Fixed inputs: everything is synthetic or computed from the bundled WMM
+# coefficients, so the suite runs offline
+BENCH_DATE = '2025-06-01'
+GRID_RESOLUTION = 2.0  # degrees
+START = (-21.115141, 55.536384)  # Reunion
+GOAL = (17.7, 56.3)  # Oman
+TRACK_STEPS = 500
+N_PATHS = 101
+SWEEP_VALUES = np.arange(-3, 3)
+BASIN_REGION = (-30, 30, 30, 80)  # lat_min, lat_max, lon_min, lon_max
+INVERSE_TARGETS = 200
+UNALIGNED_REGION = (-30, 30.7, 30, 80.6)  # extent not a whole number of grid cells
+LOOKUP_POINTS = 2000
+GEBCO_SPACING = 0.1  # degrees
+SEED = 0
+
+# Timed samples per benchmark (the fastest counts), the shortest a sample may be
+# (quick benchmarks call the code several times per sample), and how much slower or
+# larger than the baseline a result may be before it is reported as a regression
+REPEATS = 5
+MIN_SAMPLE_TIME = 0.1  # seconds
+TOLERANCE = 1.5
+
+BENCHMARKS = {}
+
+def benchmark(unit):
+    # Register a benchmark: a function of the Fixtures returning a callable that runs
+    # the code under test once and returns how many units it processed
+    def register(function):
+        BENCHMARKS[function.__name__] = (unit, function)
+        return function
+    return register
+
+def synthetic_track(n_steps=TRACK_STEPS, seed=SEED):
+    # A cleaned track (datetime, latitude, longitude) drifting from START to GOAL
+    # with random jitter, one fix every 6 hours
+    rng = np.random.default_rng(seed)
+    t = np.linspace(0, 1, n_steps)
+    lat = START[0] + (GOAL[0] - START[0]) * t + np.cumsum(rng.normal(0, 0.05, n_steps))
+    lon = START[1] + (GOAL[1] - START[1]) * t + np.cumsum(rng.normal(0, 0.05, n_steps))
+    return pd.DataFrame({
+        'datetime': pd.Timestamp(BENCH_DATE) + pd.to_timedelta(6 * np.arange(n_steps), unit='h'),
+        'latitude': lat,
+        'longitude': lon
+    })
+
+def write_synthetic_gebco(path, spacing=GEBCO_SPACING):
+    # A global GEBCO_08 style netCDF grid of smooth synthetic depths
+    nx, ny = int(round(360 / spacing)), int(round(180 / spacing))
+    lat = 90 - (np.arange(ny) + 0.5) * spacing
+    lon = -180 + (np.arange(nx) + 0.5) * spacing
+    z = (-4000 * np.cos(np.radians(lat))[:, None] * (1 + 0.5 * np.cos(np.radians(3 * lon)))[None, :])
+    file = netcdf_file(path, 'w')
+    file.createDimension('side', 2)
+    file.createDimension('xysize', nx * ny)
+    for name, value, dtype in (('x_range', [-180, 180], 'd'), ('y_range', [-90, 90], 'd'),
+                               ('spacing', [spacing, spacing], 'd'), ('dimension', [nx, ny], 'i')):
+        variable = file.createVariable(name, dtype, ('side',))
+        variable[:] = value
+    variable = file.createVariable('z', 'h', ('xysize',))
+    variable[:] = z.astype(np.int16).ravel()
+    file.close()
+
+class Fixtures:
+    # Inputs shared by the benchmarks, each built on first use
+    def __init__(self, workdir):
+        self.workdir = workdir
+        self._cache = {}
+
+    def get(self, name, build):
+        if name not in self._cache:
+            self._cache[name] = build()
+        return self._cache[name]
+
+    def model(self):
+        def build():
+            model = magmod.MagneticModel(GRID_RESOLUTION, BENCH_DATE)
+            # Build the lazily computed grids up front, outside every measurement
+            model.samples, model.sample_gradients, model.sample_orthogonality
+            return model
+        return self.get('model', build)
+
+    def agent(self):
+        def build():
+            turtle = agent.Agent(self.model())
+            turtle.SetStart(*START)
+            turtle.SetGoal(*GOAL)
+            # Evaluate the lazily computed start and goal fields now, so agent_run
+            # counts only the evaluations of the run itself
+            turtle.StartField()
+            turtle.GoalField()
+            return turtle
+        return self.get('agent', build)
+
+    def track(self):
+        return self.get('track', synthetic_track)
+
+    def paths(self):
+        return self.get('paths', lambda: scrambled.null_path_table(self.track(), N_PATHS, SEED, 'T00000'))
+
+    def bathymetry(self):
+        def build():
+            path = os.path.join(self.workdir, 'gebco_synthetic.nc')
+            write_synthetic_gebco(path)
+            return GebcoBathymetry(path)
+        return self.get('bathymetry', build)
+
+@benchmark('points')
+def populate_samples(fx):
+    model = fx.model()
+    def run():
+        model.populate_samples()
+        return model.samples['F_TOTAL'].size
+    return run
+
+@benchmark('points')
+def compute_gradients(fx):
+    model = fx.model()
+    def run():
+        model.compute_gradients()
+        return model.samples['F_TOTAL'].size
+    return run
+
+@benchmark('points')
+def compute_orthogonality(fx):
+    model = fx.model()
+    def run():
+        return model.compute_orthogonality().size
+    return run
+
+@benchmark('steps')
+def agent_run(fx):
+    turtle = fx.agent()
+    def run():
+        turtle.Reset()
+        turtle.Run()
+        return len(turtle.trajectory_lat) - 1
+    return run
+
+@benchmark('runs')
+def agent_run_adaptive(fx):
+    # The agent_run trip with the adaptive LSODA integrator; compare the field
+    # evaluations (model calls) with agent_run's
+    turtle = fx.agent()
+    # Import scipy's solvers outside the measurement
+    importlib.import_module('scipy.integrate')
+    def run():
+        turtle.Run(integrator='LSODA')
+        return 1
+    return run
+
+@benchmark('points')
+def agent_compute_velocities(fx):
+    turtle = fx.agent()
+    def run():
+        return turtle.ComputeVelocities()[0].size
+    return run
+
+@benchmark('points')
+def calculate_stability(fx):
+    stability_map = axesmap.AxesmMagneticMap(fx.model())
+    def run():
+        stability_map.stability = None
+        return stability_map.calculate_stability(np.array([[1, 0], [0, 1]])).size
+    return run
+
+@benchmark('pairs')
+def a_matrix_sweep(fx):
+    dF, dI = sweep.grid_gradients(fx.model())
+    def run():
+        result = sweep.sweep_stability(SWEEP_VALUES, SWEEP_VALUES, SWEEP_VALUES, SWEEP_VALUES, dF, dI,
+                                       store_classes=False, processes=1)
+        return int(result['counts'].sum())
+    return run
+
+@benchmark('agent steps')
+def basin_map(fx):
+    model = fx.model()
+    def run():
+        result = basin.basin_map(model, GOAL, region=BASIN_REGION, field_lookup='bilinear', processes=1)
+        return int(result['steps'].sum())
+    return run
+
+@benchmark('targets')
+def inverse_lookup(fx):
+    model = fx.model()
+    rng = np.random.default_rng(SEED)
+    field = model.evaluate_many(rng.uniform(-80, 80, INVERSE_TARGETS), rng.uniform(-180, 180, INVERSE_TARGETS))
+    model.signature_index
+    def run():
+        model.find_all_coords(field['F'], field['I'])
+        return INVERSE_TARGETS
+    return run
+
+@benchmark('points')
+def regional_lookup(fx):
+    # Bicubic lookups on a regional grid whose extent is not a whole number of cells.
+    # Also checks that the error in the strip along its northern and eastern edges
+    # stays at the level of the interior, i.e. the lookups read the right cells there.
+    model = fx.get('unaligned_model', lambda: magmod.MagneticModel(1.0, BENCH_DATE, region=UNALIGNED_REGION))
+    lat_min, lat_max, lon_min, lon_max = UNALIGNED_REGION
+    rng = np.random.default_rng(SEED)
+    lat = rng.uniform(lat_min, lat_max, LOOKUP_POINTS)
+    lon = rng.uniform(lon_min, lon_max, LOOKUP_POINTS)
+    edge = (lat > lat_max - model.sample_resolution) | (lon > lon_max - model.sample_resolution)
+    exact = model.evaluate_many(lat, lon)
+    for method in ('bilinear', 'bicubic'):
+        _, I, F = model.lookup_field(lat, lon, method)
+        for name, error in (('I', np.abs(I - exact['I'])), ('F', np.abs(F - exact['F']))):
+            if error[edge].max() > 2 * error[~edge].max():
+                raise RuntimeError(f"{method} lookup error of {name} at the edge of {UNALIGNED_REGION} is "
+                                   f"{error[edge].max():.3g}, against {error[~edge].max():.3g} inside")
+    def run():
+        model.lookup_field(lat, lon, 'bicubic')
+        return LOOKUP_POINTS
+    return run
+
+@benchmark('attaches')
+def shared_grids_attach(fx):
+    # What a pool worker pays to start: unpickle the handle and attach a model
+    shared = fx.get('shared_grids', lambda: SharedGrids(fx.model()))
+    handle = pickle.dumps(shared)
+    def run():
+        pickle.loads(handle).attach()
+        return 1
+    return run
+
+@benchmark('maps')
+def render_map(fx):
+    # One headless PNG with a stability mesh and track, on a map reused across figures
+    stability_map = axesmap.AxesmMagneticMap(fx.model())
+    stability_map.initialize_axes(surfmesh='none', headless=True)
+    track = fx.track()
+    job = {'A': np.array([[8, -4], [1, 0]]) / 10, 'track': (track['latitude'], track['longitude']), 'goal': GOAL}
+    path = os.path.join(fx.workdir, 'map.png')
+    def run():
+        stability_map.stability = None
+        renderer.render_job(stability_map, job, path)
+        return 1
+    return run
+
+@benchmark('maps')
+def regional_maps(fx):
+    # Two regional (Mercator) maps in a row, each with its own axes; also checks that
+    # a later map in the same process does not reuse an earlier map's artists
+    model = fx.get('regional_model', lambda: magmod.MagneticModel(GRID_RESOLUTION, BENCH_DATE, region=BASIN_REGION))
+    def run():
+        for _ in range(2):
+            regional_map = axesmap.AxesmMagneticMap(model)
+            regional_map.initialize_axes(surfmesh='stability', headless=True)
+        return 2
+    return run
+
+@benchmark('frames')
+def animation_frame(fx):
+    # One blitted frame of four animated trajectories over a stability map
+    stability_map = axesmap.AxesmMagneticMap(fx.model())
+    stability_map.initialize_axes(surfmesh='stability', headless=True)
+    stability_map.start_animation(4)
+    track = fx.track()
+    for i in range(4):
+        stability_map.append_positions(i, track['latitude'] + 5 * i, track['longitude'])
+    def run():
+        stability_map.draw_frame()
+        return 1
+    return run
+
+@benchmark('rows')
+def scrambled_paths(fx):
+    track = fx.track()
+    def run():
+        return len(scrambled.null_path_table(track, N_PATHS, SEED, 'T00000'))
+    return run
+
+@benchmark('rows')
+def bathymetry_annotation(fx):
+    paths, bathymetry = fx.paths(), fx.bathymetry()
+    def run():
+        return len(scrambled.add_environment(paths.copy(), bathymetry=bathymetry))
+    return run
+
+@benchmark('rows')
+def field_annotation(fx):
+    paths, model = fx.paths(), fx.model()
+    def run():
+        return len(scrambled.add_environment(paths.copy(), magmodel=model))
+    return run
+
+@contextmanager
+def count_field_calls():
+    # Count evaluate_model calls and points passed to evaluate_many while active
+    counts = {'evaluate_model_calls': 0, 'evaluate_many_points': 0}
+    evaluate_model = magmod.MagneticModel.evaluate_model
+    evaluate_many = magmod.MagneticModel.evaluate_many
+
+    def counted_model(self, lat, lon):
+        counts['evaluate_model_calls'] += 1
+        return evaluate_model(self, lat, lon)
+
+    def counted_many(self, lats, lons, *args, **kwargs):
+        counts['evaluate_many_points'] += int(np.broadcast(np.asarray(lats), np.asarray(lons)).size)
+        return evaluate_many(self, lats, lons, *args, **kwargs)
+
+    magmod.MagneticModel.evaluate_model = counted_model
+    magmod.MagneticModel.evaluate_many = counted_many
+    try:
+        yield counts
+    finally:
+        magmod.MagneticModel.evaluate_model = evaluate_model
+        magmod.MagneticModel.evaluate_many = evaluate_many
+
+def run_benchmark(name, fx, repeats=REPEATS, min_sample_time=MIN_SAMPLE_TIME):
+    # One untimed run under tracemalloc and the call counters, then the fastest of
+    # repeats timed samples, each as many calls as take min_sample_time
+    unit, function = BENCHMARKS[name]
+    run = function(fx)
+    with count_field_calls() as counts:
+        tracemalloc.start()
+        run()
+        _, peak = tracemalloc.get_traced_memory()
+        tracemalloc.stop()
+    start = time.perf_counter()
+    units = run()
+    number = max(1, int(np.ceil(min_sample_time / (time.perf_counter() - start))))
+    best = np.inf
+    for _ in range(repeats):
+        start = time.perf_counter()
+        for _ in range(number):
+            run()
+        best = min(best, (time.perf_counter() - start) / number)
+    return {
+        'unit': unit,
+        'units': units,
+        'seconds': best,
+        'throughput': units / best,
+        'peak_memory_mb': peak / 2 ** 20,
+        **counts
+    }
+
+def machine_info():
+    return {
+        'platform': platform.platform(),
+        'processor': platform.processor() or platform.machine(),
+        'python': platform.python_version(),
+        'numpy': np.__version__,
+        'cpus': os.cpu_count()
+    }
+
+def compare(results, baseline, tolerance=TOLERANCE):
+    # Regressions against the baseline: throughput down or peak memory up by more
+    # than tolerance, or more field evaluations than before (these are deterministic)
+    regressions = []
+    for name, result in results.items():
+        base = baseline.get(name)
+        if base is None:
+            continue
+        if result['throughput'] * tolerance < base['throughput']:
+            regressions.append(f"{name}: {result['throughput']:.4g} {result['unit']}/s, "
+                               f"baseline {base['throughput']:.4g}")
+        if result['peak_memory_mb'] > tolerance * base['peak_memory_mb'] + 1:
+            regressions.append(f"{name}: peak memory {result['peak_memory_mb']:.1f} MiB, "
+                               f"baseline {base['peak_memory_mb']:.1f}")
+        for counter in ('evaluate_model_calls', 'evaluate_many_points'):
+            if result[counter] > base.get(counter, result[counter]):
+                regressions.append(f"{name}: {result[counter]} {counter}, baseline {base[counter]}")
+    return regressions
+
+def print_results(results, baseline):
+    print(f"{'benchmark':<26}{'throughput':>16}{'vs base':>9}{'peak MiB':>10}{'model calls':>13}{'many points':>13}")
+    for name, result in results.items():
+        base = baseline.get(name)
+        ratio = f"{result['throughput'] / base['throughput']:.2f}x" if base else '-'
+        throughput = f"{result['throughput']:.4g} {result['unit']}/s"
+        print(f"{name:<26}{throughput:>16}{ratio:>9}{result['peak_memory_mb']:>10.1f}"
+              f"{result['evaluate_model_calls']:>13}{result['evaluate_many_points']:>13}")
+
+def load_baseline(path):
+    try:
+        with open(path) as file:
+            return json.load(file)
+    except FileNotFoundError:
+        return {'machine': None, 'benchmarks': {}}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Time the modelling hot paths on fixed synthetic inputs "
+                                     "and compare them with a stored baseline")
+    parser.add_argument('names', nargs='*', help=f"benchmarks to run (default all: {', '.join(BENCHMARKS)})")
+    parser.add_argument('--repeats', type=int, default=REPEATS)
+    parser.add_argument('--baseline', default=BASELINE)
+    parser.add_argument('--tolerance', type=float, default=TOLERANCE,
+                        help="slowdown or memory growth factor reported as a regression")
+    parser.add_argument('--save', action='store_true', help="store these results as the baseline")
+    parser.add_argument('--json', help="also write the results to this file")
+    args = parser.parse_args()
+
+    names = args.names or list(BENCHMARKS)
+    unknown = set(names) - set(BENCHMARKS)
+    if unknown:
+        parser.error(f"unknown benchmarks: {', '.join(sorted(unknown))}")
+    baseline = load_baseline(args.baseline)
+    with tempfile.TemporaryDirectory() as workdir:
+        fx = Fixtures(workdir)
+        results = {name: run_benchmark(name, fx, args.repeats) for name in names}
+        if 'bathymetry' in fx._cache:
+            fx.bathymetry().close()
+        if 'shared_grids' in fx._cache:
+            fx._cache['shared_grids'].close()
+
+    print_results(results, baseline['benchmarks'])
+    if args.json:
+        with open(args.json, 'w') as file:
+            json.dump({'machine': machine_info(), 'benchmarks': results}, file, indent=1)
+    if args.save:
+        stored = dict(baseline['benchmarks'])
+        stored.update(results)
+        with open(args.baseline, 'w') as file:
+            json.dump({'machine': machine_info(), 'benchmarks': stored}, file, indent=1, sort_keys=True)
+        sys.exit(0)
+    if baseline['machine'] is not None and baseline['machine'] != machine_info():
+        print("Baseline was recorded on a different machine; throughput ratios are indicative only")
+    regressions = compare(results, baseline['benchmarks'], args.tolerance)
+    for regression in regressions:
+        print(f"REGRESSION {regression}")
+    sys.exit(1 if regressions else 0)